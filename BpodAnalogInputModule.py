@@ -2,11 +2,101 @@ from pybpodapi.com.arcom import ArCOM, ArduinoTypes
 import time
 import numpy as np
 
+from voltsConverter import VoltsConverter, makeLookupTable
+
 
 class AnalogInException(Exception):
     pass
 
 
+class AnalogUSBStreamParser(object):
+    '''
+    Splits the analog input module's USB stream into frames and checks every frame before accepting it. Each frame is a 2 byte prefix
+    ('R' + 0x00, or '#' + syncData when the state machine sent a sync byte) followed by one little endian uint16 sample per streaming channel.
+    A frame is only accepted if its prefix is valid, every sample fits in the ADC's 13 bits, and the next frame also starts with a valid prefix.
+    When a frame fails the check (i.e. because a byte was lost), the parser scans forward byte by byte until it finds a position that passes
+    the same check and resumes from there. Bytes skipped while doing so are counted in nBytesSkipped, and the number of frames they are
+    estimated to have held is counted in nFramesLost, so that corrupted frames are detected instead of being converted to wrong voltages.
+    Accepting a frame only after the start of the next frame has arrived means that the most recent frame is held back until the next read.
+    '''
+
+    def __init__(self, nChannels, chBits=8192):
+        self.nChannels = nChannels
+        self.chBits = chBits
+        self.frameDtype = np.dtype([('prefix', 'u1'), ('syncByte', 'u1')] + [(f'ch{i}', '<u2') for i in range(nChannels)])
+        self.frameSize = self.frameDtype.itemsize
+        self.maxHighByte = (chBits - 1) >> 8  # Largest valid value of the most significant byte of a sample.
+        self.carry = np.zeros(shape=0, dtype='uint8')  # Bytes left over from the previous call that could not be parsed yet.
+        self.nBytesSkipped = 0
+        self.nFramesLost = 0
+        self.nResyncs = 0
+        self.pendingSkippedBytes = 0  # Bytes skipped since the last accepted frame.
+
+    def reset(self):
+        # Discard the bytes left over from the previous call (i.e. when the USB stream is restarted) but keep the counters.
+        self.carry = np.zeros(shape=0, dtype='uint8')
+        self.pendingSkippedBytes = 0
+
+    def getStats(self):
+        return {'nBytesSkipped': self.nBytesSkipped, 'nFramesLost': self.nFramesLost, 'nResyncs': self.nResyncs}
+
+    def parse(self, newBytes):
+        '''
+        Returns a structured array of every frame that could be validated in newBytes (together with the bytes left over from the previous call).
+        '''
+        data = np.concatenate((self.carry, np.frombuffer(newBytes, dtype='uint8')))
+        frameSize = self.frameSize
+        pos = 0
+        acceptedChunks = []
+        while True:
+            nDecidable = (len(data) - pos - 2) // frameSize  # Frames whose next frame's prefix has also arrived.
+            if nDecidable <= 0:
+                break
+            isValid = self.__validateFrames(data, pos, nDecidable)
+            nValid = nDecidable if isValid.all() else int(np.argmin(isValid))
+            if nValid > 0:
+                acceptedChunks.append(data[pos:(pos + (nValid * frameSize))])
+                pos += nValid * frameSize
+                if self.pendingSkippedBytes > 0:
+                    self.nFramesLost += max(1, round(self.pendingSkippedBytes / frameSize))
+                    self.pendingSkippedBytes = 0
+            if nValid == nDecidable:
+                break
+
+            # The frame at pos failed the check, so scan forward for the next position that passes it.
+            newPos = self.__findFrameStart(data, pos + 1)
+            if self.pendingSkippedBytes == 0:
+                self.nResyncs += 1
+            self.nBytesSkipped += newPos - pos
+            self.pendingSkippedBytes += newPos - pos
+            pos = newPos
+
+        self.carry = data[pos:]
+        if len(acceptedChunks) == 0:
+            return np.zeros(shape=0, dtype=self.frameDtype)
+        return np.concatenate(acceptedChunks).view(self.frameDtype)
+
+    def __validPrefixes(self, data, starts):
+        prefixes = data[starts]
+        return ((prefixes == 82) & (data[starts + 1] == 0)) | (prefixes == 35)  # 82 is ascii 'R' and 35 is ascii '#'.
+
+    def __validateFrames(self, data, pos, nFrames):
+        starts = pos + (np.arange(nFrames + 1) * self.frameSize)  # Includes the start of the frame after the last one.
+        validPrefixes = self.__validPrefixes(data, starts)
+        frames = data[pos:(pos + (nFrames * self.frameSize))].reshape(nFrames, self.frameSize)
+        validSamples = (frames[:, 3::2] <= self.maxHighByte).all(axis=1)
+        return validPrefixes[:-1] & validPrefixes[1:] & validSamples
+
+    def __findFrameStart(self, data, start):
+        lastDecidable = len(data) - self.frameSize - 2  # Last position where a frame and the next frame's prefix have both arrived.
+        if start <= lastDecidable:
+            candidates = start + np.flatnonzero((data[start:(lastDecidable + 1)] == 82) | (data[start:(lastDecidable + 1)] == 35))
+            for candidate in candidates:
+                if self.__validateFrames(data, candidate, 1)[0]:
+                    return int(candidate)
+        return max(start, lastDecidable + 1)  # None found yet, so keep the bytes that cannot be checked until more data arrives.
+
+
 class BpodAnalogIn(object):
     
     def __init__(self, serial_port):
@@ -14,6 +104,7 @@ class BpodAnalogIn(object):
         self.Port = ArCOM().open(serial_port=serial_port, baudrate=1312500, timeout=1)  # ArCOM Serial port
 
         # Private variables
+        self.__appliedCommands = {}  # Last configuration command of each type that the module acknowledged on this connection.
         self.__CurrentFirmwareVersion = 1
         self.__opMenuByte = 213  # Byte code to access op menu
         self.__nPhysicalChannels = 8 # Number of physical channels
@@ -34,6 +125,7 @@ class BpodAnalogIn(object):
         self.__USBStreamEnabled = 0
         self.__ModuleStreamEnabled = 0
         self.__nChannelsStreaming2USB = 0  # Number of channels that enabled USB streaming.
+        self.__usbStreamParser = AnalogUSBStreamParser(self.__nChannelsStreaming2USB, self.__chBits)  # Validates and splits the USB stream into frames.
 
         # Public variables
         self.nActiveChannels = self.__nPhysicalChannels  # Number of channels to sample (consecutive, beginning with channel 1)
@@ -79,6 +171,13 @@ class BpodAnalogIn(object):
     def getNActiveChannels(self):
         return self.nActiveChannels
 
+    def getUSBFrameDtype(self):
+        return self.__usbStreamParser.frameDtype
+
+    def getUSBStreamStats(self):
+        # Number of bytes skipped, frames lost, and re-synchronizations done by the USB stream parser since streaming was configured.
+        return self.__usbStreamParser.getStats()
+
     def getChannelInputVoltageMax(self, channelNum):
         if (channelNum < 0) or (channelNum > (self.__nPhysicalChannels - 1)):
             raise AnalogInException("Error getting channel's max input voltage: Must use a value from 0-7 for channelNum")
@@ -103,6 +202,32 @@ class BpodAnalogIn(object):
         elif (self.InputRange[channelNum] == '0V:10V'):
             return 0
 
+    def getVoltsLookupTables(self, inputRanges):
+        '''
+        Returns a 2D array with one row per range string in inputRanges that holds the voltage of every 13-bit count for that range.
+        '''
+        lookupTables = np.zeros(shape=(len(inputRanges), self.__chBits), dtype='float64')
+        for i in range(len(inputRanges)):
+            if inputRanges[i] not in self.__ValidRanges:
+                raise AnalogInException("Invalid range specified: '{0}'. Valid ranges are: {1}".format(inputRanges[i], self.__ValidRanges))
+            rangeIndex = self.__ValidRanges[inputRanges[i]]
+            lookupTables[i, :] = makeLookupTable(self.__chBits, self.__chBits, self.__RangeMultipliers[rangeIndex], self.__RangeOffsets[rangeIndex])
+        return lookupTables
+
+    def getVoltsScales(self, inputRanges):
+        '''
+        Returns a tuple of lists with the gain and offset of each range string in inputRanges, such that volts = (counts * gain) + offset.
+        '''
+        gains = [0] * len(inputRanges)
+        offsets = [0] * len(inputRanges)
+        for i in range(len(inputRanges)):
+            if inputRanges[i] not in self.__ValidRanges:
+                raise AnalogInException("Invalid range specified: '{0}'. Valid ranges are: {1}".format(inputRanges[i], self.__ValidRanges))
+            rangeIndex = self.__ValidRanges[inputRanges[i]]
+            gains[i] = self.__RangeMultipliers[rangeIndex] / self.__chBits
+            offsets[i] = -self.__RangeOffsets[rangeIndex]
+        return (gains, offsets)
+
     def getChannelThresholdVoltage(self, channelNum):
         if (channelNum < 0) or (channelNum > (self.__nPhysicalChannels - 1)):
             raise AnalogInException("Error getting channel's threshold voltage: Must use a value from 0-7 for channelNum")
@@ -113,6 +238,83 @@ class BpodAnalogIn(object):
             raise AnalogInException("Error getting channel's reset voltage: Must use a value from 0-7 for channelNum")
         return self.ResetVoltages[channelNum]
     
+    def applySettings(self, settings, force=False):
+        '''
+        Configures the module from a settings dict like the one returned by AnalogInputModuleSettingsDialog.getSettings() in one transaction.
+        The command for each setting is compared with the last one the module acknowledged since this object connected to it, and only the
+        commands that changed are sent. They are written back to back and all their acknowledgements are read at the end, so the
+        whole configuration costs at most one round-trip, and none when nothing changed. Use force=True to send every command regardless (i.e.
+        if the module might have been reconfigured by another program).
+        '''
+        if self.__Initialized and self.__USBstream2File:
+            raise AnalogInException('Error: The analog input module settings cannot be changed while streaming to a file.')
+
+        nChannels = settings['nActiveChannels']
+        samplingRate = settings['samplingRate']
+        inputRanges = list(settings['inputRanges'])
+        stream2USB = list(settings['enableUSBStreaming'])
+        stream2Module = list(settings.get('enableModuleStreaming', self.Stream2Module))
+        smEventsEnabled = list(settings['enableSMEventReporting'])
+        thresholds = list(settings['thresholdVoltages'])
+        resetVoltages = list(settings['resetVoltages'])
+
+        # Same checks as the individual setters.
+        if (nChannels < 1) or (nChannels > self.__nPhysicalChannels):
+            raise AnalogInException('Error setting active channel count: nChannels must be in the range 1: {0}'.format(self.__nPhysicalChannels))
+        if (samplingRate < 1) or (samplingRate > 10000):
+            raise AnalogInException('Error setting sampling rate: valid rates are in range: [1, 10000] Hz')
+        for name, value in (('input voltage ranges', inputRanges), ('threshold voltages', thresholds), ('reset voltages', resetVoltages), ('Stream2USB channels', stream2USB), ('Stream2Module channels', stream2Module), ('events enabled', smEventsEnabled)):
+            if not (len(value) == self.__nPhysicalChannels):
+                raise AnalogInException('Error setting {0}: The given list must be of length {1}'.format(name, self.__nPhysicalChannels))
+        for name, value in (('Stream2USB channels', stream2USB), ('Stream2Module channels', stream2Module), ('events enabled', smEventsEnabled)):
+            if not all((x == 0) or (x == 1) for x in value):
+                raise AnalogInException('Error setting {0}: enabled state must be 0 or 1'.format(name))
+        rangeIndices = [0] * self.__nPhysicalChannels
+        for i in range(self.__nPhysicalChannels):
+            if inputRanges[i] not in self.__ValidRanges:
+                raise AnalogInException("Invalid range specified: '{0}'. Valid ranges are: {1}".format(inputRanges[i], self.__ValidRanges))
+            rangeIndices[i] = self.__ValidRanges[inputRanges[i]]
+            rangeLimits = self.__InputRangeLimits[rangeIndices[i]]
+            if (thresholds[i] < rangeLimits[0]) or (thresholds[i] > rangeLimits[1]) or (resetVoltages[i] < rangeLimits[0]) or (resetVoltages[i] > rangeLimits[1]):
+                raise AnalogInException('Error setting thresholds: the threshold or reset voltage for channel {0} is not within the channel\'s voltage range of: {1}'.format(i, inputRanges[i]))
+
+        # Build the command for each setting, in the same order the individual setters are called.
+        commands = [
+            ('A', 'activeChannels', ArduinoTypes.get_uint8_array([self.__opMenuByte, ord('A'), nChannels])),
+            ('F', 'samplingRate', ArduinoTypes.get_uint8_array([self.__opMenuByte, ord('F')]) + ArduinoTypes.get_uint32_array([samplingRate])),
+            ('R', 'voltage range', ArduinoTypes.get_uint8_array([self.__opMenuByte, ord('R')]) + ArduinoTypes.get_uint8_array(rangeIndices)),
+            ('C', 'stream to USB', ArduinoTypes.get_uint8_array([self.__opMenuByte, ord('C')]) + ArduinoTypes.get_uint8_array(stream2USB + stream2Module)),
+            ('K', 'events enabled', ArduinoTypes.get_uint8_array([self.__opMenuByte, ord('K')]) + ArduinoTypes.get_uint8_array(smEventsEnabled)),
+            ('T', 'thresholds', ArduinoTypes.get_uint8_array([self.__opMenuByte, ord('T')]) + ArduinoTypes.get_uint16_array(self.__Volts2Bits(thresholds, rangeIndices) + self.__Volts2Bits(resetVoltages, rangeIndices))),
+        ]
+        changedCommands = [(op, paramName, msg) for (op, paramName, msg) in commands if force or (self.__appliedCommands.get(op) != msg)]
+
+        if self.__Initialized and (len(changedCommands) > 0):
+            self.Port.write_array(b''.join(msg for (op, paramName, msg) in changedCommands))
+            confirmations = self.Port.serial_object.read(len(changedCommands))
+            for i in range(len(changedCommands)):
+                op, paramName, msg = changedCommands[i]
+                if (i >= len(confirmations)) or (confirmations[i] != 1):
+                    self.__appliedCommands.clear()  # The module's configuration is now unknown, so send everything next time.
+                    if (i < len(confirmations)) and (confirmations[i] == 0):
+                        raise AnalogInException('Error setting {0}: the module denied your request.'.format(paramName))
+                    raise AnalogInException('Error setting {0}: module did not acknowledge new value.'.format(paramName))
+                self.__appliedCommands[op] = msg
+
+        self.nActiveChannels = nChannels
+        self.SamplingRate = samplingRate
+        self.InputRange = inputRanges
+        self.__rangeIndices = rangeIndices
+        self.Stream2USB = stream2USB
+        self.Stream2Module = stream2Module
+        self.__nChannelsStreaming2USB = sum(stream2USB)
+        self.__updateUSBStreamParser()
+        self.SMeventsEnabled = smEventsEnabled
+        self.Thresholds = thresholds
+        self.ResetVoltages = resetVoltages
+
+        return [op for (op, paramName, msg) in changedCommands]
+
     def setNsamplesToLog(self, nSamples):
         if self.__Initialized:
             nSamples2Send = nSamples
@@ -142,6 +344,7 @@ class BpodAnalogIn(object):
             msgToSend = msgHeader + msgBody
             self.Port.write_array(msgToSend)
             self.__confirmTransmission('samplingRate')
+            self.__rememberCommand('F', msgToSend)
 
         self.SamplingRate = sf
        
@@ -169,6 +372,7 @@ class BpodAnalogIn(object):
             msg = ArduinoTypes.get_uint8_array(array=[self.__opMenuByte, ord('A'), nChannels])            
             self.Port.write_array(msg)
             self.__confirmTransmission('activeChannels')
+            self.__rememberCommand('A', msg)
         
         self.nActiveChannels = nChannels
     
@@ -197,6 +401,7 @@ class BpodAnalogIn(object):
             msgToSend = msgHeader + msgBody
             self.Port.write_array(msgToSend)
             self.__confirmTransmission('voltage range')
+            self.__rememberCommand('R', msgToSend)
             oldRangeIndices = self.__rangeIndices
             self.__rangeIndices = InputRangeIndices
             # Set thresholds and reset values (expressed in voltages) to values in new range.
@@ -234,6 +439,7 @@ class BpodAnalogIn(object):
             msgToSend = msgHeader + msgBody
             self.Port.write_array(msgToSend)
             self.__confirmTransmission('thresholds')
+            self.__rememberCommand('T', msgToSend)
             self.__Initialized = 0 # Disable updating to change the object
             self.Thresholds = NewThresholds
             self.ResetVoltages = NewResets
@@ -269,6 +475,7 @@ class BpodAnalogIn(object):
             msgToSend = msgHeader + msgBody
             self.Port.write_array(msgToSend)
             self.__confirmTransmission('thresholds')
+            self.__rememberCommand('T', msgToSend)
         
         self.Thresholds = value
     
@@ -299,6 +506,7 @@ class BpodAnalogIn(object):
             msgToSend = msgHeader + msgBody
             self.Port.write_array(msgToSend)
             self.__confirmTransmission('reset values')
+            self.__rememberCommand('T', msgToSend)
         
         self.ResetVoltages = value
 
@@ -330,6 +538,7 @@ class BpodAnalogIn(object):
             msgToSend = msgHeader + msgBody
             self.Port.write_array(msgToSend)
             self.__confirmTransmission('events enabled')
+            self.__rememberCommand('K', msgToSend)
         
         self.SMeventsEnabled = value
 
@@ -365,6 +574,7 @@ class BpodAnalogIn(object):
         if self.__Initialized:
             msgToSend = ArduinoTypes.get_uint8_array([self.__opMenuByte, ord('S'), 0, 1])
             self.Port.write_array(msgToSend)
+            self.__usbStreamParser.reset()  # Do not try to join the leftover bytes from before the stream was stopped with the new frames.
             #self.__confirmTransmission('USB stream')
         
         self.__USBStreamEnabled = 1
@@ -397,6 +607,24 @@ class BpodAnalogIn(object):
             samples = self.Port.read_uint16_array(self.__nChannelsStreaming2USB)  # Each sample is 'uint16' which is 2 bytes, so read from each streaming channel.
             return ([prefix] + [samples])
 
+    def getSamplesFromUSB(self, maxFrames=None):
+        '''
+        Reads every byte that is waiting in the serial port's input buffer with one bulk read, instead of making two reads per sample like
+        getSampleFromUSB() does. The bytes are validated and split into frames by an AnalogUSBStreamParser (see its docstring) and returned as a
+        structured array with the fields 'prefix', 'syncByte', and 'ch0' to 'chN' (one uint16 field per channel that is streaming to USB, in
+        channel order). maxFrames limits how many frames worth of bytes are read at once. If nothing is waiting yet, it falls back to a blocking
+        read of a single frame (subject to the port's timeout), so the returned array can be empty.
+        '''
+        if self.__Initialized and self.__USBStreamEnabled:
+            frameSize = self.__usbStreamParser.frameSize
+            nBytesWanted = self.Port.bytes_available()
+            if maxFrames is not None:
+                nBytesWanted = min(nBytesWanted, (maxFrames * frameSize))
+            if nBytesWanted == 0:
+                nBytesWanted = frameSize  # Fallback to waiting for a single frame.
+
+            return self.__usbStreamParser.parse(self.Port.serial_object.read(nBytesWanted))
+
     # Reports threshold crossings to the state machine    
     def startReportingEvents(self):
         if self.__Initialized:
@@ -469,9 +697,11 @@ class BpodAnalogIn(object):
             msgToSend = msgHeader + msgBody  # Order matters.
             self.Port.write_array(msgToSend)
             self.__confirmTransmission('stream to USB')
+            self.__rememberCommand('C', msgToSend)
 
         self.Stream2USB = value
         self.__nChannelsStreaming2USB = sum(value)
+        self.__updateUSBStreamParser()
 
     
     def setChannelStream2USB(self, channelNum, value):
@@ -501,6 +731,7 @@ class BpodAnalogIn(object):
             msgToSend = msgHeader + msgBody  # Order matters.
             self.Port.write_array(msgToSend)
             self.__confirmTransmission('stream to Module')
+            self.__rememberCommand('C', msgToSend)
         
         self.Stream2Module = value
 
@@ -517,49 +748,43 @@ class BpodAnalogIn(object):
     def getFirmwareVersion(self):
         return self.FirmwareVersion
 
-    '''
     def getData(self):
+        '''
+        Retrieves every sample that the module logged to its onboard memory between startLogging() and stopLogging(), so that a session can
+        log at the module's top sampling rate and pull the data in bulk (i.e. during the ITI) instead of streaming every sample over USB during
+        the trial. The USB stream must be stopped first because its frames would otherwise be mixed with the logged data. The bytes are read into
+        a preallocated buffer, viewed without copying as uint16 samples, and scaled to volts with the same lookup tables used for the USB stream.
+        Returns a tuple of the time of each sample in seconds (nSamples,) and the voltages of each active channel (nActiveChannels, nSamples).
+        '''
+        if self.__USBStreamEnabled:
+            raise AnalogInException('Error retrieving logged data: the USB stream must be stopped before retrieving the logged data.')
+        if self.__Logging:
+            self.stopLogging()
+
         if (self.Port.bytes_available() > 0):
-            self.Port.read_bytes_array(self.Port.bytes_available()) # Clear buffer
-        
+            self.Port.serial_object.read(self.Port.bytes_available())  # Clear buffer
+
         # Send 'Retrieve' command to the AM
         msgToSend = ArduinoTypes.get_uint8_array([self.__opMenuByte, ord('D')])
         self.Port.write_array(msgToSend)
         nSamples = self.Port.read_uint32()
-        nValues = self.nActiveChannels * nSamples
-        # MaxReadSize = 50000
-        bytesAvailable = self.Port.bytes_available()  # 16380 bytes seems to be the max input buffer size on my computer.
-        MaxReadSize = int(bytesAvailable / 2)  # I divide by 2 to get the max number of 2-byte values.
-        if nValues < MaxReadSize:
-            RawData = self.Port.read_uint16_array(nValues)
 
-        else:
-            RawData = np.zeros(shape=nValues, dtype='uint16')
-            nReads = int(nValues / MaxReadSize)  # round down to nearest integer.
-            remainder = nValues % MaxReadSize
-            Pos = 0
-            for i in range(nReads):
-                bytesAvailable = self.Port.bytes_available()  
-                RawData[Pos : (Pos + MaxReadSize)] = self.Port.read_uint16_array(MaxReadSize)
-                Pos = Pos + MaxReadSize
-
-            bytesAvailable = self.Port.bytes_available()
-            RawData[Pos : (Pos + remainder)] = self.Port.read_uint16_array(remainder)
-
-        dataY = np.zeros(shape=(self.nActiveChannels, nSamples))
-        ReshapedRawData = np.reshape(RawData, newshape=(self.nActiveChannels, nSamples))
-        for i in range(self.nActiveChannels):
-            thisMultiplier = self.__RangeMultipliers[self.__rangeIndices[i]]
-            thisOffset = self.__RangeOffsets[self.__rangeIndices[i]]
-            dataY[i, : ] = ((ReshapedRawData[i, : ] / 8192) * thisMultiplier) - thisOffset
-
-        Period = 1 / self.SamplingRate
-        dataX = np.zeros(shape=nSamples)
-        for i in range(nSamples):
-            dataX[i] = i * Period
+        # The module sends the samples interleaved by channel, i.e. [sample1_ch1, sample1_ch2, ..., sample2_ch1, ...], as 2 byte values.
+        rawBytes = bytearray(nSamples * self.nActiveChannels * 2)
+        rawBytesView = memoryview(rawBytes)
+        pos = 0
+        while pos < len(rawBytes):
+            nRead = self.Port.serial_object.readinto(rawBytesView[pos:])  # Returns early with what arrived when the port's timeout elapses.
+            if nRead == 0:
+                raise AnalogInException('Error retrieving logged data: the module stopped sending after {0} of {1} bytes.'.format(pos, len(rawBytes)))
+            pos += nRead
+
+        rawData = np.frombuffer(rawBytes, dtype='<u2').reshape(nSamples, self.nActiveChannels)
+        converter = VoltsConverter(self.getVoltsLookupTables(self.InputRange[:self.nActiveChannels]))
+        dataY = converter.convert(rawData).T
+        dataX = np.arange(nSamples) / self.SamplingRate
 
         return (dataX, dataY)
-    '''
 
     def setZero(self):
         msgToSend = ArduinoTypes.get_uint8_array([213, ord('Z')])
@@ -578,6 +803,14 @@ class BpodAnalogIn(object):
             raise AnalogInException('Error setting {0}: module did not acknowledge new value.'.format(paramName))
         
 
+    def __rememberCommand(self, op, msg):
+        self.__appliedCommands[op] = msg
+
+    def __updateUSBStreamParser(self):
+        # Only a new frame size or bit depth needs a new parser. Otherwise keep the current one, so that its counters and the bytes it is holding back survive settings that did not change the frames.
+        if (self.__usbStreamParser.nChannels != self.__nChannelsStreaming2USB) or (self.__usbStreamParser.chBits != self.__chBits):
+            self.__usbStreamParser = AnalogUSBStreamParser(self.__nChannelsStreaming2USB, self.__chBits)
+
     def __Volts2Bits(self, VoltVector, RangeIndices):
         nElements = len(VoltVector)
         bits = [0] * nElements
@@ -0,0 +1,68 @@
+import logging
+import numpy as np
+from PyQt5.QtCore import QObject, QThread, pyqtSignal
+
+from analogRingBuffer import AnalogRingBuffer
+
+
+logging.basicConfig(format="%(message)s", level=logging.INFO)
+
+
+class AcquisitionWorker(QObject):
+    '''
+    Reads the analog samples from either the analog input module's USB stream or the bpod's flex channels as fast as they arrive and writes
+    them into a preallocated AnalogRingBuffer. It does nothing else, so that stalls in the consumers (HDF5 flushes, plotting, garbage collection)
+    cannot make the operating system's serial buffer overflow. Consumers get their own read cursor from the buffer with addReader().
+    '''
+    finished = pyqtSignal()
+
+    def __init__(self, analogInModule=None, bpod=None, bufferDuration=10):
+        super(AcquisitionWorker, self).__init__()
+        self.adc = analogInModule
+        self.bpod = bpod
+        self.keepRunning = True
+        self.buffer = None  # Stays None if there is no analog input to acquire.
+
+        if self.adc is not None:
+            self.bpod = None  # Avoid using the bpod in case it was also given as a parameter.
+            # Each item in the buffer is one USB frame (prefix, syncByte, ch0, ch1, ...).
+            self.buffer = AnalogRingBuffer(capacity=(bufferDuration * self.adc.getSamplingRate()), dtype=self.adc.getUSBFrameDtype())
+
+        elif self.bpod is not None:
+            channelIndices = self.bpod.hardware.analog_input_channels  # list of channel indices of channels configured for analog input.
+            if (channelIndices is not None) and (len(channelIndices) > 0):
+                self.nChannels = len(channelIndices)
+                samplingRate = 1 / (self.bpod.hardware.analog_input_sampling_interval * 0.0001)  # Multiply by the state machines timer period of 100 microseconds.
+                # Each item in the buffer is one sample: the trial number followed by the value of each channel.
+                self.buffer = AnalogRingBuffer(capacity=(bufferDuration * samplingRate), dtype='uint32', itemShape=((self.nChannels + 1),))
+                self.partialSample = np.zeros(shape=0, dtype='uint32')  # Values read after the last complete sample.
+            else:
+                self.bpod = None  # Make it None to indicate that there is no analog input.
+
+    def run(self):
+        if self.adc is not None:
+            while self.keepRunning:
+                analogData = self.adc.getSamplesFromUSB()
+                if analogData is None:
+                    QThread.msleep(10)  # USB streaming is stopped (i.e. experiment is paused) so wait for it to start again.
+                else:
+                    self.buffer.write(analogData)
+
+        elif self.bpod is not None:
+            while self.keepRunning:
+                analogData = self.bpod.read_analog_input()
+                if len(analogData) > 0:
+                    # Keep the values of an incomplete sample for the next read so that the trial numbers and channels stay aligned.
+                    values = np.concatenate((self.partialSample, np.asarray(analogData, dtype='uint32')))
+                    nSamples = len(values) // (self.nChannels + 1)  # Add one to account for the trial number that is included with every sample.
+                    self.partialSample = values[(nSamples * (self.nChannels + 1)):]
+                    if nSamples > 0:
+                        self.buffer.write(values[:(nSamples * (self.nChannels + 1))].reshape(nSamples, (self.nChannels + 1)))
+                else:
+                    QThread.usleep(500)
+
+        logging.info("AcquisitionWorker finished")
+        self.finished.emit()
+
+    def stopRunning(self):
+        self.keepRunning = False
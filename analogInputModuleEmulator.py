@@ -0,0 +1,347 @@
+import argparse
+import logging
+import os
+import select
+import threading
+import time
+import tty
+import numpy as np
+
+
+logging.basicConfig(format="%(message)s", level=logging.INFO)
+
+
+class AnalogInputModuleEmulator(object):
+    '''
+    Software stand-in for the Bpod analog input module (firmware v3) that runs on a Linux pseudo-terminal, so that BpodAnalogIn, the
+    AcquisitionWorker and the SaveDataWorker can be exercised and benchmarked without the hardware. Open BpodAnalogIn with getPortName() as the
+    serial port. It answers the op menu commands (213 followed by 'O', 'F', 'A', 'R', 'T', 'C', 'K', 'S', 'E', 'L', 'P', 'W', 'D', or 'Z') with
+    the same acknowledgements as the firmware, and while the USB stream is on it sends one frame per sample period ('R' + 0x00, or '#' + syncByte
+    for the frame after a sync byte, followed by one uint16 per channel that is both active and enabled for USB streaming).
+
+    waveform is 'sine' (each channel at frequency * (channelNum + 1) Hz with the given amplitude as a fraction of the channel's range) or 'noise'
+    (gaussian with the given amplitude as the standard deviation, also as a fraction of the range). syncInterval (seconds) makes it insert a sync
+    byte periodically, cycling through syncBytes (1 is ADC_start and 2 is ADC_stop in the protocol), the way the state machine would during a
+    trial. sendSyncByte() inserts one on demand. dropRate is the probability that one random byte of each frame is deleted before it is sent, to
+    test the USB stream parser's re-synchronization. If the pseudo-terminal's buffer is full because the reader fell behind, the bytes that do not
+    fit are discarded and counted in nBytesOverflowed, similarly to the module's USB buffer overflowing.
+    Threshold events are not emulated because they are sent to the state machine and not to the computer.
+    '''
+
+    __opMenuByte = 213
+    __firmwareVersion = 3
+    __nPhysicalChannels = 8
+    __chBits = 8192
+    __rangeMultipliers = [20, 10, 5, 10]
+    __rangeOffsets = [10, 5, 2.5, 0]
+    # Number of parameter bytes that follow each op code.
+    __nParamBytes = {'O': 0, 'F': 4, 'A': 1, 'R': __nPhysicalChannels, 'T': (__nPhysicalChannels * 4), 'C': (__nPhysicalChannels * 2), 'K': __nPhysicalChannels,
+                     'S': 2, 'E': 2, 'L': 1, 'P': 1, 'W': 4, 'D': 0, 'Z': 0}
+
+    def __init__(self, waveform='sine', amplitude=0.5, frequency=1.0, syncInterval=None, syncBytes=(1, 2), dropRate=0.0, seed=None):
+        if waveform not in ('sine', 'noise'):
+            raise ValueError("waveform must be 'sine' or 'noise'")
+        self.waveform = waveform
+        self.amplitude = amplitude
+        self.frequency = frequency
+        self.syncInterval = syncInterval
+        self.syncBytes = list(syncBytes)
+        self.dropRate = dropRate
+        self.rng = np.random.default_rng(seed)
+
+        # Module settings, with the same defaults as the firmware.
+        self.samplingRate = 1000
+        self.nActiveChannels = self.__nPhysicalChannels
+        self.rangeIndices = [0] * self.__nPhysicalChannels
+        self.stream2USB = [0] * self.__nPhysicalChannels
+        self.stream2Module = [0] * self.__nPhysicalChannels
+        self.smEventsEnabled = [0] * self.__nPhysicalChannels
+        self.thresholdBits = [self.__chBits - 1] * self.__nPhysicalChannels
+        self.resetBits = [0] * self.__nPhysicalChannels
+        self.streamPrefix = ord('R')
+        self.nSamplesToLog = 0  # 0 means infinite.
+        self.usbStreamEnabled = False
+        self.moduleStreamEnabled = False
+        self.logging = False
+        self.loggedChunks = []
+        self.nSamplesLogged = 0
+
+        # Statistics.
+        self.nFramesSent = 0
+        self.nSyncFramesSent = 0
+        self.nBytesSent = 0
+        self.nBytesDropped = 0
+        self.nFramesCorrupted = 0
+        self.nBytesOverflowed = 0
+
+        self.sampleIndex = 0  # Index of the next sample to be acquired, used as the time base of the waveforms.
+        self.pendingSyncBytes = []
+        self.nextSyncTime = None
+        self.settingsLock = threading.Lock()  # Protects the settings from being changed by a command in the middle of generating a block.
+        self.writeLock = threading.Lock()  # Keeps command replies from being inserted in the middle of a block of frames.
+        self.keepRunning = False
+        self.masterFd = None
+        self.slaveFd = None
+        self.commandThread = None
+        self.streamThread = None
+
+    def start(self):
+        self.masterFd, self.slaveFd = os.openpty()
+        tty.setraw(self.slaveFd)
+        os.set_blocking(self.masterFd, False)
+        self.keepRunning = True
+        self.commandThread = threading.Thread(target=self.__runCommandLoop, daemon=True)
+        self.streamThread = threading.Thread(target=self.__runStreamLoop, daemon=True)
+        self.commandThread.start()
+        self.streamThread.start()
+        return self
+
+    def stop(self):
+        self.keepRunning = False
+        for thread in (self.commandThread, self.streamThread):
+            if thread is not None:
+                thread.join()
+        for fd in (self.masterFd, self.slaveFd):
+            if fd is not None:
+                os.close(fd)
+        self.masterFd = None
+        self.slaveFd = None
+
+    def getPortName(self):
+        return os.ttyname(self.slaveFd)
+
+    def getStats(self):
+        return {'nFramesSent': self.nFramesSent, 'nSyncFramesSent': self.nSyncFramesSent, 'nBytesSent': self.nBytesSent, 'nBytesDropped': self.nBytesDropped,
+                'nFramesCorrupted': self.nFramesCorrupted, 'nBytesOverflowed': self.nBytesOverflowed}
+
+    def sendSyncByte(self, syncByte):
+        # Same as the state machine sending a byte to the module. It is relayed in the prefix of the next frame.
+        with self.settingsLock:
+            self.pendingSyncBytes.append(syncByte)
+
+    def getStreamingChannels(self):
+        # The firmware only streams channels that are active (the first nActiveChannels channels).
+        return [i for i in range(self.nActiveChannels) if self.stream2USB[i]]
+
+    def __runCommandLoop(self):
+        received = bytearray()
+        while self.keepRunning:
+            readable, _, _ = select.select([self.masterFd], [], [], 0.05)
+            if not readable:
+                continue
+            try:
+                received += os.read(self.masterFd, 4096)
+            except (BlockingIOError, OSError):
+                continue
+
+            while len(received) > 0:
+                if received[0] != self.__opMenuByte:
+                    del received[0]  # Not a command, so ignore it like the firmware does.
+                    continue
+                if len(received) < 2:
+                    break
+                op = chr(received[1])
+                if op not in self.__nParamBytes:
+                    logging.info(f"AnalogInputModuleEmulator: unknown op code {received[1]}")
+                    del received[:2]
+                    continue
+                nBytes = 2 + self.__nParamBytes[op]
+                if len(received) < nBytes:
+                    break  # Wait for the rest of the parameters.
+                params = bytes(received[2:nBytes])
+                del received[:nBytes]
+                self.__handleCommand(op, params)
+
+    def __handleCommand(self, op, params):
+        reply = b'\x01'  # Most commands are acknowledged with a 1.
+        with self.settingsLock:
+            if op == 'O':
+                self.usbStreamEnabled = False
+                self.logging = False
+                reply = bytes([161]) + np.array([self.__firmwareVersion], dtype='<u4').tobytes()
+            elif op == 'F':
+                samplingRate = int(np.frombuffer(params, dtype='<u4')[0])
+                if (samplingRate < 1) or (samplingRate > 10000):
+                    reply = b'\x00'
+                else:
+                    self.samplingRate = samplingRate
+                    self.nextSyncTime = None
+            elif op == 'A':
+                if (params[0] < 1) or (params[0] > self.__nPhysicalChannels):
+                    reply = b'\x00'
+                else:
+                    self.nActiveChannels = params[0]
+            elif op == 'R':
+                if max(params) > 3:
+                    reply = b'\x00'
+                else:
+                    self.rangeIndices = list(params)
+            elif op == 'T':
+                bits = np.frombuffer(params, dtype='<u2').tolist()
+                self.thresholdBits = bits[:self.__nPhysicalChannels]
+                self.resetBits = bits[self.__nPhysicalChannels:]
+            elif op == 'C':
+                self.stream2USB = list(params[:self.__nPhysicalChannels])
+                self.stream2Module = list(params[self.__nPhysicalChannels:])
+            elif op == 'K':
+                self.smEventsEnabled = list(params)
+            elif op == 'S':
+                if params[0] == 0:
+                    self.usbStreamEnabled = bool(params[1])
+                    self.sampleIndex = 0
+                    self.nextSyncTime = None
+                    reply = b''  # BpodAnalogIn does not read an acknowledgement for the USB stream because frames may already be in the buffer.
+                else:
+                    self.moduleStreamEnabled = bool(params[1])
+            elif op == 'E':
+                pass  # Event reporting is acknowledged but threshold events are not emulated.
+            elif op == 'L':
+                self.logging = bool(params[0])
+                if self.logging:
+                    self.loggedChunks = []
+                    self.nSamplesLogged = 0
+            elif op == 'P':
+                self.streamPrefix = params[0]
+            elif op == 'W':
+                self.nSamplesToLog = int(np.frombuffer(params, dtype='<u4')[0])
+            elif op == 'D':
+                if len(self.loggedChunks) > 0:
+                    loggedCounts = np.concatenate(self.loggedChunks)
+                else:
+                    loggedCounts = np.zeros(shape=(0, self.nActiveChannels), dtype='<u2')
+                reply = np.array([len(loggedCounts)], dtype='<u4').tobytes() + loggedCounts.astype('<u2').tobytes()
+            elif op == 'Z':
+                reply = b''
+
+        if len(reply) > 0:
+            self.__write(reply, dropIfFull=False)
+
+    def __runStreamLoop(self):
+        startTime = None
+        nSamplesDue = 0
+        while self.keepRunning:
+            time.sleep(0.001)
+            with self.settingsLock:
+                acquiring = self.usbStreamEnabled or self.logging
+                samplingRate = self.samplingRate
+            if not acquiring:
+                startTime = None
+                continue
+
+            now = time.perf_counter()
+            if startTime is None:
+                startTime = now
+                nSamplesDue = 0
+            nSamples = int((now - startTime) * samplingRate) - nSamplesDue
+            if nSamples <= 0:
+                continue
+            nSamples = min(nSamples, samplingRate)  # Never generate more than one second at once, i.e. after the process was suspended.
+            nSamplesDue += nSamples
+            self.__acquire(nSamples, now)
+
+    def __acquire(self, nSamples, now):
+        with self.settingsLock:
+            counts = self.__generateCounts(nSamples)
+            self.sampleIndex += nSamples
+
+            if self.logging:
+                loggedCounts = counts[:, :self.nActiveChannels]
+                if self.nSamplesToLog > 0:
+                    loggedCounts = loggedCounts[:(self.nSamplesToLog - self.nSamplesLogged)]
+                    if (self.nSamplesLogged + len(loggedCounts)) >= self.nSamplesToLog:
+                        self.logging = False
+                self.loggedChunks.append(loggedCounts)
+                self.nSamplesLogged += len(loggedCounts)
+
+            if not self.usbStreamEnabled:
+                return
+            channels = self.getStreamingChannels()
+            frameDtype = np.dtype([('prefix', 'u1'), ('syncByte', 'u1')] + [(f'ch{i}', '<u2') for i in range(len(channels))])
+            frames = np.zeros(shape=nSamples, dtype=frameDtype)
+            frames['prefix'] = self.streamPrefix
+            for i in range(len(channels)):
+                frames[f'ch{i}'] = counts[:, channels[i]]
+
+            if self.syncInterval is not None:
+                if self.nextSyncTime is None:
+                    self.nextSyncTime = now + self.syncInterval
+                while now >= self.nextSyncTime:
+                    self.pendingSyncBytes.append(self.syncBytes[0])
+                    self.syncBytes = self.syncBytes[1:] + self.syncBytes[:1]
+                    self.nextSyncTime += self.syncInterval
+            nSync = min(len(self.pendingSyncBytes), nSamples)
+            if nSync > 0:
+                # The firmware relays each sync byte in the prefix of the next frame, so spread them over the first frames of the block.
+                frames['prefix'][:nSync] = ord('#')
+                frames['syncByte'][:nSync] = self.pendingSyncBytes[:nSync]
+                del self.pendingSyncBytes[:nSync]
+                self.nSyncFramesSent += nSync
+
+        data = frames.view('uint8')
+        if self.dropRate > 0:
+            corrupted = np.flatnonzero(self.rng.random(nSamples) < self.dropRate)
+            if len(corrupted) > 0:
+                dropPositions = (corrupted * frameDtype.itemsize) + self.rng.integers(0, frameDtype.itemsize, size=len(corrupted))
+                data = np.delete(data, dropPositions)
+                self.nFramesCorrupted += len(corrupted)
+                self.nBytesDropped += len(corrupted)
+        self.nFramesSent += nSamples
+        self.__write(data.tobytes(), dropIfFull=True)
+
+    def __generateCounts(self, nSamples):
+        # Returns the ADC counts of every physical channel for the next nSamples samples as an array of shape (nSamples, nPhysicalChannels).
+        t = (self.sampleIndex + np.arange(nSamples)) / self.samplingRate
+        channelNums = np.arange(self.__nPhysicalChannels)
+        if self.waveform == 'sine':
+            fractions = self.amplitude * np.sin(2 * np.pi * self.frequency * np.outer(t, channelNums + 1))
+        else:
+            fractions = self.amplitude * self.rng.standard_normal(size=(nSamples, self.__nPhysicalChannels))
+        multipliers = np.array([self.__rangeMultipliers[i] for i in self.rangeIndices])
+        offsets = np.array([self.__rangeOffsets[i] for i in self.rangeIndices])
+        # Centered on the middle of each range, with the fraction relative to half the range's span.
+        volts = (multipliers / 2) - offsets + (fractions * (multipliers / 2))
+        counts = np.round(((volts + offsets) / multipliers) * self.__chBits)
+        return np.clip(counts, 0, self.__chBits - 1).astype('<u2')
+
+    def __write(self, data, dropIfFull):
+        with self.writeLock:
+            view = memoryview(data)
+            while len(view) > 0:
+                try:
+                    nWritten = os.write(self.masterFd, view)
+                except BlockingIOError:
+                    nWritten = 0
+                except OSError:
+                    return  # The emulator is being stopped.
+                view = view[nWritten:]
+                self.nBytesSent += nWritten
+                if len(view) > 0:
+                    if dropIfFull:
+                        self.nBytesOverflowed += len(view)
+                        return
+                    select.select([], [self.masterFd], [], 0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulates the Bpod analog input module on a pseudo-terminal. Connect to the printed port name.')
+    parser.add_argument('--waveform', choices=['sine', 'noise'], default='sine')
+    parser.add_argument('--amplitude', type=float, default=0.5, help='fraction of each channel\'s range')
+    parser.add_argument('--frequency', type=float, default=1.0, help='sine frequency of the first channel in Hz')
+    parser.add_argument('--sync-interval', type=float, default=None, help='seconds between sync bytes')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='probability that a byte of each frame is dropped')
+    args = parser.parse_args()
+
+    emulator = AnalogInputModuleEmulator(waveform=args.waveform, amplitude=args.amplitude, frequency=args.frequency, syncInterval=args.sync_interval,
+                                         dropRate=args.drop_rate).start()
+    logging.info(f"Analog input module emulator running on {emulator.getPortName()} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    emulator.stop()
+    logging.info(f"AnalogInputModuleEmulator stats: {emulator.getStats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import threading
+import numpy as np
+
+
+class AnalogRingBuffer(object):
+    '''
+    Preallocated ring buffer that hands off analog samples from the acquisition thread to any number of consumers (saving, plotting, etc.).
+    There is a single producer that calls write() and never blocks, and each consumer gets its own read cursor from addReader(). Every item
+    has an absolute index (the number of items written before it) so consumers can tell exactly which samples they received. If a consumer
+    falls more than 'capacity' items behind, the oldest items are overwritten before it reads them. Its cursor then jumps forward to the
+    oldest item still in the buffer and the number of items it missed is added to its overrun counter.
+    Consumers that would otherwise poll can register a threading.Event with addWakeEvent(), which is set after every write, and wait on it.
+    '''
+
+    def __init__(self, capacity, dtype, itemShape=()):
+        self.capacity = int(capacity)
+        self.buffer = np.zeros(shape=((self.capacity,) + tuple(itemShape)), dtype=dtype)
+        self.nWritten = 0  # Total number of items written since the buffer was created. This is also the absolute index of the next item.
+        self.readCursors = {}  # Absolute index of the next item to be read by each reader.
+        self.overrunCounts = {}  # Number of items each reader missed because they were overwritten before being read.
+        self.nextReaderId = 0
+        self.wakeEvents = []  # threading.Event objects that are set after every write.
+        self.lock = threading.Lock()
+
+    def addReader(self):
+        with self.lock:
+            readerId = self.nextReaderId
+            self.nextReaderId += 1
+            self.readCursors[readerId] = self.nWritten  # New readers only see items written after they were added.
+            self.overrunCounts[readerId] = 0
+        return readerId
+
+    def removeReader(self, readerId):
+        with self.lock:
+            del self.readCursors[readerId]
+            del self.overrunCounts[readerId]
+
+    def addWakeEvent(self, event):
+        with self.lock:
+            self.wakeEvents.append(event)
+
+    def removeWakeEvent(self, event):
+        with self.lock:
+            self.wakeEvents.remove(event)
+
+    def write(self, block):
+        nItems = len(block)
+        if nItems == 0:
+            return
+
+        with self.lock:
+            if nItems > self.capacity:
+                # Only the last 'capacity' items of the block can fit, so count the rest as written (and overwritten) right away.
+                self.nWritten += nItems - self.capacity
+                block = block[-self.capacity:]
+                nItems = self.capacity
+
+            start = self.nWritten % self.capacity
+            end = start + nItems
+            if end <= self.capacity:
+                self.buffer[start:end] = block
+            else:
+                nFirst = self.capacity - start
+                self.buffer[start:] = block[:nFirst]
+                self.buffer[:(nItems - nFirst)] = block[nFirst:]
+            self.nWritten += nItems
+            wakeEvents = list(self.wakeEvents)
+
+        for event in wakeEvents:
+            event.set()
+
+    def read(self, readerId, maxItems=None):
+        '''
+        Returns a tuple of the absolute index of the first item and a copy of every item the reader has not read yet (up to maxItems).
+        '''
+        with self.lock:
+            cursor = self.readCursors[readerId]
+            oldest = self.nWritten - self.capacity
+            if cursor < oldest:
+                self.overrunCounts[readerId] += oldest - cursor
+                cursor = oldest
+
+            nItems = self.nWritten - cursor
+            if (maxItems is not None) and (nItems > maxItems):
+                nItems = maxItems
+
+            start = cursor % self.capacity
+            end = start + nItems
+            if end <= self.capacity:
+                block = self.buffer[start:end].copy()
+            else:
+                block = np.concatenate((self.buffer[start:], self.buffer[:(end - self.capacity)]))
+            self.readCursors[readerId] = cursor + nItems
+
+        return (cursor, block)
+
+    def readLast(self, nItems):
+        '''
+        Returns a copy of the last nItems items written (or of every item still in the buffer if there are fewer) without moving any reader's cursor.
+        '''
+        with self.lock:
+            nItems = max(0, min(nItems, self.nWritten, self.capacity))
+            start = (self.nWritten - nItems) % self.capacity
+            end = start + nItems
+            if end <= self.capacity:
+                return self.buffer[start:end].copy()
+            return np.concatenate((self.buffer[start:], self.buffer[:(end - self.capacity)]))
+
+    def getWriteIndex(self):
+        '''
+        Returns the absolute index that the next item written will have, which is the number of items written so far.
+        '''
+        with self.lock:
+            return self.nWritten
+
+    def getNumAvailable(self, readerId):
+        with self.lock:
+            return min(self.nWritten - self.readCursors[readerId], self.capacity)
+
+    def getOverrunCount(self, readerId):
+        return self.overrunCounts[readerId]
@@ -6,7 +6,7 @@ from serial.serialutil import SerialException
 import serial.tools.list_ports
 import serial
 
-from PyQt5.QtWidgets import QApplication, QMainWindow, QMessageBox, QProgressDialog, QFileDialog, QMdiSubWindow
+from PyQt5.QtWidgets import QApplication, QMainWindow, QMessageBox, QProgressDialog, QFileDialog, QMdiSubWindow, QLabel, QComboBox, QCheckBox, QHBoxLayout
 from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal, pyqtSlot, Qt
 from PyQt5.QtGui import QCloseEvent
 
@@ -17,9 +17,10 @@ import olfactometry
 
 from ui_files.main_window_ui import Ui_MainWindow
 from saveDataWorker import SaveDataWorker
+from acquisitionWorker import AcquisitionWorker
 from inputEventWorker import InputEventWorker
 from protocolWorker import ProtocolWorker
-from streamingWorker import StreamingWorker
+from streamingWorker import makeStreamingWorker
 from flowUsagePlotWorker import FlowUsagePlotWorker
 from resultsPlotWorker import ResultsPlotWorker
 from protocolEditorDialog import ProtocolEditorDialog
@@ -66,6 +67,7 @@ class Window(QMainWindow, Ui_MainWindow):
         self.adc = None
         self.bpod = None
         self.saveDataWorker = None
+        self.acquisitionWorker = None
         self.protocolWorker = None
         self.itiMinSpinBox.setMaximum(self.itiMaxSpinBox.value())  # I do not want the itiMinSpinBox to be higher than the itiMaxSpinBox's current value.
         self.itiMaxSpinBox.setMinimum(self.itiMinSpinBox.value())  # I do not want the itiMaxSpinBox to be lower than the itiMinSpinBox's current value.
@@ -76,6 +78,8 @@ class Window(QMainWindow, Ui_MainWindow):
         self.olfaConfigFileName = ''
         self.analogInputModuleSettingsDialog = None
         self.bpodFlexChannelSettingsDialog = None
+        self.dataStorageSettings = {}  # Settings for how the SaveDataWorker organizes the results file. Empty means use its defaults.
+        self.streamingChannelRanges = []  # (ymin, ymax) of each analog channel in the streaming plot, or None to use the plot's y axis.
         self.isPaused = False
         self.loadDefaults()
 
@@ -85,6 +89,7 @@ class Window(QMainWindow, Ui_MainWindow):
 
         self.oldProtocolThreads = []
         self.oldSaveDataThreads = []
+        self.oldAcquisitionThreads = []
         self.oldInputEventThreads = []
 
 
@@ -98,10 +103,19 @@ class Window(QMainWindow, Ui_MainWindow):
         # self.currentTrialSubWindow.resize(720, 230)
         self.mdiArea.addSubWindow(self.currentTrialSubWindow)
 
-        self.streaming = StreamingWorker(self.maxtSpinBox.value(), self.dtDoubleSpinBox.value(), self.yMinDoubleSpinBox.value(), self.yMaxDoubleSpinBox.value(), self.plotIntervalSpinBox.value())
+        self.streaming = makeStreamingWorker(self.getStreamingPlotBackend(), self.maxtSpinBox.value(), self.dtDoubleSpinBox.value(), self.yMinDoubleSpinBox.value(), self.yMaxDoubleSpinBox.value(), self.plotIntervalSpinBox.value())
         self.streamingWidget = self.streaming.getFigure()
         self.streamingWidget.setMinimumSize(500, 250)
         self.streamingPlotSubWindowWidgetGridLayout.addWidget(self.streamingWidget, 0, 2, 5, 1)
+        # Below the plot: whether the analog channels are overlaid or stacked, and a check box to show or hide each channel, created by updateStreamingChannels().
+        self.channelLayoutLabel = QLabel('Channels')
+        self.channelLayoutComboBox = QComboBox()
+        self.channelLayoutComboBox.addItems(['Overlaid', 'Stacked'])
+        self.channelCheckBoxesLayout = QHBoxLayout()
+        self.channelCheckBoxes = []
+        self.streamingPlotSubWindowWidgetGridLayout.addWidget(self.channelLayoutLabel, 5, 0, 1, 1)
+        self.streamingPlotSubWindowWidgetGridLayout.addWidget(self.channelLayoutComboBox, 5, 1, 1, 1)
+        self.streamingPlotSubWindowWidgetGridLayout.addLayout(self.channelCheckBoxesLayout, 5, 2, 1, 1)
         self.streamingSubWindow = MyQMdiSubWindow()
         self.streamingSubWindow.closed.connect(self.updateViewMenu)
         self.streamingSubWindow.setObjectName("streamingSubWindow")
@@ -185,6 +199,7 @@ class Window(QMainWindow, Ui_MainWindow):
         self.maxtSpinBox.valueChanged.connect(lambda maxt: self.streaming.setXaxis(maxt))
         self.dtDoubleSpinBox.valueChanged.connect(lambda dt: self.streaming.set_dt(dt))
         self.plotIntervalSpinBox.valueChanged.connect(lambda x: self.streaming.setPlotInterval(x))
+        self.channelLayoutComboBox.currentTextChanged.connect(lambda text: self.streaming.setChannelLayout(text.lower()))
 
         self.leftSensorPortNumComboBox.currentTextChanged.connect(self.recordLeftSensorPort)
         self.leftWaterValvePortNumComboBox.currentTextChanged.connect(self.recordLeftWaterValvePort)
@@ -194,6 +209,13 @@ class Window(QMainWindow, Ui_MainWindow):
         self.rightWaterValveDurationSpinBox.valueChanged.connect(self.recordRightWaterValveDuration)
         self.finalValvePortNumComboBox.currentTextChanged.connect(self.recordFinalValvePort)
 
+    def getStreamingPlotBackend(self):
+        # The streaming plot is created before loadDefaults() is called, so its backend is read from defaults.json here. Changing it needs a restart.
+        if os.path.exists("defaults.json"):
+            with open("defaults.json", 'r') as defaultSettings:
+                return json.load(defaultSettings).get('streamingPlot', {}).get('backend', 'matplotlib')
+        return 'matplotlib'
+
     def loadDefaults(self):
         if os.path.exists("defaults.json"):
             with open("defaults.json", 'r') as defaultSettings:
@@ -228,6 +250,8 @@ class Window(QMainWindow, Ui_MainWindow):
             self.maxtSpinBox.setValue(self.defaultSettings['streamingPlot']['max_t'])
             self.dtDoubleSpinBox.setValue(self.defaultSettings['streamingPlot']['dt'])
             self.plotIntervalSpinBox.setValue(self.defaultSettings['streamingPlot']['plotInterval'])
+            self.channelLayoutComboBox.setCurrentText(self.defaultSettings['streamingPlot'].get('channelLayout', 'overlaid').capitalize())
+            self.streamingChannelRanges = self.defaultSettings['streamingPlot'].get('channelRanges', [])
 
             if self.bpodFlexChannelSettingsDialog is None:  # In case the user starts experiment without configuring the bpod flex channel settings from the dialog window, create the dialog window object once here. There get the default settings for it.
                 self.bpodFlexChannelSettingsDialog = BpodFlexChannelSettingsDialog(parent=self)
@@ -239,6 +263,8 @@ class Window(QMainWindow, Ui_MainWindow):
                 self.analogInputModuleSettingsDialog.accepted.connect(self.configureAnalogInputModule)
             self.analogInputModuleSettingsDialog.loadSettings(self.defaultSettings['analogInputModule'])
 
+            self.dataStorageSettings = self.defaultSettings.get('dataStorage', {})  # defaults.json files from before the dataStorage section use the SaveDataWorker's defaults.
+
         else:
             QMessageBox.warning(self, 'Not Found', 'The defaults.json file was not found.')
 
@@ -397,13 +423,7 @@ class Window(QMainWindow, Ui_MainWindow):
                 self.analogInputModuleSettingsDialog = AnalogInputModuleSettingsDialog(parent=self)
                 self.analogInputModuleSettingsDialog.accepted.connect(self.configureAnalogInputModule)
             settings = self.analogInputModuleSettingsDialog.getSettings()
-            self.adc.setNactiveChannels(settings['nActiveChannels'])
-            self.adc.setSamplingRate(settings['samplingRate'])
-            self.adc.setInputRange(settings['inputRanges'])
-            self.adc.setStream2USB(settings['enableUSBStreaming'])
-            self.adc.setSMeventsEnabled(settings['enableSMEventReporting'])
-            self.adc.setThresholds(settings['thresholdVoltages'])
-            self.adc.setResetVoltages(settings['resetVoltages'])
+            self.adc.applySettings(settings)  # Only sends the settings that changed since the last time the module was configured.
 
     def startAnalogModule(self):
         self.adc.startReportingEvents()
@@ -502,6 +522,7 @@ class Window(QMainWindow, Ui_MainWindow):
         if self.adc is not None:
             self.startAnalogModule()
 
+        self.runAcquisitionThread()
         self.runSaveDataThread()
         self.runInputEventThread()
         self.runProtocolThread()
@@ -911,6 +932,23 @@ class Window(QMainWindow, Ui_MainWindow):
         self.inputEventThread.start()
         logging.info(f"inputEventThread is running? {self.inputEventThread.isRunning()}")
 
+    def runAcquisitionThread(self):
+        logging.info(f"from _runAcquisitionThread, thread is {QThread.currentThread()} and ID is {int(QThread.currentThreadId())}")
+        self.acquisitionThread = QThread(parent=self)
+
+        ## hack fix for Qthread deleted error, more info in __init__
+        self.oldAcquisitionThreads.append(self.acquisitionThread)
+
+        self.acquisitionWorker = AcquisitionWorker(self.adc, self.bpod)
+        self.acquisitionWorker.moveToThread(self.acquisitionThread)
+        self.acquisitionThread.started.connect(self.acquisitionWorker.run)  # run() returns right away if there is no analog input to acquire.
+        self.acquisitionWorker.finished.connect(self.acquisitionThread.quit)
+        self.acquisitionWorker.finished.connect(self.acquisitionWorker.deleteLater)
+        self.acquisitionThread.finished.connect(self.acquisitionThread.deleteLater)
+        self.stopRunningSignal.connect(lambda: self.acquisitionWorker.stopRunning())  # Need to use lambda, to explicitly make function call (from the main thread). Because the acquisitionWorker thread will never call it since its in a infinite loop.
+        self.acquisitionThread.start()
+        logging.info(f"acquisitionThread running? {self.acquisitionThread.isRunning()}")
+
     def runSaveDataThread(self):
         logging.info(f"from _runSaveDataThread, thread is {QThread.currentThread()} and ID is {int(QThread.currentThreadId())}")
         if self.analogInputModuleSettingsDialog is None:  # if it wasnt created yet, then create it but only create it once.
@@ -924,18 +962,39 @@ class Window(QMainWindow, Ui_MainWindow):
 
         self.saveDataWorker = SaveDataWorker(
             self.mouseNumberLineEdit.text(), self.rigLetterLineEdit.text(), self.protocolFileName, self.olfaConfigFileName, self.shuffleMultiplierSpinBox.value(), self.itiMinSpinBox.value(), self.itiMaxSpinBox.value(),
-            self.leftWaterValveDurationSpinBox.value(), self.rightWaterValveDurationSpinBox.value(), settingsDict, self.adc, self.bpod
+            self.leftWaterValveDurationSpinBox.value(), self.rightWaterValveDurationSpinBox.value(), settingsDict, self.adc, self.bpod, self.acquisitionWorker.buffer,
+            self.dataStorageSettings
         )
         self.saveDataWorker.moveToThread(self.saveDataThread)
         self.saveDataThread.started.connect(self.saveDataWorker.run)
         self.saveDataWorker.finished.connect(self.saveDataThread.quit)
         self.saveDataWorker.finished.connect(self.saveDataWorker.deleteLater)
         self.saveDataThread.finished.connect(self.saveDataThread.deleteLater)
-        self.saveDataWorker.analogDataSignal.connect(self.streaming.getData)
+        self.streaming.setDataBuffer(self.saveDataWorker.plotBuffer)  # The plot reads the new samples from it on each frame, instead of receiving a signal for every block.
+        self.updateStreamingChannels(self.saveDataWorker.plotChannelNames)
         self.stopRunningSignal.connect(lambda: self.saveDataWorker.stopRunning())  # Need to use lambda, to explicitly make function call (from the main thread). Because the saveDataWorker thread will never call it since its in a infinite loop.
         self.saveDataThread.start()
         logging.info(f"saveDataThread running? {self.saveDataThread.isRunning()}")
 
+    def updateStreamingChannels(self, channelNames):
+        # Gives the streaming plot the names of the channels that the SaveDataWorker sends, and makes a check box to show or hide each one.
+        # Channels keep being shown or hidden as they were in the previous session.
+        wasChecked = {checkBox.text(): checkBox.isChecked() for checkBox in self.channelCheckBoxes}
+        for checkBox in self.channelCheckBoxes:
+            self.channelCheckBoxesLayout.removeWidget(checkBox)
+            checkBox.deleteLater()
+        self.channelCheckBoxes = []
+        self.streaming.setChannelNames(channelNames)
+        for i in range(len(channelNames)):
+            checkBox = QCheckBox(channelNames[i])
+            checkBox.setChecked(wasChecked.get(channelNames[i], True))
+            checkBox.toggled.connect(lambda checked, channel=i: self.streaming.setChannelVisible(channel, checked))
+            self.streaming.setChannelVisible(i, checkBox.isChecked())
+            if i < len(self.streamingChannelRanges):
+                self.streaming.setChannelYRange(i, self.streamingChannelRanges[i])
+            self.channelCheckBoxesLayout.addWidget(checkBox)
+            self.channelCheckBoxes.append(checkBox)
+
     def runProtocolThread(self):
         logging.info(f"from _runProtocolThread, thread is {QThread.currentThread()} and ID is {int(QThread.currentThreadId())}")
         self.protocolThread = QThread(parent=self)
@@ -0,0 +1,85 @@
+'''
+Measures the acquisition path (BpodAnalogIn.getSamplesFromUSB() -> AcquisitionWorker -> AnalogRingBuffer) against the analog input module
+emulator for every combination of sampling rate and number of streaming channels. For each configuration it reports how many frames the
+emulator sent, how many arrived in the ring buffer, how many the USB stream parser counted as lost, and the CPU time used by this process.
+Requires Linux because the emulator runs on a pseudo-terminal.
+
+Run from the repository's root folder with:
+    python benchmarks/benchmarkAcquisitionThroughput.py [secondsPerConfiguration] [dropRate]
+'''
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from analogInputModuleEmulator import AnalogInputModuleEmulator
+from BpodAnalogInputModule import BpodAnalogIn
+from acquisitionWorker import AcquisitionWorker
+
+
+samplingRates = [1000, 5000, 10000]
+channelCounts = [1, 4, 8]
+
+
+def runConfiguration(samplingRate, nChannels, duration, dropRate):
+    emulator = AnalogInputModuleEmulator(waveform='noise', syncInterval=1.0, dropRate=dropRate, seed=0).start()
+    adc = BpodAnalogIn(emulator.getPortName())
+    adc.applySettings({
+        'nActiveChannels': nChannels,
+        'samplingRate': samplingRate,
+        'inputRanges': ['-10V:10V'] * 8,
+        'enableUSBStreaming': ([1] * nChannels) + ([0] * (8 - nChannels)),
+        'enableSMEventReporting': [0] * 8,
+        'thresholdVoltages': [10] * 8,
+        'resetVoltages': [-10] * 8
+    })
+
+    worker = AcquisitionWorker(analogInModule=adc)
+    readerId = worker.buffer.addReader()
+    nReceived = 0
+    thread = threading.Thread(target=worker.run)  # The worker's loop does not need a Qt event loop, so a plain thread is enough here.
+
+    adc.startUSBStream()
+    thread.start()
+    cpuStart = time.process_time()
+    endTime = time.perf_counter() + duration
+    while time.perf_counter() < endTime:
+        time.sleep(0.01)  # Drain the ring buffer at about the rate that SaveDataWorker does.
+        nReceived += len(worker.buffer.read(readerId)[1])
+    adc.stopUSBStream()
+    cpuTime = time.process_time() - cpuStart
+    time.sleep(0.1)  # Let the last frames arrive before stopping the worker.
+    worker.stopRunning()
+    thread.join()
+    nReceived += len(worker.buffer.read(readerId)[1])
+
+    emulatorStats = emulator.getStats()
+    parserStats = adc.getUSBStreamStats()
+    adc.close()
+    emulator.stop()
+    return {
+        'sent': emulatorStats['nFramesSent'],
+        'received': nReceived,
+        'lost': parserStats['nFramesLost'],
+        'corrupted': emulatorStats['nFramesCorrupted'],
+        'overflowed': emulatorStats['nBytesOverflowed'],
+        'overruns': worker.buffer.getOverrunCount(readerId),
+        'cpu': cpuTime / duration
+    }
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    dropRate = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    print(f"{duration} s per configuration, drop rate {dropRate}")
+    print(f"{'rate (Hz)':>9} {'channels':>8} {'sent':>8} {'received':>8} {'lost':>6} {'corrupted':>9} {'overflowed (B)':>14} {'overruns':>8} {'CPU':>6}")
+    for samplingRate in samplingRates:
+        for nChannels in channelCounts:
+            result = runConfiguration(samplingRate, nChannels, duration, dropRate)
+            print(f"{samplingRate:>9} {nChannels:>8} {result['sent']:>8} {result['received']:>8} {result['lost']:>6} {result['corrupted']:>9} "
+                  f"{result['overflowed']:>14} {result['overruns']:>8} {result['cpu']:>6.1%}")
+
+
+if __name__ == '__main__':
+    main()
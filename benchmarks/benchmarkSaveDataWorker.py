@@ -0,0 +1,259 @@
+'''
+Measures the whole save path of a session without any hardware: synthetic analog input module frames are written into an AnalogRingBuffer the
+way the AcquisitionWorker does, and synthetic end of trial infoDicts (shaped like the example at the top of saveDataWorker.py) are given to
+receiveInfoDict() the way the ProtocolWorker does, while the SaveDataWorker saves them in its own thread. The frames are written as fast as the
+SaveDataWorker keeps up, so samples/s is the most it can sustain (divide by the sampling rate to get how many times faster than real time that is).
+For every combination of sampling rate, number of channels and storage option it reports:
+    samples/s: frames saved per second of wall time.
+    trial p50/p95/max: milliseconds from receiveInfoDict() until the trial's data was saved (the SaveDataWorker's trialSaveLatency).
+    size: megabytes of files saved in the results folder.
+    peak RSS: the most memory used by the process running the configuration (not available on Windows).
+    check: whether the saved file is read back by SessionReader with one range of samples and a valid anchor for every trial, and every event.
+Each configuration runs in its own process, in a temporary folder, so that the peak RSS of one does not hide the next. The benchmark exits with
+an error if the check of any configuration failed, after printing what was wrong.
+
+Run from the repository's root folder with:
+    python benchmarks/benchmarkSaveDataWorker.py [secondsOfDataPerConfiguration]
+'''
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from analogRingBuffer import AnalogRingBuffer
+from BpodAnalogInputModule import AnalogUSBStreamParser
+from saveDataWorker import SaveDataWorker
+from sessionReader import SessionReader
+from voltsConverter import makeLookupTable
+import sessionWriters
+import tables
+
+
+samplingRates = [1000, 10000]
+channelCounts = [1, 8]
+storageOptions = [
+    ('hdf5', {}),
+    ('hdf5 counts lz4', {'voltsFormat': 'counts', 'compressionLibrary': 'blosc:lz4', 'compressionLevel': 5}),
+    ('binary', {'writer': 'binary'}),
+    ('swmr', {'writer': 'swmr'}),
+    ('hdf5 process', {'writerProcess': True})
+]
+blockDuration = 0.01  # seconds of samples per block, like the AcquisitionWorker's reads from the USB stream.
+trialDuration = 2  # seconds of samples per trial.
+
+
+class SyntheticAnalogInModule(object):
+    # Has the methods of BpodAnalogIn that the SaveDataWorker calls, for the -10V:10V range.
+
+    def __init__(self, nChannels):
+        self.frameDtype = AnalogUSBStreamParser(nChannels).frameDtype
+
+    def getUSBFrameDtype(self):
+        return self.frameDtype
+
+    def getVoltsLookupTables(self, inputRanges):
+        return np.array([makeLookupTable(8192, 8192, 20, 10) for inputRange in inputRanges])
+
+    def getVoltsScales(self, inputRanges):
+        return ([20 / 8192] * len(inputRanges), [-10] * len(inputRanges))
+
+    def getUSBStreamStats(self):
+        return {'nBytesSkipped': 0, 'nFramesLost': 0, 'nResyncs': 0}
+
+
+class SyntheticBpod(object):
+    # Has the attributes of the bpod that the SaveDataWorker reads when the analog input module is given too, which are only the event names.
+
+    class hardware:
+        class channels:
+            event_names = ['Port1In', 'Port1Out', 'Port2In', 'Port2Out', 'Port3In', 'Port3Out', 'Tup', 'GlobalTimer1_End']
+
+
+def makeProtocolFile(fileName):
+    # The state names of the example infoDict. WaitForOdor sends ADC_start and ITIdelay sends ADC_stop, like the example protocols.
+    stateNames = ['WaitForOdor', 'WaitForSniff', 'WaitForResponse', 'Punish', 'ITIdelay', 'Reward', 'NoLick']
+    outputActions = {'WaitForOdor': {'Serial1': 'ADC_start'}, 'ITIdelay': {'Serial1': 'ADC_stop'}}
+    with open(fileName, 'w') as f:
+        json.dump({'states': [{'stateName': name, 'outputActions': outputActions.get(name, {})} for name in stateNames]}, f)
+
+
+def makeInfoDict(trialNum, rng):
+    trialStart = 4.344831 + ((trialNum - 1) * trialDuration)
+    response = trialDuration * 0.4
+    licks = np.sort(rng.uniform(response, trialDuration * 0.6, size=10))
+    return {
+        'Bpod start timestamp': 4.344831,
+        'Trial start timestamp': trialStart,
+        'Trial end timestamp': trialStart + trialDuration,
+        'States timestamps': {
+            'WaitForOdor': [(0, trialDuration * 0.2)],
+            'WaitForSniff': [(trialDuration * 0.2, trialDuration * 0.25)],
+            'WaitForResponse': [(trialDuration * 0.25, response)],
+            'Punish': [(response, response + 0.001)],
+            'ITIdelay': [(response + 0.001, trialDuration)],
+            'Reward': [(np.nan, np.nan)],
+            'NoLick': [(np.nan, np.nan)]
+        },
+        'Events timestamps': {
+            'Tup': [trialDuration * 0.2, trialDuration * 0.25, response + 0.001, trialDuration],
+            'Port1In': list(licks[::2]),
+            'Port1Out': list(licks[1::2])
+        },
+        'responseResult': ['Correct', 'Wrong', 'None'][trialNum % 3],
+        'stimList': [{'olfas': {'olfa_0': {'vialNum': str(5 + (trialNum % 2)), 'mfc_1_flow': 100}}}]
+    }
+
+
+def runConfiguration(samplingRate, nChannels, storageSettings, duration, resultQueue):
+    os.chdir(tempfile.mkdtemp())  # The SaveDataWorker saves in the results folder of the current folder.
+    logging.getLogger().setLevel(logging.ERROR)  # Keep the SaveDataWorker's messages out of the table. Overruns are in the table instead.
+    makeProtocolFile('protocol.json')
+    adc = SyntheticAnalogInModule(nChannels)
+    analogSettings = {
+        'nActiveChannels': nChannels,
+        'samplingRate': samplingRate,
+        'inputRanges': ['-10V:10V'] * 8,
+        'thresholdVoltages': [10] * 8,
+        'resetVoltages': [-10] * 8,
+        'enableUSBStreaming': ([1] * nChannels) + ([0] * (8 - nChannels))
+    }
+    buffer = AnalogRingBuffer(capacity=(10 * samplingRate), dtype=adc.getUSBFrameDtype())
+    worker = SaveDataWorker(1234, 'bench', 'protocol.json', '', 0, 6, 10, 25, 25, analogSettings, adc, SyntheticBpod(), buffer, storageSettings)
+    thread = threading.Thread(target=worker.run)  # The worker's loop does not need a Qt event loop, so a plain thread is enough here.
+
+    # One second of sniff-like counts that every block is cut from.
+    rng = np.random.default_rng(0)
+    t = np.arange(samplingRate) / samplingRate
+    counts = np.clip(np.round(4096 + (1500 * np.sin(2 * np.pi * 5 * t))[:, np.newaxis] + rng.normal(0, 3, size=(samplingRate, nChannels))), 0, 8191).astype('uint16')
+    blockSize = int(blockDuration * samplingRate)
+    samplesPerTrial = trialDuration * samplingRate
+    nSamples = int(duration * samplingRate)
+    nEvents = 0  # Events of every infoDict given to the worker, which the events table must have.
+
+    thread.start()
+    t0 = time.perf_counter()
+    for start in range(0, nSamples, blockSize):
+        # Keep a few blocks waiting at most, so the frames are written as fast as the SaveDataWorker reads them and never overwritten.
+        while buffer.getNumAvailable(worker.analogBufferReader) > (4 * blockSize):
+            time.sleep(0.0005)
+        frames = np.zeros(shape=blockSize, dtype=adc.getUSBFrameDtype())
+        frames['prefix'] = 82
+        offset = start % samplingRate
+        for i in range(nChannels):
+            frames[f'ch{i}'] = np.take(counts[:, i], range(offset, offset + blockSize), mode='wrap')
+        trialPosition = start % samplesPerTrial
+        if trialPosition == 0:
+            frames['prefix'][0] = 35  # ADC_start at the start of the trial.
+            frames['syncByte'][0] = 1
+        elif trialPosition == (samplesPerTrial - blockSize):
+            frames['prefix'][-1] = 35  # ADC_stop at the end of the trial.
+            frames['syncByte'][-1] = 2
+        buffer.write(frames)
+        if (trialPosition + blockSize) >= samplesPerTrial:
+            infoDict = makeInfoDict(((start // samplesPerTrial) + 1), rng)
+            nEvents += sum(len(timestamps) for timestamps in infoDict['Events timestamps'].values())
+            worker.receiveInfoDict(infoDict)
+    while buffer.getNumAvailable(worker.analogBufferReader) > 0:
+        time.sleep(0.0005)
+    elapsed = time.perf_counter() - t0
+    worker.stopRunning()
+    thread.join()
+
+    latencies = np.array(worker.saveLatencies) * 1000 if (len(worker.saveLatencies) > 0) else np.zeros(1)
+    peakRss = None
+    if resource is not None:
+        peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if (sys.platform == 'darwin') else 1024)  # Bytes on macOS and kilobytes on Linux.
+    size = sum(os.path.getsize(f) for f in glob.glob('results/*'))  # Before verifySession() converts a binary session to HDF5.
+    resultQueue.put({
+        'samplesPerSecond': nSamples / elapsed,
+        'p50': np.percentile(latencies, 50),
+        'p95': np.percentile(latencies, 95),
+        'max': latencies.max(),
+        'size': size,
+        'peakRss': peakRss,
+        'overruns': buffer.getOverrunCount(worker.analogBufferReader),
+        'errors': verifySession((nSamples // samplesPerTrial), samplesPerTrial, nEvents)
+    })
+
+
+def verifySession(nTrials, samplesPerTrial, nEvents):
+    '''
+    Reads the session saved in the results folder back with SessionReader and returns a list of what is wrong with it, which is empty if it has:
+        one range of samples per trial in /voltages/trial_index, with every frame from the trial's ADC_start frame up to its ADC_stop frame (which
+            is not saved), so that no samples were saved with the wrong trial.
+        a valid anchor for every trial, at its ADC_start frame and with a time on the bpod's clock.
+        a row in the events table for every event of the infoDicts.
+    '''
+    errors = []
+    hdf5Files = glob.glob('results/*.h5')
+    if len(hdf5Files) == 0:
+        hdf5Files = [sessionWriters.convertToHDF5(f) for f in glob.glob('results/*.json')]  # The 'binary' writer's sidecar file.
+    with SessionReader(hdf5Files[0]) as session:
+        trialNums = session.getTrialNums()
+        if trialNums[:nTrials] != list(range(1, nTrials + 1)):
+            errors.append(f"expected trials 1 to {nTrials} but the file has {trialNums}")
+        for trialNum in range(1, nTrials + 1):
+            if trialNum not in session.trialRanges:
+                continue
+            start, stop = session.trialRanges[trialNum]
+            firstSampleIndex = (trialNum - 1) * samplesPerTrial  # The trial's ADC_start frame.
+            if (stop - start) != (samplesPerTrial - 1):
+                errors.append(f"trial {trialNum} has {stop - start} samples instead of {samplesPerTrial - 1}")
+            elif (session.readTrialColumn(trialNum, 'sampleIndex')[0] != firstSampleIndex):
+                errors.append(f"trial {trialNum}'s samples do not start at its ADC_start frame")
+            anchorSampleIndex, anchorTime = session.trialAnchors.get(trialNum, (-1, np.nan))
+            if (anchorSampleIndex != firstSampleIndex) or not np.isfinite(anchorTime):
+                errors.append(f"trial {trialNum} has the anchor ({anchorSampleIndex}, {anchorTime}) instead of one at sampleIndex {firstSampleIndex}")
+        nEventRows = len(session.readEvents()) if ('/events' in session.h5file) else 0
+        if nEventRows != nEvents:
+            errors.append(f"the events table has {nEventRows} rows instead of {nEvents}")
+    return errors
+
+
+def isAvailable(storageSettings):
+    if (storageSettings.get('writer') == 'swmr') and (sessionWriters.h5py is None):
+        return False
+    if storageSettings.get('compressionLibrary', 'zlib').startswith('blosc') and not tables.which_lib_version('blosc'):
+        return False
+    return True
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    context = multiprocessing.get_context('spawn')
+    print(f"{duration} s of data per configuration, a trial every {trialDuration} s")
+    print(f"{'rate (Hz)':>9} {'channels':>8} {'storage':>16} {'samples/s':>10} {'x real time':>11} {'trial p50 (ms)':>14} {'p95 (ms)':>9} {'max (ms)':>9} {'size (MB)':>9} {'peak RSS (MB)':>13} {'overruns':>8} {'check':>6}")
+    nFailed = 0
+    for samplingRate in samplingRates:
+        for nChannels in channelCounts:
+            for storageName, storageSettings in storageOptions:
+                if not isAvailable(storageSettings):
+                    continue
+                resultQueue = context.Queue()
+                process = context.Process(target=runConfiguration, args=(samplingRate, nChannels, storageSettings, duration, resultQueue))
+                process.start()
+                result = resultQueue.get()
+                process.join()
+                peakRss = f"{result['peakRss'] / 1e6:.0f}" if (result['peakRss'] is not None) else 'n/a'
+                print(f"{samplingRate:>9} {nChannels:>8} {storageName:>16} {result['samplesPerSecond']:>10.0f} {result['samplesPerSecond'] / samplingRate:>11.1f} "
+                      f"{result['p50']:>14.1f} {result['p95']:>9.1f} {result['max']:>9.1f} {result['size'] / 1e6:>9.1f} {peakRss:>13} {result['overruns']:>8} {'failed' if result['errors'] else 'ok':>6}")
+                for error in result['errors']:
+                    print(f"    {error}")
+                nFailed += (len(result['errors']) > 0)
+    if nFailed > 0:
+        sys.exit(f"The saved session of {nFailed} configurations did not read back as expected.")
+
+
+if __name__ == '__main__':
+    main()
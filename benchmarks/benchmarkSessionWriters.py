@@ -0,0 +1,103 @@
+'''
+Compares the session writers (the dataStorage setting "writer") by saving the same session through the SessionWriter interface the way
+SaveDataWorker does: blocks of samples, and every few seconds the end of a trial. For each writer it reports the time spent appending samples,
+the slowest end of trial save, and the size of the files. For the 'binary' writer it also reports the time to convert the session to HDF5.
+
+Run from the repository's root folder with:
+    python benchmarks/benchmarkSessionWriters.py [secondsOfData] [nChannels] [samplingRate]
+'''
+import glob
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sessionWriters import makeSessionWriter, convertToHDF5
+
+
+blockDuration = 0.01  # seconds of samples per block, like the SaveDataWorker's reads from the acquisition ring buffer.
+trialDuration = 5  # seconds
+
+
+def makeInfoDict(trialNum):
+    trialStart = trialNum * trialDuration
+    return {
+        'Bpod start timestamp': 0.0,
+        'Trial start timestamp': float(trialStart),
+        'Trial end timestamp': float(trialStart + trialDuration),
+        'States timestamps': {'WaitForOdor': [(0.0, 1.0)], 'WaitForResponse': [(1.0, 4.0)], 'Reward': [(4.0, 4.1)], 'Punish': [(np.nan, np.nan)]},
+        'Events timestamps': {'Port1In': list(np.linspace(1.0, 3.9, 20)), 'Tup': [1.0, 4.0, 4.1]},
+        'responseResult': 'Correct',
+        'stimList': [{'olfas': {'olfa_0': {'vialNum': '5', 'mfc_1_flow': 50}}}]
+    }
+
+
+def writeSession(writerName, directory, duration, nChannels, samplingRate):
+    writer = makeSessionWriter({'writer': writerName})
+    fileName = os.path.join(directory, f"session{writer.fileExtension}")
+    writer.open(fileName, {'mouseNum': 1, 'rig': 'bench'}, ['Port1In', 'Port1Out', 'Tup'])
+    dtype = np.dtype([('sampleIndex', 'int64')] + [(f'voltageCh{i}', 'float32') for i in range(nChannels)])
+    settings = np.zeros(shape=nChannels, dtype=[('samplingRate', 'uint16'), ('gain', 'float64'), ('offset', 'float64')])
+    writer.createVolts(dtype, settings, {
+        'samplingRate': samplingRate,
+        'voltsFormat': 'volts',
+        'columnNames': [f'voltageCh{i}' for i in range(nChannels)],
+        'columnGains': [1.0] * nChannels,
+        'columnOffsets': [0.0] * nChannels
+    }, expectedRows=(samplingRate * 3600))
+
+    rng = np.random.default_rng(0)
+    blockSize = int(blockDuration * samplingRate)
+    samplesPerTrial = trialDuration * samplingRate
+    appendTime = 0
+    trialSaveTimes = []
+    trialNum = 1
+    trialStartIndex = 0
+    for start in range(0, int(duration * samplingRate), blockSize):
+        records = np.zeros(shape=blockSize, dtype=dtype)
+        records['sampleIndex'] = start + np.arange(blockSize)
+        for i in range(nChannels):
+            records[f'voltageCh{i}'] = rng.normal(0, 1, size=blockSize)
+        t0 = time.perf_counter()
+        writer.appendSamples(trialNum, records)
+        writer.flushIfDue()
+        appendTime += time.perf_counter() - t0
+
+        if (start + blockSize - trialStartIndex) >= samplesPerTrial:
+            infoDict = makeInfoDict(trialNum)
+            t0 = time.perf_counter()
+            writer.appendTrial(trialNum, infoDict)
+            writer.appendEvents(trialNum, infoDict['Events timestamps'])
+            writer.endTrialSamples(trialNum, trialStartIndex, infoDict['Trial start timestamp'])
+            trialSaveTimes.append(time.perf_counter() - t0)
+            trialNum += 1
+            trialStartIndex = start + blockSize
+
+    t0 = time.perf_counter()
+    writer.close()
+    closeTime = time.perf_counter() - t0
+    size = sum(os.path.getsize(f) for f in glob.glob(os.path.join(directory, 'session*')))
+    return fileName, appendTime, max(trialSaveTimes, default=0), closeTime, size
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+    nChannels = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    samplingRate = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+    print(f"{duration} s of data, {nChannels} channels at {samplingRate} Hz, a trial every {trialDuration} s")
+    print(f"{'writer':>7} {'append (s)':>11} {'max trial (ms)':>15} {'close (s)':>10} {'size (MB)':>10} {'convert (s)':>12}")
+    for writerName in ['hdf5', 'binary']:
+        with tempfile.TemporaryDirectory() as directory:
+            fileName, appendTime, maxTrialTime, closeTime, size = writeSession(writerName, directory, duration, nChannels, samplingRate)
+            convertTime = ''
+            if writerName == 'binary':
+                t0 = time.perf_counter()
+                convertToHDF5(fileName)
+                convertTime = f"{time.perf_counter() - t0:.2f}"
+            print(f"{writerName:>7} {appendTime:>11.2f} {maxTrialTime * 1000:>15.1f} {closeTime:>10.2f} {size / 1e6:>10.1f} {convertTime:>12}")
+
+
+if __name__ == '__main__':
+    main()
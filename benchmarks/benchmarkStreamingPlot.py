@@ -0,0 +1,112 @@
+'''
+Compares the frame rates of the streaming plot backends (the "backend" setting of the streamingPlot section of defaults.json). Each backend
+plots a synthetic sniff signal, written in blocks every few milliseconds into a plot buffer the way the SaveDataWorker writes its plotBuffer, with
+the input ports toggling like licks, for each sampling rate (the plot's dt is 1 / samplingRate, so a 10 s window holds maxt * samplingRate points)
+and number of channels.
+It reports:
+    updates/s: how many times per second the backend's update() ran, which is the "Mean Frame Rate" shown on the plot.
+    paints/s: how many times per second the plot widget was actually repainted.
+    update (ms): the mean time spent in update().
+    plotted: the percentage of the samples written to the plot buffer that were plotted. Below 100 the plot fell behind and skipped samples.
+The widgets are rendered offscreen when no display is available.
+
+Run from the repository's root folder with:
+    python benchmarks/benchmarkStreamingPlot.py [secondsPerBackend] [plotInterval]
+'''
+import os
+import sys
+import time
+import numpy as np
+
+if ('DISPLAY' not in os.environ) and (sys.platform.startswith('linux')):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PyQt5.QtCore import QEvent, QObject, QTimer
+from PyQt5.QtWidgets import QApplication
+from analogRingBuffer import AnalogRingBuffer
+from streamingWorker import makeStreamingWorker
+
+
+backends = ['matplotlib', 'pyqtgraph']
+samplingRates = [1000, 10000]
+channelCounts = [1, 8]
+maxt = 10  # seconds in the plot's window, like defaults.json.
+emitInterval = 5  # milliseconds between blocks written to the plot buffer.
+
+
+class PaintCounter(QObject):
+    def __init__(self):
+        super(PaintCounter, self).__init__()
+        self.nPaints = 0
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Paint:
+            self.nPaints += 1
+        return False
+
+
+def runBackend(app, backend, samplingRate, nChannels, duration, plotInterval):
+    streaming = makeStreamingWorker(backend, maxt, 1 / samplingRate, 0.0, 5.0, plotInterval)
+    widget = streaming.getFigure()
+    widget.resize(1000, 300)
+    widget.show()
+    paintCounter = PaintCounter()
+    paintTarget = widget.viewport() if hasattr(widget, 'viewport') else widget  # pyqtgraph's PlotWidget is a QGraphicsView, which paints its viewport.
+    paintTarget.installEventFilter(paintCounter)
+
+    updateTimes = []
+    update = streaming.update
+
+    def timedUpdate(y):
+        t0 = time.perf_counter()
+        result = update(y)
+        updateTimes.append(time.perf_counter() - t0)
+        return result
+    streaming.update = timedUpdate  # Replaced before startAnimation() so that the animation calls the timed version.
+
+    blockSize = max(int(samplingRate * emitInterval / 1000), 1)
+    t = np.arange(samplingRate) / samplingRate
+    sniff = (2.5 + (2 * np.sin(2 * np.pi * 5 * t[np.newaxis, :] + np.arange(nChannels)[:, np.newaxis]))).astype('float32')  # One second of a 5 Hz sniff-like signal per channel, cut into blocks.
+    state = {'position': 0, 'nBlocks': 0}
+    plotBuffer = AnalogRingBuffer(capacity=(2 * samplingRate), dtype='float32', itemShape=(nChannels,))  # Like the SaveDataWorker's plotBuffer.
+    streaming.setDataBuffer(plotBuffer)
+
+    def emitBlock():
+        start = state['position']
+        plotBuffer.write(np.take(sniff, range(start, start + blockSize), axis=1, mode='wrap').T)  # Shape (blockSize, nChannels) like the SaveDataWorker's blocks.
+        state['position'] = (start + blockSize) % samplingRate
+        state['nBlocks'] += 1
+        if (state['nBlocks'] % 50) == 0:
+            streaming.setInputEvent([(state['nBlocks'] // 50) % 2 == 1, False, (state['nBlocks'] // 50) % 2 == 0, False])  # Toggle ports like licks.
+
+    emitTimer = QTimer()
+    emitTimer.timeout.connect(emitBlock)
+    emitTimer.start(emitInterval)
+    streaming.startAnimation()
+    t0 = time.perf_counter()
+    QTimer.singleShot(int(duration * 1000), app.quit)
+    app.exec_()
+    elapsed = time.perf_counter() - t0
+    emitTimer.stop()
+    streaming.pauseAnimation()
+    widget.close()
+    plotted = (100 * streaming.nDataPointsPlotted / (state['nBlocks'] * blockSize)) if state['nBlocks'] else 0
+    return len(updateTimes) / elapsed, paintCounter.nPaints / elapsed, np.mean(updateTimes) * 1000 if updateTimes else 0, plotted
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    plotInterval = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    app = QApplication(sys.argv[:1])
+    print(f"{duration} s per backend, plotInterval {plotInterval} ms, {maxt} s window, a block every {emitInterval} ms")
+    print(f"{'backend':>10} {'rate (Hz)':>9} {'channels':>8} {'updates/s':>10} {'paints/s':>9} {'update (ms)':>12} {'plotted (%)':>11}")
+    for samplingRate in samplingRates:
+        for nChannels in channelCounts:
+            for backend in backends:
+                updatesPerSecond, paintsPerSecond, updateTime, plotted = runBackend(app, backend, samplingRate, nChannels, duration, plotInterval)
+                print(f"{backend:>10} {samplingRate:>9} {nChannels:>8} {updatesPerSecond:>10.1f} {paintsPerSecond:>9.1f} {updateTime:>12.2f} {plotted:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
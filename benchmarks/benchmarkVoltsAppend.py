@@ -0,0 +1,97 @@
+'''
+Compares writing analog samples to the h5 file one row at a time with Row.append() (how SaveDataWorker used to save every sample) with
+collecting them in record arrays and writing them with Table.append() in chunks of appendChunkRows rows (how it saves them now). Both write
+the same volts table layout (bpodTime and one voltageCh column per channel) for several channel counts and sampling rates, and the blocks of
+samples arrive at the same size that SaveDataWorker reads from the acquisition ring buffer (about 10 ms worth at a time).
+
+Run from the repository's root folder with:
+    python benchmarks/benchmarkVoltsAppend.py [secondsOfData] [appendChunkRows]
+'''
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import tables
+
+
+channelCounts = [1, 4, 8]
+samplingRates = [1000, 10000]
+blockDuration = 0.01  # seconds of samples per block, like the SaveDataWorker's reads from the ring buffer.
+
+
+def makeVoltsTable(h5file, nChannels):
+    descDict = {'bpodTime': tables.Float32Col(pos=0)}
+    for i in range(nChannels):
+        descDict[f'voltageCh{i}'] = tables.Float32Col(pos=(i + 1))
+    return h5file.create_table(where='/', name='samples', description=descDict, expectedrows=1000000)
+
+
+def writePerRow(table, blocks, samplingPeriod):
+    # The SaveDataWorker's old loop: one dictionary-style assignment per channel and one Row.append() per sample.
+    row = table.row
+    bpodTime = 0
+    for block in blocks:
+        for voltages in block.tolist():
+            row['bpodTime'] = bpodTime
+            bpodTime += samplingPeriod
+            for i in range(len(voltages)):
+                row[f'voltageCh{i}'] = voltages[i]
+            row.append()
+    table.flush()
+
+
+def writeBlocks(table, blocks, samplingPeriod, appendChunkRows):
+    # The SaveDataWorker's new path: one record array per block, appended to the table once appendChunkRows rows are waiting.
+    pending = []
+    nPending = 0
+    bpodTime = 0
+    for block in blocks:
+        records = np.zeros(shape=len(block), dtype=table.dtype)
+        records['bpodTime'] = bpodTime + (np.arange(len(block)) * samplingPeriod)
+        bpodTime += len(block) * samplingPeriod
+        for i in range(block.shape[1]):
+            records[f'voltageCh{i}'] = block[:, i]
+        pending.append(records)
+        nPending += len(records)
+        if nPending >= appendChunkRows:
+            table.append(np.concatenate(pending))
+            pending = []
+            nPending = 0
+    if nPending > 0:
+        table.append(np.concatenate(pending))
+    table.flush()
+
+
+def timeWriter(writer, nChannels, *args):
+    fd, fileName = tempfile.mkstemp(suffix='.h5')
+    os.close(fd)
+    try:
+        with tables.open_file(fileName, mode='w') as h5file:
+            table = makeVoltsTable(h5file, nChannels)
+            t0 = time.perf_counter()
+            writer(table, *args)
+            return time.perf_counter() - t0
+    finally:
+        os.remove(fileName)
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    appendChunkRows = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    rng = np.random.default_rng(0)
+    print(f"{duration} s of data per configuration, appendChunkRows = {appendChunkRows}")
+    print(f"{'channels':>8} {'rate (Hz)':>9} {'Row.append (rows/s)':>20} {'block append (rows/s)':>22} {'speedup':>8}")
+    for nChannels in channelCounts:
+        for samplingRate in samplingRates:
+            nSamples = int(duration * samplingRate)
+            blockSize = max(1, int(blockDuration * samplingRate))
+            voltages = rng.uniform(-10, 10, size=(nSamples, nChannels)).astype('float32')
+            blocks = [voltages[i:(i + blockSize)] for i in range(0, nSamples, blockSize)]
+            perRowTime = timeWriter(writePerRow, nChannels, blocks, 1 / samplingRate)
+            blockTime = timeWriter(writeBlocks, nChannels, blocks, 1 / samplingRate, appendChunkRows)
+            print(f"{nChannels:>8} {samplingRate:>9} {nSamples / perRowTime:>20,.0f} {nSamples / blockTime:>22,.0f} {perRowTime / blockTime:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
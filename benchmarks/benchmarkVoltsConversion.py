@@ -0,0 +1,72 @@
+'''
+Compares the per-sample if/elif conversion from ADC counts to volts that SaveDataWorker used to do with the lookup table conversion of
+VoltsConverter, for 8 channels sampled at 10 kHz. It also checks that both give the same voltages (after the float32 cast that happens when
+the voltages are written to the h5 file).
+
+Run from the repository's root folder with:
+    python benchmarks/benchmarkVoltsConversion.py
+'''
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from voltsConverter import VoltsConverter, makeLookupTable
+
+
+nChannels = 8
+samplingRate = 10000
+duration = 10  # seconds of data to convert.
+inputRanges = ['-10V:10V', '-5V:5V', '-2.5V:2.5V', '0V:10V', '-10V:10V', '-5V:5V', '-2.5V:2.5V', '0V:10V']
+
+# Same constants as BpodAnalogIn's __RangeMultipliers and __RangeOffsets, and SaveDataWorker's old rangeLimits.
+rangeMultipliers = {'-10V:10V': 20, '-5V:5V': 10, '-2.5V:2.5V': 5, '0V:10V': 10}
+rangeOffsets = {'-10V:10V': 10, '-5V:5V': 5, '-2.5V:2.5V': 2.5, '0V:10V': 0}
+rangeLimits = {'-10V:10V': [-10.0, 10.0], '-5V:5V': [-5.0, 5.0], '-2.5V:2.5V': [-2.5, 2.5], '0V:10V': [0.0, 10.0]}
+
+
+def convertPerSample(countsList, maxVoltages, minVoltages):
+    # This is the conversion that SaveDataWorker.saveAnalogDataFromModule() used to do for every sample.
+    allVoltages = []
+    for samples in countsList:
+        voltages = [0] * len(samples)
+        for i in range(len(samples)):
+            if (minVoltages[i] == 0):
+                voltages[i] = ((samples[i] * maxVoltages[i]) / 8192)
+            else:
+                if samples[i] >= 4096:
+                    samples[i] -= 4096
+                    voltages[i] = (samples[i] * maxVoltages[i]) / 4096
+                elif samples[i] < 4096:
+                    voltages[i] = ((samples[i] * maxVoltages[i]) / 4096) - maxVoltages[i]
+        allVoltages.append(voltages)
+    return allVoltages
+
+
+def main():
+    nSamples = samplingRate * duration
+    counts = np.random.default_rng(0).integers(0, 8192, size=(nSamples, nChannels), dtype='uint16')
+    maxVoltages = [rangeLimits[x][1] for x in inputRanges]
+    minVoltages = [rangeLimits[x][0] for x in inputRanges]
+    converter = VoltsConverter([makeLookupTable(8192, 8192, rangeMultipliers[x], rangeOffsets[x]) for x in inputRanges])
+
+    countsList = counts.tolist()  # Not timed because the old code got the samples from the serial port as python lists.
+    t0 = time.perf_counter()
+    perSampleVolts = convertPerSample(countsList, maxVoltages, minVoltages)
+    perSampleTime = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    lookupVolts = converter.convert(counts)
+    lookupTime = time.perf_counter() - t0
+
+    identical = np.array_equal(np.array(perSampleVolts, dtype='float32'), lookupVolts)
+    print(f"{nChannels} channels x {samplingRate} Hz x {duration} s = {nSamples} samples per channel")
+    print(f"per-sample if/elif:  {perSampleTime:.4f} s  ({nSamples / perSampleTime:,.0f} samples/s)")
+    print(f"lookup table:        {lookupTime:.4f} s  ({nSamples / lookupTime:,.0f} samples/s)")
+    print(f"speedup:             {perSampleTime / lookupTime:.1f}x")
+    print(f"identical voltages:  {identical}")
+
+
+if __name__ == '__main__':
+    main()
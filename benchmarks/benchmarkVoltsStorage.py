@@ -0,0 +1,92 @@
+'''
+Compares the file size and write time of the volts table for each combination of the dataStorage settings voltsFormat ('volts' saves float32
+voltages, 'counts' saves the ADC's uint16 counts) and compression (compressionLibrary and compressionLevel). The signal is a sniff-like sine
+wave plus a few counts of noise on every channel, written in blocks the same way SaveDataWorker does.
+
+Run from the repository's root folder with:
+    python benchmarks/benchmarkVoltsStorage.py [secondsOfData] [nChannels] [samplingRate]
+'''
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import tables
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from voltsConverter import VoltsConverter, makeLookupTable
+
+
+compressionOptions = [('zlib', 0), ('zlib', 1), ('zlib', 5), ('blosc', 5), ('blosc:lz4', 5), ('blosc:zstd', 5)]
+appendChunkRows = 4096
+blockDuration = 0.01  # seconds of samples per block, like the SaveDataWorker's reads from the acquisition ring buffer.
+
+
+def makeCounts(nSamples, nChannels, samplingRate):
+    rng = np.random.default_rng(0)
+    t = np.arange(nSamples) / samplingRate
+    sniff = 1500 * np.sin(2 * np.pi * 5 * np.outer(t, np.ones(nChannels)))  # 5 Hz, about 3.7 V peak on the -10V:10V range.
+    noise = rng.normal(0, 3, size=(nSamples, nChannels))
+    return np.clip(np.round(4096 + sniff + noise), 0, 8191).astype('uint16')
+
+
+def writeSession(fileName, counts, samplingRate, voltsFormat, complib, complevel):
+    converter = VoltsConverter([makeLookupTable(8192, 8192, 20, 10)] * counts.shape[1])
+    filters = tables.Filters(complevel=complevel, complib=complib, shuffle=(complevel > 0))
+    colType = tables.UInt16Col if (voltsFormat == 'counts') else tables.Float32Col
+    descDict = {'sampleIndex': tables.Int64Col(pos=0)}
+    for i in range(counts.shape[1]):
+        descDict[f'voltageCh{i}'] = colType(pos=(i + 1))
+
+    blockSize = int(blockDuration * samplingRate)
+    with tables.open_file(fileName, mode='w', filters=filters) as h5file:
+        table = h5file.create_table(where='/', name='samples', description=descDict, expectedrows=(samplingRate * 3600))
+        t0 = time.perf_counter()
+        pending = []
+        nPending = 0
+        for start in range(0, len(counts), blockSize):
+            block = counts[start:(start + blockSize)]
+            values = block if (voltsFormat == 'counts') else converter.convert(block)
+            records = np.zeros(shape=len(block), dtype=table.dtype)
+            records['sampleIndex'] = start + np.arange(len(block))
+            for i in range(block.shape[1]):
+                records[f'voltageCh{i}'] = values[:, i]
+            pending.append(records)
+            nPending += len(records)
+            if nPending >= appendChunkRows:
+                table.append(np.concatenate(pending))
+                pending = []
+                nPending = 0
+        if nPending > 0:
+            table.append(np.concatenate(pending))
+        table.flush()
+        return time.perf_counter() - t0
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+    nChannels = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    samplingRate = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+    counts = makeCounts(int(duration * samplingRate), nChannels, samplingRate)
+    print(f"{duration} s of data, {nChannels} channels at {samplingRate} Hz")
+    print(f"{'format':>7} {'compression':>14} {'size (MB)':>10} {'MB per hour':>12} {'write time (s)':>15} {'ratio':>6}")
+    baseline = None
+    for voltsFormat in ['volts', 'counts']:
+        for complib, complevel in compressionOptions:
+            if not tables.which_lib_version(complib.split(':')[0]):
+                continue
+            fd, fileName = tempfile.mkstemp(suffix='.h5')
+            os.close(fd)
+            try:
+                writeTime = writeSession(fileName, counts, samplingRate, voltsFormat, complib, complevel)
+                size = os.path.getsize(fileName) / 1e6
+            finally:
+                os.remove(fileName)
+            if baseline is None:
+                baseline = size
+            compression = f"{complib} {complevel}" if (complevel > 0) else 'none'
+            print(f"{voltsFormat:>7} {compression:>14} {size:>10.2f} {size * 3600 / duration:>12.0f} {writeTime:>15.3f} {baseline / size:>5.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+import pyqtgraph as pg
+import logging
+import numpy as np
+import time
+from PyQt5.QtCore import QObject, QTimer
+
+from streamingWorker import StreamingChannelLayout, StreamingPlotBuffer, StreamingPlotReader
+
+
+logging.basicConfig(format="%(message)s", level=logging.INFO)
+
+
+class PyqtgraphStreamingWorker(QObject):
+    '''
+    Live sniff/lick plot drawn with pyqtgraph instead of matplotlib. It has the same methods as StreamingWorker and is chosen by setting "backend"
+    to "pyqtgraph" in the streamingPlot section of defaults.json (see makeStreamingWorker()). Instead of FuncAnimation, a QTimer calls update()
+    every plotInterval milliseconds, and pyqtgraph only repaints the items whose data changed. Each input port is drawn as a thick line at its
+    own height while the port is triggered (the NaN points between events break the line), and the response window is a LinearRegionItem.
+    '''
+
+    spanColors = {'b': (0, 0, 255, 50), 'y': (255, 255, 0, 50), 'g': (0, 255, 0, 50), 'r': (255, 0, 0, 50)}  # Same colors as the matplotlib axvspan with alpha=0.2.
+
+    def __init__(self, maxt=2, dt=0.02, ymin=-1.0, ymax=1.0, plotInterval=5):
+        super(PyqtgraphStreamingWorker, self).__init__()
+        self.graphWidget = pg.PlotWidget()
+        self.plotItem = self.graphWidget.getPlotItem()
+        self.plotItem.setMouseEnabled(x=False, y=False)
+        self.plotItem.hideButtons()  # The autoscale button would fight with the fixed axes.
+
+        self.dt = dt
+        self.maxt = maxt
+        self.ymax = ymax
+        self.ymin = ymin
+        self.plotInterval = plotInterval  # milliseconds
+        self.plotData = StreamingPlotBuffer(self.maxt, self.dt)
+
+        self.span = pg.LinearRegionItem(values=(0, 0), movable=False, brush=pg.mkBrush(self.spanColors['b']), pen=pg.mkPen(None))
+        self.plotItem.addItem(self.span)
+        self.channelLayout = StreamingChannelLayout()
+        self.channelLines = []  # One curve per analog channel, created by updateChannelLines() once the number of channels is known.
+        self.legend = self.plotItem.addLegend(offset=(-10, 10))  # Top right corner, so it does not cover the stats text.
+        self.portLines = [self.plotItem.plot(pen=pg.mkPen('b', width=4), connect='finite') for i in range(self.plotData.nPorts)]
+        self.plotItem.showAxis('right')
+        self.plotItem.getViewBox().sigResized.connect(lambda viewBox: self.plotData.setDecimationColumns(viewBox.width()))  # One envelope bucket per pixel column of the plot.
+
+        self.updateChannelLines()
+        self.setYaxis(self.ymin, self.ymax)
+        self.plotItem.setXRange(0, self.maxt, padding=0)
+        self.spanStart = 0
+        self.spanEnd = 0
+        self.spanColor = 'b'
+
+        self.dataReader = StreamingPlotReader()  # Gets the samples of each frame from the SaveDataWorker's plotBuffer, given by setDataBuffer().
+        self.nDataPointsPlotted = 0
+
+        self.statsText = pg.TextItem(anchor=(0, 0))
+        self.statsText.setParentItem(self.plotItem.getViewBox())  # Positioned in pixels from the plot's top left corner, so it does not move with the x axis.
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(lambda: self.update(self.dataReader.read()))  # Like StreamingWorker's emitter(), every frame plots the samples written since the previous one.
+        self.plotTimer = 0
+        self.previousTimer = 0
+        self.counter = 0
+        self.inputPorts = [np.nan] * 4
+
+        self.activateResponseWindow = False
+        self.presentOdor = False
+        self.paused = False
+        self.isRun = False
+        self.isSetup = True
+
+    def setYaxis(self, ymin, ymax):
+        self.ymax = ymax
+        self.ymin = ymin
+        self.plotItem.setYRange(self.ymin - 0.1, self.ymax + 0.1, padding=0)
+        self.triggeredValues = [self.ymax, (self.ymax - ((self.ymax - self.ymin) / 3)), (((self.ymax - self.ymin) / 3) + self.ymin), self.ymin]
+        self.plotItem.getAxis('right').setTicks([[(self.triggeredValues[i], f'Port_{i + 1}') for i in range(len(self.triggeredValues))]])
+        self.updateChannelAxis()  # The stacked lanes divide the y axis, so they move with it.
+
+    def setXaxis(self, maxt):
+        self.maxt = maxt
+        self.plotData.resize(self.maxt, self.dt)
+        lastt = self.plotData.getLastTime()
+        self.plotData.reset(lastt, self.plotData.getLastValues(), self.plotData.getPortValues()[:, -1])  # Start a new window from the last point.
+        self.plotItem.setXRange(lastt, lastt + self.maxt, padding=0)
+
+    def set_dt(self, dt):
+        self.dt = dt
+        if self.plotData.resize(self.maxt, self.dt):  # The window holds maxt/dt points, so it needs a new size.
+            self.plotItem.setXRange(self.plotData.getWindowStart(), self.plotData.getWindowStart() + self.maxt, padding=0)
+
+    def setPlotInterval(self, value):
+        self.plotInterval = value
+        self.timer.setInterval(self.plotInterval)
+
+    def update(self, y):
+        currentTimer = time.perf_counter()
+        self.plotTimer = round(((currentTimer - self.previousTimer) * 1000), 3)  # the first reading will be erroneous
+        self.previousTimer = currentTimer
+        self.counter += 1
+        if (self.counter % 10) == 0:  # Updating the text re-lays it out, so only do it every few frames.
+            elapsed = time.perf_counter() - self.t_start
+            self.statsText.setText(
+                f"Plot Interval = {self.plotTimer}ms\nMean Frame Rate: {self.counter / elapsed:.3f}FPS\nElapsed Time: {elapsed:.3f} sec\n"
+                f"Total data points: {self.dataReader.getNumSamples()}\nPlotted data points: {self.nDataPointsPlotted}"
+            )
+
+        if y is None:
+            return  # No new samples since the last frame, so there is nothing to redraw.
+        if self.plotData.append(y, self.inputPorts):  # The window is full (or the number of channels changed) so a new one was started.
+            if len(self.channelLines) != self.plotData.nChannels:
+                self.updateChannelLines()
+            self.plotItem.setXRange(self.plotData.getWindowStart(), self.plotData.getWindowStart() + self.maxt, padding=0)
+        self.nDataPointsPlotted += np.shape(y)[-1]
+
+        for channel, laneBottom, laneTop in self.channelLayout.getLanes(self.ymin, self.ymax):
+            scale, offset = self.channelLayout.getTransform(channel, laneBottom, laneTop, self.ymin, self.ymax)
+            self.channelLines[channel].setData(self.plotData.getDisplayTimes(channel), self.plotData.getDisplayValues(channel, scale, offset))
+        tdata = self.plotData.getDisplayPortTimes()
+        portData = self.plotData.getDisplayPortValues()
+        for i in range(len(self.portLines)):
+            self.portLines[i].setData(tdata, portData[i])
+
+        if self.activateResponseWindow or self.presentOdor:
+            self.spanEnd = self.plotData.getLastTime()  # Make the responseWindow grow with sniff signal.
+            self.span.setRegion((self.spanStart, self.spanEnd))
+
+    def updateChannelLines(self):
+        # Creates one curve per channel of the plot buffer, replacing the previous ones. The first channel is white like the single channel plot was.
+        for line in self.channelLines:
+            self.plotItem.removeItem(line)
+        self.channelLayout.setNumChannels(self.plotData.nChannels)
+        self.channelLines = [self.plotItem.plot(pen=pg.mkPen('w' if (i == 0) else pg.intColor(i - 1, hues=7), width=1)) for i in range(self.plotData.nChannels)]
+        self.updateChannelAxis()
+
+    def updateChannelAxis(self):
+        # Shows the visible channels' curves, and labels them with a legend when overlaid or with the left axis ticks of their lanes when stacked.
+        for i in range(len(self.channelLines)):
+            self.channelLines[i].setVisible(self.channelLayout.visible[i])
+        lanes = self.channelLayout.getLanes(self.ymin, self.ymax)
+        if self.channelLayout.mode == 'stacked':
+            self.plotItem.getAxis('left').setTicks([[((laneBottom + laneTop) / 2, self.channelLayout.names[channel]) for channel, laneBottom, laneTop in lanes]])
+        else:
+            self.plotItem.getAxis('left').setTicks(None)
+        self.legend.clear()
+        if (self.channelLayout.mode == 'overlaid') and (len(lanes) > 1):
+            for channel, laneBottom, laneTop in lanes:
+                self.legend.addItem(self.channelLines[channel], self.channelLayout.names[channel])
+
+    def setChannelNames(self, names):
+        self.channelLayout.setNames(names)
+        self.updateChannelAxis()
+
+    def setChannelLayout(self, mode):
+        # mode is 'overlaid' or 'stacked'.
+        self.channelLayout.setMode(mode)
+        self.updateChannelAxis()
+
+    def setChannelVisible(self, channel, visible):
+        self.channelLayout.setVisible(channel, visible)
+        self.updateChannelAxis()
+
+    def setChannelYRange(self, channel, yRange):
+        # yRange is the (ymin, ymax) of the channel's values that fills its lane, or None to use the plot's y axis.
+        self.channelLayout.setYRange(channel, yRange)
+        self.updateChannelAxis()
+
+    def setDataBuffer(self, buffer):
+        # buffer is the SaveDataWorker's plotBuffer (see StreamingPlotReader), or None when there is no analog input to plot.
+        self.dataReader.setBuffer(buffer)
+
+    def getFigure(self):
+        return self.graphWidget
+
+    def setSpanColor(self, color):
+        self.span.setBrush(pg.mkBrush(self.spanColors[color]))
+        self.span.update()
+
+    def checkOdorPresentation(self, stateName):
+        if stateName == 'PresentOdor':
+            self.presentOdor = True
+            self.spanStart = self.plotData.getLastTime()
+            self.setSpanColor('y')
+            self.spanColor = 'y'
+
+    def checkResponseWindow(self, stateName):
+        # This function gets the newStateSignal from protocolWorker. See StreamingWorker.checkResponseWindow() for why the span color is set with a QTimer.singleShot.
+        if stateName == 'WaitForResponse':
+            self.presentOdor = False
+            self.spanStart = self.plotData.getLastTime()
+            self.setSpanColor('b')  # reset color to blue until lick occurs.
+            self.activateResponseWindow = True
+            self.spanColor = 'b'  # also reset the color variable to blue.
+        elif stateName == 'Correct':
+            self.setSpanColor('g')
+            self.activateResponseWindow = False
+        elif stateName == 'Wrong':
+            self.setSpanColor('r')
+            self.activateResponseWindow = False
+        elif stateName == 'NoResponse':
+            # No need to set span color here as it is already blue.
+            self.activateResponseWindow = False
+        else:
+            if self.activateResponseWindow:
+                QTimer.singleShot(100, lambda: self.setSpanColor(self.spanColor))
+                self.activateResponseWindow = False
+
+    def setInputEvent(self, inputs):
+        for i in range(len(inputs)):
+            if inputs[i]:
+                self.inputPorts[i] = self.triggeredValues[i]
+            else:
+                self.inputPorts[i] = np.nan
+
+    def pauseAnimation(self):
+        if not self.paused:
+            self.timer.stop()
+            self.paused = True
+
+    def resumeAnimation(self):
+        if self.paused:
+            self.timer.start(self.plotInterval)
+            self.paused = False
+
+    def startAnimation(self):
+        if self.isSetup and not self.isRun:
+            self.t_start = time.perf_counter()
+            self.timer.start(self.plotInterval)
+            self.isRun = True
+            return True
+        return False
+
+    def resetPlot(self):
+        self.plotData.reset()
+        self.plotItem.setXRange(0, self.maxt, padding=0)
+        self.statsText.setText('')
+
+        self.dataReader.skip()  # Start from the samples written from now on instead of the ones written while the plot was paused.
+        self.nDataPointsPlotted = 0
+        self.plotTimer = 0
+        self.previousTimer = 0
+        self.counter = 0
+        self.inputPorts = [np.nan] * 4
+
+        self.spanStart = 0
+        self.spanEnd = 0
+        self.span.setRegion((0, 0))
+        self.activateResponseWindow = False
+        self.presentOdor = False
+        self.t_start = time.perf_counter()
@@ -1,11 +1,20 @@
-import tables
 import logging
 import os
+import time
 import json
+import queue
+import threading
+import collections
 import numpy as np
 from datetime import datetime
+from numpy.lib import recfunctions
 from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal, pyqtSlot
 
+from voltsConverter import VoltsConverter
+from analogRingBuffer import AnalogRingBuffer
+from sessionWriters import makeSessionWriter
+from sessionWriterProcess import ProcessSessionWriter, isWriterProcessAvailable
+
 
 logging.basicConfig(format="%(message)s", level=logging.INFO)
 
@@ -48,142 +57,151 @@ Example trial info dictionary created by the bpod.
 
 
 class SaveDataWorker(QObject):
-    analogDataSignal = pyqtSignal(np.ndarray)
     finished = pyqtSignal()
 
     def __init__(self,
-            mouseNum, rigLetter, protocolFile, olfaConfigFile, shuffleMultiplier, itiMin, itiMax, leftWaterValveDuration, rightWaterValveDuration, analogInSettings, analogInModule=None, bpod=None
+            mouseNum, rigLetter, protocolFile, olfaConfigFile, shuffleMultiplier, itiMin, itiMax, leftWaterValveDuration, rightWaterValveDuration, analogInSettings, analogInModule=None, bpod=None, analogBuffer=None,
+            storageSettings=None
         ):
         super(SaveDataWorker, self).__init__()
         # QObject.__init__(self)  # super(...).__init() does this for you in the line above.
+
+        # The writer saves everything to the file, and the format is chosen by the "writer" setting (see sessionWriters.py and sessionWriterProcess.py).
+        self.storageSettings = storageSettings if (storageSettings is not None) else {}
+        if self.storageSettings.get('writerProcess', False) and isWriterProcessAvailable():
+            self.writer = ProcessSessionWriter(self.storageSettings)  # Runs the writer in its own process.
+        else:
+            if self.storageSettings.get('writerProcess', False):
+                logging.warning("Running the writer in its own process needs Python 3.8 or newer. Saving in this process instead.")
+            self.writer = makeSessionWriter(self.storageSettings)
+        self.flushInterval = self.storageSettings.get('flushInterval', 1.0)  # The writer flushes at least this often, so the run loop wakes up at least this often.
+
+        # 'volts' saves each sample as float32 voltages. 'counts' saves the ADC's uint16 counts, which are half the size, and the gain and offset of each channel
+        # (volts = (counts * gain) + offset) in the voltages settings and attributes.
+        self.voltsFormat = self.storageSettings.get('voltsFormat', 'volts')
+        if self.voltsFormat not in ('volts', 'counts'):
+            logging.warning(f"Unknown voltsFormat '{self.voltsFormat}' in the dataStorage settings. Using 'volts' instead.")
+            self.voltsFormat = 'volts'
+
+        self.adc = analogInModule
+        self.bpod = bpod
+        eventNames = list(self.bpod.hardware.channels.event_names) if (self.bpod is not None) else []  # All of the bpod's event names in the order of their event codes. Used for the events table's Enum.
+        self.protocolStates = self.readProtocolStates(protocolFile)
+        stateNames = [state['stateName'] for state in self.protocolStates]  # Writers that must create every table before the first trial (i.e. 'swmr') use these for the states table's Enum.
+
         dateTimeString = datetime.now().strftime("%Y-%m-%d_%H%M%S")
-        fileName = f"results/Mouse_{mouseNum}_Rig_{rigLetter}_{dateTimeString}.h5"
+        fileName = f"results/Mouse_{mouseNum}_Rig_{rigLetter}_{dateTimeString}{self.writer.fileExtension}"
         if not os.path.isdir('results'):
             os.mkdir('results')
-        self.h5file = tables.open_file(filename=fileName, mode='w', title=f"Mouse {mouseNum} Experiment Data")
         
         # File attributes for future reference.
-        self.h5file.root._v_attrs.mouseNum = mouseNum
-        self.h5file.root._v_attrs.rig = rigLetter
-        self.h5file.root._v_attrs.date = dateTimeString
-        self.h5file.root._v_attrs.protocolFile = protocolFile
-        self.h5file.root._v_attrs.olfaConfigFile = olfaConfigFile
-        self.h5file.root._v_attrs.shuffleMultiplier = shuffleMultiplier
-        self.h5file.root._v_attrs.itiMax = itiMax
-        self.h5file.root._v_attrs.itiMin = itiMin
-        self.h5file.root._v_attrs.leftWaterValveDuration = leftWaterValveDuration
-        self.h5file.root._v_attrs.rightWaterValveDuration = rightWaterValveDuration
-        
-        self.eventsGroup = self.h5file.create_group(where='/', name='event_times', title='Event Timestamps Per Trial')
-        self.trialsTable = None  # Make it None for now because have to wait for completion of first trial to get the infoDict with data on the trial. Once that comes, make a description dictionary using the infoDict and then use that description dict to create the trialsTable.
-        self.trialsTableDescDict = {}  # Description for the trialsTable (using this instead of making a class definition and subclassing tables.IsDescription).
-        self.statesTable = None  # Make it None because have to wait for completion of first trial to get names of all the states. Afterwhich, make description dictionary and then table.
-        self.statesTableDescDict = {}  # Description for the states table (using this instead of making a class definition and subclassing tables.IsDescription).
-        self.eventsTable = None  # Same thing here, and also because I do not want to create the eventsTable if no input events even occurred.
-        self.eventsTableDescDict = {}  # Description for the events table instead of making a class definition and subclassing tables.IsDescription.
+        self.writer.open(fileName, {
+            'mouseNum': mouseNum,
+            'rig': rigLetter,
+            'date': dateTimeString,
+            'protocolFile': protocolFile,
+            'olfaConfigFile': olfaConfigFile,
+            'shuffleMultiplier': shuffleMultiplier,
+            'itiMax': itiMax,
+            'itiMin': itiMin,
+            'leftWaterValveDuration': leftWaterValveDuration,
+            'rightWaterValveDuration': rightWaterValveDuration
+        }, eventNames, stateNames)
         
         self.keepRunning = True
-        self.newData = False
+        self.wakeEvent = threading.Event()  # Set whenever there is something to do: new analog samples, an end of trial dict, or stopping.
+        self.infoDictQueue = queue.Queue()  # End of trial dicts received from the protocolWorker, with the time they were received.
+        self.saveLatencies = []  # Seconds from receiving each end of trial dict until its data was saved.
+        self.saveLatencyWarning = 0.5  # Log a warning when saving the end of trial data takes longer than this many seconds.
         self.trialNum = 1
+        self.samplesTrialNum = 1  # Trial whose analog samples are being saved. It lags behind self.trialNum while the last samples of ended trials are still in the analog buffer.
+        self.pendingTrialEnds = collections.deque()  # Trials whose end of trial dict was received but whose samples are not all saved yet (see receiveInfoDict() and saveAnalogData()).
         self.infoDict = {}        
-        self.adc = analogInModule
-        self.bpod = bpod
+        self.plotChannelNames = []  # Set below when there is analog input to plot.
+        self.plotBuffer = None  # AnalogRingBuffer of the volts of every channel, read by the streaming plot (see StreamingPlotReader). Set below when there is analog input to plot.
+        self.plotBufferDuration = 2  # Seconds of samples that plotBuffer holds, which is how far the streaming plot can fall behind before it skips samples.
+        self.analogBuffer = analogBuffer  # AnalogRingBuffer filled by the AcquisitionWorker's thread.
+        if self.analogBuffer is not None:
+            self.analogBufferReader = self.analogBuffer.addReader()
+            self.analogBuffer.addWakeEvent(self.wakeEvent)
+            self.analogBufferOverruns = 0
+            self.usbFramesLost = 0
 
         if olfaConfigFile:
             with open(olfaConfigFile, 'r') as configFile:
                 self.olfaConfigDict = json.load(configFile)
                 self.nOlfas = len(self.olfaConfigDict['Olfactometers'])
-            
-            # Make the description dict for the vials table.
-            self.vialsTableDescDict = {}
-            pos = 0
-            self.vialsTableDescDict["olfa"] = tables.UInt8Col(pos=pos)
-            pos += 1
-            self.vialsTableDescDict["vial"] = tables.UInt8Col(pos=pos)
-            pos += 1
-            self.vialsTableDescDict["odor"] = tables.StringCol(32, pos=pos)
-            pos += 1
-            self.vialsTableDescDict["conc"] = tables.Float32Col(pos=pos)
-
-            # Make the vials table using the description dict above.
-            self.vialsTable = self.h5file.create_table(where=self.h5file.root, name='vials', description=self.vialsTableDescDict, title='Vial Details')
-            self.vialsRow = self.vialsTable.row
-
-            # Write to the vials table.
+
+            # Save the details of every vial that is not a dummy.
+            vials = []
             olfaIndex = 0
             for olfaDict in self.olfaConfigDict['Olfactometers']:
                 for vialNum, vialInfo in olfaDict['Vials'].items():
                     if not (vialInfo['odor'] == 'dummy'):
-                        self.vialsRow['olfa'] = olfaIndex
-                        self.vialsRow['vial'] = int(vialNum)
-                        self.vialsRow['odor'] = vialInfo['odor']
-                        self.vialsRow['conc'] = vialInfo['conc']
-                        self.vialsRow.append()
+                        vials.append((olfaIndex, int(vialNum), vialInfo['odor'], vialInfo['conc']))
                 olfaIndex += 1
-            self.vialsTable.flush()
+            self.writer.saveVials(np.array(vials, dtype=[('olfa', 'uint8'), ('vial', 'uint8'), ('odor', 'S32'), ('conc', 'float32')]))
 
         if self.adc is not None:
             self.bpod = None  # Avoid using the bpod in case it was also given as a parameter.
             self.analogSettings = analogInSettings
-            self.rangeLimits = {'-10V:10V': [-10.0, 10.0], '-5V:5V': [-5.0, 5.0], '-2.5V:2.5V': [-2.5, 2.5],'0V:10V': [0.0, 10.0]}
-            self.maxVoltages = [self.rangeLimits[x][1] for x in self.analogSettings['inputRanges']]  # Make a list of integers for the max voltage of each channel's input range. analogSettings['inputRanges'] returns a list of strings that are used as keys in self.rangeLimits.
-            self.minVoltages = [self.rangeLimits[x][0] for x in self.analogSettings['inputRanges']]  # Make a list of integers for the min voltage of each channel's input range.
-            self.samplingPeriod = 1 / (self.analogSettings['samplingRate'])
-            self.analogDataBufferSize = 5  # Size of buffer to send to the streamingWorker for plotting the analog data. Larger the buffer, the thicker the line gets and steps become more visible as buffers get sent before the previous buffer is completely plotted.
-            self.analogDataBuffer = np.zeros(shape=self.analogDataBufferSize, dtype='float32')
+            self.streamChannels = [i for i in range(len(self.analogSettings['enableUSBStreaming'])) if self.analogSettings['enableUSBStreaming'][i]]  # Channels that stream to USB, in the order their samples arrive in each frame.
+            self.plotChannelNames = [f"Channel {c + 1}" for c in self.streamChannels]  # Names of the channels of plotBuffer.
+            self.voltsConverter = VoltsConverter.fromAnalogInModule(self.adc, [self.analogSettings['inputRanges'][i] for i in self.streamChannels])  # One lookup table per streaming channel, built from its input range.
+            self.samplingRate = self.analogSettings['samplingRate']
+            self.adcStartStates = self.findAdcStartStates()  # Used to find the time on the bpod's clock of each trial's ADC_start sync byte.
+            self.plotBuffer = AnalogRingBuffer(capacity=max(int(self.plotBufferDuration * self.samplingRate), 1), dtype='float32', itemShape=(len(self.streamChannels),))
             self.saveVoltages = False
-            self.counter = 0
+
+            # Frames from up to preTriggerDuration seconds before each ADC_start sync byte and postTriggerDuration seconds after each ADC_stop sync byte are saved
+            # too, so that the baseline around the triggered segment is kept. The last frames of each block are kept in preTriggerBuffer because the window before
+            # an ADC_start can begin in an earlier block.
+            self.preTriggerSamples = int(round(self.storageSettings.get('preTriggerDuration', 0) * self.samplingRate))
+            self.postTriggerSamples = int(round(self.storageSettings.get('postTriggerDuration', 0) * self.samplingRate))
+            self.preTriggerBuffer = AnalogRingBuffer(capacity=self.preTriggerSamples, dtype=self.adc.getUSBFrameDtype()) if (self.preTriggerSamples > 0) else None
+            self.preTriggerEndIndex = None  # sampleIndex after the last frame in preTriggerBuffer.
+            self.postTriggerRemaining = 0  # Frames of the current post-trigger window that have not been received yet.
+            self.lastSavedSampleIndex = -1
             self.previousTimer = 0
             self.t_start = 0
-            self.bpodTime = 0
-            self.voltsGroup = self.h5file.create_group(where='/', name='voltages', title='Voltages Per Trial')
-            
-            # Make the description dict for the setting table.
-            self.voltsSettingsDescDict = {}
-            pos = 0
-            self.voltsSettingsDescDict['samplingRate'] = tables.UInt16Col(pos=pos)
-            pos += 1
-            self.voltsSettingsDescDict['inputRange'] = tables.StringCol(10, pos=pos)
-            pos += 1
-            self.voltsSettingsDescDict['thresholdVoltage'] = tables.Float32Col(pos=pos)
-            pos += 1
-            self.voltsSettingsDescDict['resetVoltage'] = tables.Float32Col(pos=pos)
             
-            # Make the settings table using the description dict above.
-            self.voltsSettingsTable = self.h5file.create_table(where='/voltages', name='settings', description=self.voltsSettingsDescDict, title='Analog Input Settings')
-            self.voltsSettingsRow = self.voltsSettingsTable.row
-            
-            # Write to the settings table.
-            for i in range(self.analogSettings['nActiveChannels']):  # Each active channel will have a row.
-                self.voltsSettingsRow['samplingRate'] = self.analogSettings['samplingRate']  # sampling rate is global for all channels.
-                self.voltsSettingsRow['inputRange'] = self.analogSettings['inputRanges'][i]
-                self.voltsSettingsRow['thresholdVoltage'] = self.analogSettings['thresholdVoltages'][i]
-                self.voltsSettingsRow['resetVoltage'] = self.analogSettings['resetVoltages'][i]
-                self.voltsSettingsRow.append()
-            self.voltsSettingsTable.flush()
-
-            # Make the description dict for the volts table.
-            self.voltsTableDescDict = {}  # Description dictionary for the volts table instead of making a class definition and subclassing tables.IsDescription.
-            pos = 0
-            # self.voltsTableDescDict['prefix'] = tables.UInt8Col(pos=pos)
-            # pos += 1
-            # self.voltsTableDescDict['syncByte'] = tables.UInt8Col(pos=pos)
-            # pos += 1
-            self.voltsTableDescDict['bpodTime'] = tables.Float32Col(pos=pos)
-            pos += 1
+            # Each active channel has a row of settings.
+            gains, offsets = self.adc.getVoltsScales(self.analogSettings['inputRanges'])
+            settingsRecords = np.zeros(shape=self.analogSettings['nActiveChannels'], dtype=[
+                ('samplingRate', 'uint16'),  # sampling rate is global for all channels.
+                ('inputRange', 'S10'),
+                ('thresholdVoltage', 'float32'),
+                ('resetVoltage', 'float32'),
+                ('gain', 'float64'),  # volts = (counts * gain) + offset
+                ('offset', 'float64')
+            ])
+            settingsRecords['samplingRate'] = self.analogSettings['samplingRate']
             for i in range(self.analogSettings['nActiveChannels']):
-                self.voltsTableDescDict[f'voltageCh{i}'] = tables.Float32Col(pos=pos)  # make a column for each channel used.
-                pos += 1
+                settingsRecords[i] = (self.analogSettings['samplingRate'], self.analogSettings['inputRanges'][i], self.analogSettings['thresholdVoltages'][i], self.analogSettings['resetVoltages'][i], gains[i], offsets[i])
+
+            # Each sample is saved with its sampleIndex (its position in the session's stream, see the writer's trial anchors) and a column for each channel used.
+            # self.voltsDtype.append(('prefix', 'uint8'))
+            # self.voltsDtype.append(('syncByte', 'uint8'))
+            self.voltsDtype = [('sampleIndex', 'int64')] + [(f'voltageCh{i}', self.getVoltsColType()) for i in range(self.analogSettings['nActiveChannels'])]
             
-            # Make the volts table using the description dict above.
-            self.voltsTable = self.h5file.create_table(where='/voltages', name=f'trial_{self.trialNum:03d}', description=self.voltsTableDescDict, title=f'Trial {self.trialNum} Voltage Data')
-            self.voltsRow = self.voltsTable.row
+            # The voltageCh columns hold the streaming channels in order, so take each column's gain and offset from the settings of the channel it holds.
+            nColumns = min(len(self.streamChannels), self.analogSettings['nActiveChannels'])
+            self.writer.createVolts(np.dtype(self.voltsDtype), settingsRecords, {
+                'samplingRate': self.samplingRate,
+                'voltsFormat': self.voltsFormat,
+                'columnNames': [f'voltageCh{i}' for i in range(nColumns)],
+                'columnGains': [gains[c] for c in self.streamChannels[:nColumns]],
+                'columnOffsets': [offsets[c] for c in self.streamChannels[:nColumns]]
+            }, expectedRows=(self.samplingRate * 3600))  # Assumes sessions of about one hour.
+            self.trialAnchorSampleIndex = None  # sampleIndex of the current trial's anchor, once it has been received.
+            self.nTrialSamples = 0  # Samples appended to the writer since the current trial started.
 
         elif self.bpod is not None:
             self.channelIndices = self.bpod.hardware.analog_input_channels  # list of channel indices of channels configured for analog input.
             if (self.channelIndices is not None) and (len(self.channelIndices) > 0):
                 # This means it is a list of at least one flex channel number that is configured for analog input.
                 self.nChannels = len(self.channelIndices)
+                self.plotChannelNames = [f"Flex {c + 1}" for c in self.channelIndices]  # Names of the channels of plotBuffer.
                 self.thresholds_1 = self.bpod.hardware.analog_input_thresholds_1
                 self.thresholds_2 = self.bpod.hardware.analog_input_thresholds_2
                 self.polarities_1 = self.bpod.hardware.analog_input_threshold_polarity_1
@@ -191,305 +209,318 @@ class SaveDataWorker(QObject):
                 self.maxVoltages = [5] * self.nChannels  # Make a list of integers for the max voltage of each channel's input range.
                 self.minVoltages = [0] * self.nChannels  # Make a list of integers for the min voltage of each channel's input range.
                 self.samplingPeriod = self.bpod.hardware.analog_input_sampling_interval * 0.0001  # Multiply by the state machines timer period of 100 microseconds.
-                self.bpodTime = 0
-                self.voltsGroup = self.h5file.create_group(where='/', name='voltages', title='Voltages Per Trial')
+                self.samplingRate = 1 / self.samplingPeriod
+                self.plotBuffer = AnalogRingBuffer(capacity=max(int(self.plotBufferDuration * self.samplingRate), 1), dtype='float32', itemShape=(self.nChannels,))
+                self.voltsConverter = VoltsConverter.fromFlexChannels(self.maxVoltages)
                 
-                # Make the description dict for the setting table.
-                self.voltsSettingsDescDict = {}
-                pos = 0
-                self.voltsSettingsDescDict['samplingRate'] = tables.UInt16Col(pos=pos)
-                pos += 1
-                self.voltsSettingsDescDict['inputRange'] = tables.StringCol(10, pos=pos)
-                pos += 1
-                self.voltsSettingsDescDict['thresholdVoltage_1'] = tables.Float32Col(pos=pos)
-                pos += 1
-                self.voltsSettingsDescDict['thresholdVoltage_2'] = tables.Float32Col(pos=pos)
-                pos += 1
-                self.voltsSettingsDescDict['thresholdPolarity_1'] = tables.UInt8Col(pos=pos)
-                pos += 1
-                self.voltsSettingsDescDict['thresholdPolarity_2'] = tables.UInt8Col(pos=pos)
-                
-                # Make the settings table using the description dict above.
-                self.voltsSettingsTable = self.h5file.create_table(where='/voltages', name='settings', description=self.voltsSettingsDescDict, title='Analog Input Settings')
-                self.voltsSettingsRow = self.voltsSettingsTable.row
-                
-                # Write to the settings table.
-                for i in range(self.nChannels):  # Each analog input channel will have a row.
-                    self.voltsSettingsRow['samplingRate'] = 1 / self.samplingPeriod  # sampling rate is global for all channels.
-                    self.voltsSettingsRow['inputRange'] = "0V:5V"  # global for all flex channels.
-                    self.voltsSettingsRow['thresholdVoltage_1'] = (self.thresholds_1[self.channelIndices[i]] / 4095) * self.maxVoltages[i]  # Convert to voltage
-                    self.voltsSettingsRow['thresholdVoltage_2'] = (self.thresholds_2[self.channelIndices[i]] / 4095) * self.minVoltages[i]  # Convert to voltage
-                    self.voltsSettingsRow['thresholdPolarity_1'] = self.polarities_1[self.channelIndices[i]]
-                    self.voltsSettingsRow['thresholdPolarity_2'] = self.polarities_2[self.channelIndices[i]]
-                    self.voltsSettingsRow.append()
-                self.voltsSettingsTable.flush()
-
-                # Make the description dict for the volts table.
-                self.voltsTableDescDict = {}  # Description dictionary for the volts table instead of making a class definition and subclassing tables.IsDescription.
-                pos = 0
-                self.voltsTableDescDict['trialNum'] = tables.UInt8Col(pos=pos)
-                pos += 1
-                self.voltsTableDescDict['bpodTime'] = tables.Float32Col(pos=pos)
-                pos += 1
+                # Each analog input channel has a row of settings.
+                settingsRecords = np.zeros(shape=self.nChannels, dtype=[
+                    ('samplingRate', 'uint16'),  # sampling rate is global for all channels.
+                    ('inputRange', 'S10'),  # global for all flex channels.
+                    ('thresholdVoltage_1', 'float32'),
+                    ('thresholdVoltage_2', 'float32'),
+                    ('thresholdPolarity_1', 'uint8'),
+                    ('thresholdPolarity_2', 'uint8'),
+                    ('gain', 'float64'),  # volts = (counts * gain) + offset
+                    ('offset', 'float64')
+                ])
                 for i in range(self.nChannels):
-                    self.voltsTableDescDict[f'voltageCh{self.channelIndices[i]}'] = tables.Float32Col(pos=pos)  # make a column for each channel used.
-                    pos += 1
-                
-                # Make the volts table using the description dict above.
-                self.voltsTable = self.h5file.create_table(where='/voltages', name=f'trial_{self.trialNum:03d}', description=self.voltsTableDescDict, title=f'Trial {self.trialNum} Voltage Data')
-                self.voltsRow = self.voltsTable.row
+                    settingsRecords[i] = (
+                        self.samplingRate, "0V:5V",
+                        (self.thresholds_1[self.channelIndices[i]] / 4095) * self.maxVoltages[i],  # Convert to voltage
+                        (self.thresholds_2[self.channelIndices[i]] / 4095) * self.minVoltages[i],  # Convert to voltage
+                        self.polarities_1[self.channelIndices[i]], self.polarities_2[self.channelIndices[i]],
+                        self.maxVoltages[i] / 4095, 0
+                    )
+
+                self.voltsDtype = [('trialNum', 'uint16'), ('sampleIndex', 'int64')] + [(f'voltageCh{c}', self.getVoltsColType()) for c in self.channelIndices]
+                self.writer.createVolts(np.dtype(self.voltsDtype), settingsRecords, {
+                    'samplingRate': self.samplingRate,
+                    'voltsFormat': self.voltsFormat,
+                    'columnNames': [f'voltageCh{c}' for c in self.channelIndices],
+                    'columnGains': [maxVoltage / 4095 for maxVoltage in self.maxVoltages],
+                    'columnOffsets': [0] * self.nChannels
+                }, expectedRows=int(3600 / self.samplingPeriod))  # Assumes sessions of about one hour.
+                self.trialAnchorSampleIndex = None  # sampleIndex of the current trial's first sample, once it has been received.
+                self.nTrialSamples = 0  # Samples appended to the writer since the current trial started.
             
             else:
                 self.bpod = None  # Make it None to indicate to other functions below that there is no analog input.
 
+    def getVoltsColType(self):
+        if self.voltsFormat == 'counts':
+            return 'uint16'
+        return 'float32'
+
+    def readProtocolStates(self, protocolFile):
+        # The state dicts of the protocol file (see protocolEditorDialog), or an empty list if it cannot be read.
+        try:
+            with open(protocolFile, 'r') as f:
+                stateMachine = json.load(f)
+        except (OSError, TypeError, ValueError):
+            logging.warning("Could not read the states of the protocol file. The trial anchors will not have a bpod time.")
+            return []
+        return stateMachine.get('states', [])
+
+    def findAdcStartStates(self):
+        # Names of the protocol's states whose output actions send the ADC_start sync byte to the analog input module (see protocolWorker).
+        return [state['stateName'] for state in self.protocolStates if 'ADC_start' in state.get('outputActions', {}).values()]
+
+    def getTrialAnchorTime(self):
+        # Time on the bpod's clock of the current trial's anchor, using the end of trial data in self.infoDict.
+        trialStartTime = self.infoDict['Trial start timestamp']
+        if self.adc is None:
+            return trialStartTime  # The flex channels' samples are tagged with the trial number, so the trial's first sample is at the start of the trial.
+
+        # The anchor is the ADC_start sync byte, which the state machine sends when it enters a state in self.adcStartStates. States timestamps are relative to the start of the trial.
+        stateStartTimes = [self.infoDict['States timestamps'][name][0][0] for name in self.adcStartStates if name in self.infoDict['States timestamps']]
+        stateStartTimes = [t for t in stateStartTimes if not np.isnan(t)]  # States that were not visited this trial have NaN timestamps.
+        if len(stateStartTimes) == 0:
+            return np.nan
+        return trialStartTime + min(stateStartTimes)
+
     def receiveInfoDict(self, infoDict):
-        self.newData = True
-        self.infoDict = infoDict
-
-    def saveStatesTimestamps(self):
-        # Define the description for the states table using a dictionary of the states timestamps. Then create the states table (only once).
-        if self.statesTable is None:
-            pos = 0
-            for k, v in self.infoDict['States timestamps'].items():
-                keyString = k + '_start'
-                self.statesTableDescDict[keyString] = tables.Float32Col(pos=pos)
-                pos += 1
-                keyString = k + '_end'
-                self.statesTableDescDict[keyString] = tables.Float32Col(pos=pos)
-                pos += 1
-            
-            self.statesTable = self.h5file.create_table(where='/', name='state_times', description=self.statesTableDescDict, title='States Timestamps')
-            self.statesRow = self.statesTable.row
-
-        # Fill in column values for the states timestamps for the current row since statesTable has now been created.
-        for k, v in self.infoDict['States timestamps'].items():
-            keyString = k + '_start'
-            self.statesRow[keyString] = v[0][0]
-            keyString = k + '_end'
-            self.statesRow[keyString] = v[0][1]
-
-        # only one row per end of trial data so append what was written and flush to disk.
-        self.statesRow.append()
-        self.statesTable.flush()
-   
-    def saveEventsTimestamps(self):
-        # Create the eventsTableDescDict (and then the eventsTable) every trial because it is not always the same every trial. Some events happen one trial but not in another.
-        pos = 0
-        eventCounters = []
-        for event, eventList in self.infoDict['Events timestamps'].items():
-            self.eventsTableDescDict[event] = tables.Float32Col(dflt=np.nan, pos=pos)
-            eventCounters.append(len(eventList))  # Store the lengths of each eventList because will need to find the longest list below by finding the max.
-            pos += 1  
-        self.eventsTable = self.h5file.create_table(where='/event_times', name=f'trial_{self.trialNum:03d}', description=self.eventsTableDescDict, title=f'Trial {self.trialNum} Event Timestamps')
-        self.eventsRow = self.eventsTable.row
-        
-        # Use the length of the longest list to make an index to take one element from each eventList and add it to the row. If an IndexError happens because an eventList is shorter
-        # than the longest eventList, then add np.nan to that row.
-        for i in range(max(eventCounters)):
-            for event, eventsList in self.infoDict['Events timestamps'].items():
-                try:
-                    self.eventsRow[event] = eventsList[i]
-                except IndexError:
-                    self.eventsRow[event] = np.nan
-            self.eventsRow.append()
-        self.eventsTable.flush()
-    
-    def saveTrialData(self):
-        # If its None, that means the first trial's data just came, so make the description dict and then create the trialsTable using that description dict. This only happens once.
-        if self.trialsTable is None:
-            pos = 0
-            # self.trialsTableDescDict['trialNum'] = tables.UInt16Col(pos=pos)
-            # pos += 1
-            # self.trialsTableDescDict['correctResponse'] = tables.StringCol(8, pos=pos)
-            # pos += 1
-            self.trialsTableDescDict['responseResult'] = tables.StringCol(7, pos=pos)
-            pos += 1
-            # self.trialsTableDescDict['itiDuration'] = tables.UInt8Col(pos=pos)
-            # pos += 1
-            # self.trialsTableDescDict['bpodStartTime'] = tables.Float32Col(pos=pos)
-            # pos += 1
-            self.trialsTableDescDict['trialStartTime'] = tables.Float32Col(pos=pos)
-            pos += 1
-            self.trialsTableDescDict['trialEndTime'] = tables.Float32Col(pos=pos)
-            pos += 1
-            # self.trialsTableDescDict['totalTrialTime'] = tables.Float32Col(pos=pos)
-            # pos += 1
-
-            # Loop through the olfactometers used to save each one's parameters for each stimulus in their own column.
-            stimIndex = 0
-            for stimDict in self.infoDict['stimList']:
-                for olfaName in stimDict['olfas'].keys():
-                    self.trialsTableDescDict[f'odor{stimIndex}_{olfaName}_vial'] = tables.UInt8Col(pos=pos)
-                    pos += 1
-                    # self.trialsTableDescDict[f'odor{stimIndex}_{olfaName}_name'] = tables.StringCol(32, pos=pos)  # Size of strings added to the column does not need to exactly match the size given during initialization.
-                    # pos += 1
-                    # self.trialsTableDescDict[f'odor{stimIndex}_{olfaName}_conc'] = tables.Float32Col(pos=pos)
-                    # pos += 1
-                    self.trialsTableDescDict[f'odor{stimIndex}_{olfaName}_flow'] = tables.UInt8Col(pos=pos)  # This is assuming that only flowrates between 1 to 100 will be used.
-                    pos += 1
-                stimIndex += 1
-            
-            self.trialsTable = self.h5file.create_table(where='/', name='trial_data', description=self.trialsTableDescDict, title='Trial Data')
-            self.trialRow = self.trialsTable.row
-            self.h5file.root._v_attrs.bpodStartTime = self.infoDict['Bpod start timestamp']  # Save the bpod start time as an attribute instead of in the table because it remains the same for every trial. So save it when the first trial's data comes.
-
-        # Fill in the column values for the row now that the trialsTable has been created.
-        # self.trialRow['trialNum'] = self.infoDict['currentTrialNum']
-        # self.trialRow['correctResponse'] = self.infoDict['correctResponse']
-        self.trialRow['responseResult'] = self.infoDict['responseResult']
-        # self.trialRow['itiDuration'] = self.infoDict['currentITI']
-        # self.trialRow['bpodStartTime'] = self.infoDict['Bpod start timestamp']
-        self.trialRow['trialStartTime'] = self.infoDict['Trial start timestamp']
-        self.trialRow['trialEndTime'] = self.infoDict['Trial end timestamp']
-        # self.trialRow['totalTrialTime'] = self.trialRow['trialEndTime'] - self.trialRow['trialStartTime']
-        stimIndex = 0
-        for stimDict in self.infoDict['stimList']:  # Loop again to save the data to the columns.
-            for olfaName, olfaValues in stimDict['olfas'].items():
-                self.trialRow[f'odor{stimIndex}_{olfaName}_vial'] = int(olfaValues['vialNum'])
-                # self.trialRow[f'odor{stimIndex}_{olfaName}_name'] = olfaValues['odor']
-                # self.trialRow[f'odor{stimIndex}_{olfaName}_conc'] = olfaValues['vialconc']
-                self.trialRow[f'odor{stimIndex}_{olfaName}_flow'] = olfaValues['mfc_1_flow']
-            stimIndex += 1
-        
-        self.trialRow.append()
-        self.trialsTable.flush()
-    
-    def saveAnalogDataFromModule(self):
-        analogData = self.adc.getSampleFromUSB()
-
-        # Uses the computer's clock to make the timestamps for the samples and period in between each sample.
-        # currentTimer = time.perf_counter()
-        # period = currentTimer - self.previousTimer
-        # elapsed = currentTimer - self.t_start
-        # self.previousTimer = currentTimer
-
-        if analogData is not None:
-            prefix = analogData[0][0]
-            syncByte = analogData[0][1]
-            samples = analogData[1]
-            voltages = [0] * len(samples)
-
-            if (prefix == 35):  # 35 is the decimal value for the ascii char '#' which is the prefix for when the syncByte is received. Otherwise the prefix is 'R' and the syncByte will be zero.
-                if (syncByte == 1):
-                    self.saveVoltages = True  # Start saving to h5 file when syncByte value of 1 is received.
-                elif (syncByte == 2):
-                    self.saveVoltages = False  # Stop saving to h5 file when syncByte value of 2 is received.
-
-            # convert decimal bit value to voltage. The length of samples indicates how many channels are streaming to USB.
-            for i in range(len(samples)):
-                if (self.minVoltages[i] == 0):  # This is when input voltage range is 0V to 10V.
-                    voltages[i] = ((samples[i] * self.maxVoltages[i]) / 8192)
-                else:
-                    if samples[i] >= 4096:
-                        samples[i] -= 4096
-                        voltages[i] = (samples[i] * self.maxVoltages[i]) / 4096
-                    elif samples[i] < 4096:
-                        voltages[i] = ((samples[i] * self.maxVoltages[i]) / 4096) - self.maxVoltages[i]
-            
-            if self.saveVoltages:
-                # self.voltsRow['computerTime'] = elapsed
-                # self.voltsRow['computerPeriod'] = period
-                # self.voltsRow['prefix'] = prefix
-                # self.voltsRow['syncByte'] = syncByte
-                self.voltsRow['bpodTime'] = self.bpodTime
-                self.bpodTime += self.samplingPeriod
-                for i in range(len(voltages)):
-                    self.voltsRow[f'voltageCh{i}'] = voltages[i]
-                self.voltsRow.append()
-
-            # fill buffer and send it when full using the signal.
-            if self.counter < self.analogDataBufferSize:    
-                self.analogDataBuffer[self.counter] = voltages[0]  # Need to use element, not list
-                self.counter += 1
+        # Called from the main thread, so hand the dict over through the thread-safe queue and wake up the run loop. The analog buffer's write index marks where
+        # the trial's samples end, because this thread can be any number of blocks behind the acquisition thread when it gets to the dict.
+        writeIndex = self.analogBuffer.getWriteIndex() if (self.analogBuffer is not None) else 0
+        self.infoDictQueue.put((time.perf_counter(), infoDict, writeIndex))
+        self.wakeEvent.set()
+
+    def saveAnalogData(self):
+        '''
+        Saves every sample the acquisition thread wrote since the last call. A block that holds the end of one or more ended trials is split at the write index
+        recorded when each trial's end of trial dict was received, so that every sample is saved with the trial it was received in. The analog input module's
+        frames are split at its sync frames instead: a trial keeps the frames after that index up to the next ADC_start frame, so that its post-trigger window
+        stays with it and every ADC_start frame is saved with, and anchors, the trial that sent it.
+        '''
+        startIndex, analogData = self.analogBuffer.read(self.analogBufferReader)  # Every sample the acquisition thread received since the last read.
+        position = 0  # Samples of the block before this position have been saved.
+        while len(self.pendingTrialEnds) > 0:
+            trialEnd = self.pendingTrialEnds[0][0] - startIndex  # Position in the block of the first sample received after the trial ended.
+            if trialEnd > len(analogData):
+                break  # The trial's last samples are in a block that has not been read yet.
+            self.saveAnalogBlock(startIndex + position, analogData[position:max(position, trialEnd)])
+            position = max(position, trialEnd)
+            if self.adc is not None:
+                self.saveVoltages = False  # The trial's recording ends with the trial, like at an ADC_stop.
+                startSyncs = position + np.flatnonzero((analogData['prefix'][position:] == 35) & (analogData['syncByte'][position:] == 1))
+                nextStart = int(startSyncs[0]) if (len(startSyncs) > 0) else len(analogData)  # The next trial's first frame.
+                self.saveAnalogBlock(startIndex + position, analogData[position:nextStart])
+                position = nextStart
+                if (len(startSyncs) == 0) and (self.postTriggerRemaining > 0):
+                    break  # The rest of the trial's post-trigger window is in a block that has not been read yet.
+            self.closeTrialSamples()
+
+        self.saveAnalogBlock(startIndex + position, analogData[position:])
+        self.writer.flushIfDue()
+
+    def saveAnalogBlock(self, startIndex, analogData):
+        # Every sample in analogData belongs to the trial self.samplesTrialNum.
+        if len(analogData) == 0:
+            return
+        if self.adc is not None:
+            self.saveFramesFromModule(startIndex, analogData)
+        else:
+            self.saveSamplesFromBpod(startIndex, analogData)
+
+    def saveFramesFromModule(self, startIndex, analogData):
+        # analogData is a structured array of consecutive frames, the first of which has the sampleIndex startIndex.
+        # The number of ch fields indicates how many channels are streaming to USB.
+        counts = recfunctions.structured_to_unstructured(analogData[list(analogData.dtype.names[2:])])
+
+        # Find which frames to save. Saving starts at the frame whose prefix is '#' (35) with syncByte 1 and stops at the frame with syncByte 2. Frames before the first
+        # sync byte of the block keep the state from the end of the previous block.
+        isSync = (analogData['prefix'] == 35) & ((analogData['syncByte'] == 1) | (analogData['syncByte'] == 2))
+        lastSyncIndex = np.maximum.accumulate(np.where(isSync, np.arange(len(analogData)), -1))  # Index of the most recent sync frame at each frame, or -1 if none yet.
+        saveMask = np.where(lastSyncIndex >= 0, analogData['syncByte'][lastSyncIndex] == 1, self.saveVoltages)
+        self.saveVoltages = bool(saveMask[-1])
+
+        # saveAnalogData() only gives this the frames of one trial, so the block's first ADC_start frame is the trial's anchor unless an earlier block of the
+        # trial had one. A trial whose protocol sends ADC_start more than once is anchored at the first, like its anchor time (see getTrialAnchorTime()).
+        startSyncs = np.flatnonzero(isSync & (analogData['syncByte'] == 1))
+        if (len(startSyncs) > 0) and (self.trialAnchorSampleIndex is None):
+            self.trialAnchorSampleIndex = startIndex + int(startSyncs[0])  # The trial's first ADC_start frame.
+
+        earlierCounts = counts[:0]  # Frames of previous blocks in the pre-trigger window of this block's first ADC_start.
+        if (self.preTriggerSamples > 0) or (self.postTriggerSamples > 0):
+            saveMask, earlierFrames = self.addTriggerWindows(startIndex, analogData, isSync, saveMask)
+            earlierCounts = recfunctions.structured_to_unstructured(earlierFrames[list(analogData.dtype.names[2:])]).reshape(-1, counts.shape[1])
+
+        # startIndex is the ring buffer's count of frames received before this block.
+        sampleIndices = np.concatenate((np.arange((startIndex - len(earlierCounts)), startIndex), (startIndex + np.flatnonzero(saveMask))))
+        nSaved = len(sampleIndices)
+        if nSaved > 0:
+            savedCounts = np.concatenate((earlierCounts, counts[saveMask]))
+            records = np.zeros(shape=nSaved, dtype=self.voltsDtype)
+            records['sampleIndex'] = sampleIndices
+            if self.voltsFormat == 'counts':
+                savedValues = savedCounts
             else:
-                # self.voltsTable.flush()  # Write to the file whenever the buffer gets full instead of waiting for the end of trial dict to come from the protocolWorker thread.
-                self.analogDataSignal.emit(self.analogDataBuffer)
-                self.counter = 0
-                self.analogDataBuffer[self.counter] = voltages[0]
-                self.counter += 1
-    
-    def saveAnalogDataFromBpod(self):
-        analogData = self.bpod.read_analog_input()
-
-        if len(analogData) > 0:
-            # convert decimal bit value to voltage. The length of samples indicates how many channels are streaming to USB.
-            nSamples = int(len(analogData) / (self.nChannels + 1))  # Add one to account for the trial number that is included with every sample.
-            voltages = [[]] * self.nChannels  # make a sublist for each channel
-            ind = 0
-            for s in range(nSamples):
-                trialNum = analogData[ind]
-                ind += 1
-                if trialNum == self.trialNum:  # Note that self.trialNum starts at 1 and is incremented each time a new info dict is received.
-                    self.voltsRow['trialNum'] = trialNum
-                    self.voltsRow['bpodTime'] = self.bpodTime
-                    self.bpodTime += self.samplingPeriod
-                    for i in range(self.nChannels):
-                        samp = (analogData[ind] / 4095) * self.maxVoltages[i]
-                        ind += 1
-                        voltages[i].append(samp)
-                        self.voltsRow[f'voltageCh{self.channelIndices[i]}'] = voltages[i][-1]  # The most recently appended value is the current ind.
-                    self.voltsRow.append()
-                else:
-                    # Skip over this sample. Instead of breaking out of the for loop, run the for loop below to increment ind, just in case analogData
-                    # is more than one sample, in which case the next sample could be the correct trialNum.
-                    for i in range(self.nChannels):
-                        ind += 1
-
-            self.analogDataSignal.emit(np.array(voltages[0], dtype='float32'))  # StreamingWorker is currently only capable of plotting one channel.
+                savedValues = self.voltsConverter.convert(savedCounts)  # convert decimal bit value to voltage for the whole block at once.
+            for i in range(min(savedValues.shape[1], self.analogSettings['nActiveChannels'])):
+                records[f'voltageCh{i}'] = savedValues[:, i]
+            self.writer.appendSamples(self.samplesTrialNum, records)
+            self.nTrialSamples += nSaved
+            self.lastSavedSampleIndex = int(sampleIndices[-1])
+
+        self.plotBuffer.write(self.voltsConverter.convert(counts))  # Every streaming channel, converted in one lookup. The streaming plot reads them once per frame.
+
+    def addTriggerWindows(self, startIndex, analogData, isSync, saveMask):
+        '''
+        Adds the pre-trigger and post-trigger windows to the block's saveMask. Returns the new mask and the frames of previous blocks that are in the
+        pre-trigger window of the block's first ADC_start (none if they were already saved), which are saved ahead of the block's frames.
+        '''
+        saveMask = saveMask.copy()
+        nFrames = len(analogData)
+
+        # The post-trigger window of an ADC_stop in a previous block can continue into this block.
+        saveMask[:self.postTriggerRemaining] = True
+        stopSyncs = np.flatnonzero(isSync & (analogData['syncByte'] == 2))
+        for stop in stopSyncs:
+            saveMask[stop:(stop + self.postTriggerSamples)] = True
+        postTriggerEnd = (stopSyncs[-1] + self.postTriggerSamples) if (len(stopSyncs) > 0) else self.postTriggerRemaining
+        self.postTriggerRemaining = max(0, int(postTriggerEnd) - nFrames)
+
+        startSyncs = np.flatnonzero(isSync & (analogData['syncByte'] == 1))
+        for start in startSyncs:
+            saveMask[max(0, (start - self.preTriggerSamples)):start] = True
+        earlierFrames = analogData[:0]
+        if (len(startSyncs) > 0) and (startSyncs[0] < self.preTriggerSamples) and (self.preTriggerEndIndex == startIndex):
+            # preTriggerBuffer only has the frames right before this block if no frames were lost in between (see AnalogRingBuffer's overruns).
+            earlierFrames = self.preTriggerBuffer.readLast(min((self.preTriggerSamples - startSyncs[0]), (startIndex - (self.lastSavedSampleIndex + 1))))
+
+        if self.preTriggerSamples > 0:
+            self.preTriggerBuffer.write(analogData)
+            self.preTriggerEndIndex = startIndex + nFrames
+        return saveMask, earlierFrames
+
+    def saveSamplesFromBpod(self, startIndex, analogData):
+        # Each row of analogData is one sample: [trialNum, ch0, ch1, ...], and the first row has the sampleIndex startIndex.
+        # Only save the samples of the trial being saved. Note that self.samplesTrialNum starts at 1 and is incremented each time a trial's samples are closed.
+        trialMask = (analogData[:, 0] == self.samplesTrialNum)
+        sampleIndices = startIndex + np.flatnonzero(trialMask)
+        nSaved = len(sampleIndices)
+        if nSaved > 0:
+            if self.trialAnchorSampleIndex is None:
+                self.trialAnchorSampleIndex = int(sampleIndices[0])  # The trial's first sample.
+            counts = analogData[trialMask, 1:]
+            voltages = self.voltsConverter.convert(counts)  # convert decimal bit value to voltage for the whole block at once.
+            savedValues = counts if (self.voltsFormat == 'counts') else voltages
+            records = np.zeros(shape=nSaved, dtype=self.voltsDtype)
+            records['trialNum'] = self.samplesTrialNum
+            records['sampleIndex'] = sampleIndices
+            for i in range(self.nChannels):
+                records[f'voltageCh{self.channelIndices[i]}'] = savedValues[:, i]
+            self.writer.appendSamples(self.samplesTrialNum, records)
+            self.nTrialSamples += nSaved
+            self.plotBuffer.write(voltages)  # Shape (nSamples, nChannels), one column per flex channel.
     
+    def saveQueuedInfoDicts(self):
+        while not self.infoDictQueue.empty():
+            receivedTime, self.infoDict, writeIndex = self.infoDictQueue.get()
+            self.saveEndOfTrialData(receivedTime, writeIndex)
+
+    def saveEndOfTrialData(self, receivedTime, writeIndex):
+        hasAnalogInput = (self.adc is not None) or (self.bpod is not None)
+        if not (self.infoDict == {}):
+            self.writer.appendTrial(self.trialNum, self.infoDict)
+            self.writer.appendEvents(self.trialNum, self.infoDict['Events timestamps'])
+
+            if hasAnalogInput:
+                # The trial's samples are closed by saveAnalogData() once every sample before writeIndex is saved.
+                self.pendingTrialEnds.append((writeIndex, self.trialNum, self.getTrialAnchorTime(), receivedTime, False))
+            else:
+                self.recordSaveLatency(time.perf_counter() - receivedTime)
+            self.trialNum += 1  # increment trial number.
+        else:
+            # Empty dict means to discard the trial and repeat it.
+            if hasAnalogInput:
+                self.pendingTrialEnds.append((writeIndex, self.trialNum, np.nan, receivedTime, True))
+            else:
+                self.recordSaveLatency(time.perf_counter() - receivedTime)
+
+    def closeTrialSamples(self):
+        # Ends the samples of the oldest trial in self.pendingTrialEnds, after saveAnalogData() saved all of them.
+        writeIndex, trialNum, anchorTime, receivedTime, discard = self.pendingTrialEnds.popleft()
+        if discard:
+            self.writer.discardTrialSamples()
+            if self.adc is not None:
+                self.postTriggerRemaining = 0
+        else:
+            # Write the voltages to the disk and mark where the next trial's voltages begin.
+            self.writer.endTrialSamples(trialNum, self.trialAnchorSampleIndex, anchorTime)
+            self.saveAcquisitionStats()
+            self.samplesTrialNum = trialNum + 1
+        self.trialAnchorSampleIndex = None
+        self.nTrialSamples = 0
+        if self.adc is not None:
+            self.saveVoltages = False  # reset for the next trial.
+        self.recordSaveLatency(time.perf_counter() - receivedTime)
+
+    def recordSaveLatency(self, latency):
+        # Time from receiveInfoDict() until the trial's data was written and flushed to the file.
+        self.saveLatencies.append(latency)
+        if latency > self.saveLatencyWarning:
+            logging.warning(f"SaveDataWorker took {latency * 1000:.1f} ms to save the end of trial data.")
+
+    def saveLatencyStats(self):
+        if len(self.saveLatencies) > 0:
+            latencies = np.array(self.saveLatencies)
+            self.writer.setAttributes({
+                'trialSaveLatencyMean': latencies.mean(),
+                'trialSaveLatencyP95': np.percentile(latencies, 95),
+                'trialSaveLatencyMax': latencies.max()
+            })
+            logging.info(f"End of trial save latency: mean {latencies.mean() * 1000:.1f} ms, 95th percentile {np.percentile(latencies, 95) * 1000:.1f} ms, max {latencies.max() * 1000:.1f} ms")
+
+    def saveAcquisitionStats(self):
+        overruns = self.analogBuffer.getOverrunCount(self.analogBufferReader)
+        if overruns > self.analogBufferOverruns:
+            logging.warning(f"SaveDataWorker fell behind the acquisition thread and lost {overruns - self.analogBufferOverruns} analog samples.")
+            self.analogBufferOverruns = overruns
+            self.writer.setAttributes({'analogBufferOverruns': overruns})
+
+        if self.adc is not None:
+            # Counters of the USB stream parser that re-synchronizes to the frame prefixes whenever bytes are lost or corrupted.
+            stats = self.adc.getUSBStreamStats()
+            if stats['nFramesLost'] > self.usbFramesLost:
+                logging.warning(f"Analog input module USB stream lost {stats['nFramesLost'] - self.usbFramesLost} frames.")
+                self.usbFramesLost = stats['nFramesLost']
+            self.writer.setAttributes({
+                'usbBytesSkipped': stats['nBytesSkipped'],
+                'usbFramesLost': stats['nFramesLost'],
+                'usbResyncs': stats['nResyncs']
+            })
+
     def run(self):
         # self.t_start = time.perf_counter()
         while self.keepRunning:
-            if self.newData:
-                self.newData = False  # reset
-
-                if not (self.infoDict == {}):
-                    self.saveTrialData()
-                    self.saveEventsTimestamps()
-                    self.saveStatesTimestamps()
-                    self.trialNum += 1  # increment trial number.
-
-                    if (self.adc is not None) or (self.bpod is not None):
-                        # The trial data above comes at the end of a trial, so write the voltages to the disk, and create a new table for the next trial's voltages
-                        self.voltsTable.flush()
-                        self.saveVoltages = False  # reset for the next trial.
-                        self.bpodTime = 0  # reset timestamps for samples back to zero.
-                        
-                        # Re-iterate through the volts table row by row to update the bpodTime so it corresponds to the bpod's trial start time instead of starting it at zero.
-                        # self.bpodTime = self.infoDict['Trial start timestamp']
-                        # for voltsRow in self.voltsTable.iterrows():
-                        #     voltsRow['bpodTime'] = self.bpodTime
-                        #     self.bpodTime += self.samplingPeriod
-                        #     voltsRow.update()
-                        # self.voltsTable.flush()
-
-                        self.voltsTable = self.h5file.create_table(where='/voltages', name=f'trial_{self.trialNum:03d}', description=self.voltsTableDescDict, title=f'Trial {self.trialNum} Voltage Data')
-                        self.voltsRow = self.voltsTable.row
-                else:
-                    # Empty dict means to discard the trial and repeat it.
-                    if (self.adc is not None) or (self.bpod is not None):
-                        self.saveVoltages = False
-                        self.bpodTime = 0
-                        self.voltsTable.remove()  # Delete the current table and create and new empty below.
-                        self.voltsTable = self.h5file.create_table(where='/voltages', name=f'trial_{self.trialNum:03d}', description=self.voltsTableDescDict, title=f'Trial {self.trialNum} Voltage Data')
-                        self.voltsRow = self.voltsTable.row
+            # Sleep until receiveInfoDict(), the acquisition thread, or stopRunning() sets the event. The timeout makes sure the voltages get flushed every flushInterval seconds.
+            self.wakeEvent.wait(timeout=self.flushInterval)
+            self.wakeEvent.clear()  # Clear before doing the work so that anything that arrives in the meantime wakes the next iteration.
 
-            
-            elif self.adc is not None:
-                self.saveAnalogDataFromModule()
-
-            elif self.bpod is not None:
-                self.saveAnalogDataFromBpod()
-
-            else:
-                QThread.sleep(1)  # Need this or else entire application will become severely unresponsive.
+            # Save the end of trial data first, so that the analog data is split at the end of every trial that ended since the last iteration.
+            self.saveQueuedInfoDicts()
+            if (self.adc is not None) or (self.bpod is not None):
+                self.saveAnalogData()
 
+        # Save whatever arrived between the last iteration and stopRunning().
+        self.saveQueuedInfoDicts()
         if (self.adc is not None) or (self.bpod is not None):
-            self.voltsTable.flush()
-
-        self.h5file.close()
-        logging.info("h5 file closed")
+            self.saveAnalogData()
+            while len(self.pendingTrialEnds) > 0:
+                self.closeTrialSamples()  # Only a trial that ended after the last read can still be pending.
+            self.saveAcquisitionStats()
+            if (self.trialAnchorSampleIndex is not None) or (self.nTrialSamples > 0):
+                self.writer.endTrialSamples(self.samplesTrialNum, self.trialAnchorSampleIndex, np.nan)  # The unfinished trial has no end of trial data to give the anchor a bpod time.
+
+        self.saveLatencyStats()
+        if self.analogBuffer is not None:
+            self.analogBuffer.removeWakeEvent(self.wakeEvent)
+        self.writer.close()
+        logging.info("session file closed")
         self.finished.emit()
         
     def stopRunning(self):
         self.keepRunning = False
+        self.wakeEvent.set()
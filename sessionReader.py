@@ -0,0 +1,286 @@
+import tables
+import logging
+import numpy as np
+
+from sessionWriters import indexedColumns
+
+
+logging.basicConfig(format="%(message)s", level=logging.INFO)
+
+
+def sampleIndexToSeconds(sampleIndex, anchorSampleIndex, samplingRate, anchorTime=0.0):
+    '''
+    Converts sample indices (the sampleIndex column of the volts tables) to seconds for a whole array at once. With the default anchorTime the result
+    is the seconds since the anchor sample, and with the anchorTime of the trial's row in /voltages/trial_anchors it is the time on the bpod's clock.
+    The subtraction is done on the integer indices and the result is float64, so it does not lose precision however long the trial is.
+    '''
+    return anchorTime + ((np.asarray(sampleIndex, dtype='int64') - anchorSampleIndex) / float(samplingRate))
+
+
+class LazyVolts(object):
+    '''
+    Array-like view of the voltageCh columns of a range of rows of a volts table. Nothing is read from the file until it is indexed, and then only
+    the requested rows are read and converted to volts, i.e. volts[1000:2000] returns a float32 array of shape (1000, nChannels). This works the
+    same whether the file saved voltages or ADC counts (see the voltsFormat storage setting), so long recordings saved as counts can be analyzed
+    a piece at a time without converting the whole session. Use np.asarray(volts) to read every row.
+    '''
+
+    def __init__(self, table, start, stop, columnNames, gains, offsets):
+        self.table = table
+        self.start = start
+        self.stop = stop
+        self.columnNames = list(columnNames)
+        self.gains = np.asarray(gains, dtype='float64')
+        self.offsets = np.asarray(offsets, dtype='float64')
+
+    def __len__(self):
+        return self.stop - self.start
+
+    @property
+    def shape(self):
+        return (len(self), len(self.columnNames))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+        else:
+            index = range(len(self))[key]  # Raises IndexError like a list would.
+            return self[index:(index + 1)][0]
+
+        volts = np.zeros(shape=(len(range(start, stop, step)), len(self.columnNames)), dtype='float32')
+        if len(volts) > 0:
+            for i in range(len(self.columnNames)):
+                values = self.table.read(self.start + start, self.start + stop, step, field=self.columnNames[i])
+                volts[:, i] = (values * self.gains[i]) + self.offsets[i]
+        return volts
+
+    def __array__(self, dtype=None):
+        volts = self[:]
+        return volts if (dtype is None) else volts.astype(dtype)
+
+
+class SessionReader(object):
+    '''
+    Reads the results file of a session saved by the SaveDataWorker. The voltages can be saved with either layout of the dataStorage settings:
+    'contiguous' (one /voltages/samples table for the whole session and a /voltages/trial_index table with each trial's first and last row) or
+    'perTrial' (one /voltages/trial_NNN table per trial, which is also how files saved before the dataStorage settings existed are organized).
+    readTrialVoltages() returns the same structured array for both, so analysis code does not need to know the layout.
+    Can be used as a context manager, i.e. with SessionReader('results/Mouse_1234_Rig_e_2021-01-01_120000.h5') as session: ...
+    '''
+
+    def __init__(self, fileName):
+        self.h5file = tables.open_file(fileName, mode='r')
+        self.createMissingIndexes(fileName)
+        self.voltsLayout = None
+        self.trialRanges = {}  # Maps trialNum to the (start, stop) rows of its samples when the layout is 'contiguous'.
+        if '/voltages' in self.h5file:
+            self.voltsLayout = getattr(self.h5file.root.voltages._v_attrs, 'layout', 'perTrial')
+            if self.voltsLayout == 'contiguous':
+                # The index is small (one row per trial), so load it once to make slicing a trial a single read of the samples table.
+                trialIndex = self.h5file.root.voltages.trial_index.read()
+                self.trialRanges = {int(t): (int(start), int(stop)) for (t, start, stop) in zip(trialIndex['trialNum'], trialIndex['start'], trialIndex['stop'])}
+        self.trialAnchors = {}  # Maps trialNum to the (anchorSampleIndex, anchorTime) of its samples. Files saved before the sampleIndex column existed have a bpodTime column instead.
+        if '/voltages/trial_anchors' in self.h5file:
+            anchors = self.h5file.root.voltages.trial_anchors.read()
+            self.trialAnchors = {int(t): (int(index), float(time)) for (t, index, time) in zip(anchors['trialNum'], anchors['anchorSampleIndex'], anchors['anchorTime'])}
+
+    def createMissingIndexes(self, fileName):
+        '''
+        The writers only create the indexes of sessionWriters.indexedColumns when the session is closed, so a session that crashed has none. Creates the
+        missing ones so that the queries below read only the matching rows. A file that cannot be written (i.e. it is read-only) is read without them,
+        and the queries read the whole tables instead.
+        '''
+        missing = [(tableName, columnName) for (tableName, columnNames) in indexedColumns.items() if f'/{tableName}' in self.h5file
+                   for columnName in columnNames if not self.h5file.get_node('/', tableName).colindexed[columnName]]
+        if len(missing) == 0:
+            return
+        self.h5file.close()
+        try:
+            with tables.open_file(fileName, mode='a') as h5file:
+                for tableName, columnName in missing:
+                    h5file.get_node('/', tableName).colinstances[columnName].create_csindex()
+                for tableName in set(tableName for (tableName, columnName) in missing):
+                    h5file.get_node('/', tableName).close()  # See HDF5SessionWriter.indexAndCloseTables().
+            logging.info(f"Created the {len(missing)} indexes that {fileName} did not have, which means its session did not end cleanly.")
+        except (OSError, ValueError, tables.HDF5ExtError) as error:
+            logging.warning(f"{fileName} has no indexes and they could not be created ({error}), so queries will read whole tables.")
+        self.h5file = tables.open_file(fileName, mode='r')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def close(self):
+        self.h5file.close()
+
+    def getVoltsLayout(self):
+        return self.voltsLayout
+
+    def getTrialNums(self):
+        # Trial numbers that have voltages saved.
+        if self.voltsLayout == 'contiguous':
+            return sorted(self.trialRanges.keys())
+        elif self.voltsLayout == 'perTrial':
+            return sorted(int(node._v_name[len('trial_'):]) for node in self.h5file.iter_nodes('/voltages', classname='Table') if node._v_name[len('trial_'):].isdigit())  # Skips /voltages/trial_anchors.
+        return []
+
+    def readTrialVoltages(self, trialNum):
+        '''
+        Returns a structured array with the sampleIndex and voltageCh columns (and trialNum for the bpod's flex channels) of every sample of the trial,
+        as they are saved in the file. If the session saved ADC counts, use getTrialVolts() to get volts, and use getTrialTimes() to get timestamps.
+        '''
+        if self.voltsLayout == 'contiguous':
+            if trialNum not in self.trialRanges:
+                raise KeyError(f"Trial {trialNum} has no voltages in this session.")
+            start, stop = self.trialRanges[trialNum]
+            return self.h5file.root.voltages.samples.read(start, stop)
+        elif self.voltsLayout == 'perTrial':
+            return self.h5file.get_node('/voltages', f'trial_{trialNum:03d}').read()
+        raise KeyError("This session has no voltages.")
+
+    def readTrialColumn(self, trialNum, columnName):
+        # Reads a single column of the trial's samples without reading the others.
+        if self.voltsLayout == 'contiguous':
+            if trialNum not in self.trialRanges:
+                raise KeyError(f"Trial {trialNum} has no voltages in this session.")
+            start, stop = self.trialRanges[trialNum]
+            return self.h5file.root.voltages.samples.read(start, stop, field=columnName)
+        elif self.voltsLayout == 'perTrial':
+            return self.h5file.get_node('/voltages', f'trial_{trialNum:03d}').read(field=columnName)
+        raise KeyError("This session has no voltages.")
+
+    def getSamplingRate(self):
+        attrs = self.h5file.root.voltages._v_attrs
+        if 'samplingRate' in attrs:
+            return float(attrs.samplingRate)
+        return float(self.h5file.root.voltages.settings[0]['samplingRate'])
+
+    def getTrialAnchor(self, trialNum):
+        # Returns the (anchorSampleIndex, anchorTime) of the trial. anchorTime is NaN if the session ended before the trial did or the protocol did not send ADC_start.
+        if trialNum not in self.trialAnchors:
+            raise KeyError(f"Trial {trialNum} has no time base in this session.")
+        return self.trialAnchors[trialNum]
+
+    def getTrialTimes(self, trialNum, bpodClock=False):
+        '''
+        Returns the float64 timestamps of the trial's samples. By default they are seconds since the trial's anchor (the analog input module's ADC_start
+        sync byte, or the trial's first sample for the bpod's flex channels). With bpodClock=True they are seconds on the bpod's clock instead, which
+        line up with the trial_data, states and events tables.
+        '''
+        sampleIndex = self.readTrialColumn(trialNum, 'sampleIndex' if (len(self.trialAnchors) > 0) else 'bpodTime')
+        if len(self.trialAnchors) == 0:
+            # Older files saved a float32 bpodTime that starts at zero every trial.
+            if bpodClock:
+                raise KeyError("This session was saved without sample indices, so its samples have no time on the bpod's clock.")
+            return sampleIndex.astype('float64')
+        anchorSampleIndex, anchorTime = self.getTrialAnchor(trialNum)
+        if anchorSampleIndex < 0:
+            anchorSampleIndex = sampleIndex[0] if (len(sampleIndex) > 0) else 0  # No ADC_start frame was received, so count from the first saved sample.
+        return sampleIndexToSeconds(sampleIndex, anchorSampleIndex, self.getSamplingRate(), anchorTime if bpodClock else 0.0)
+
+    def getTrialVolts(self, trialNum):
+        '''
+        Returns a LazyVolts of the trial's samples, which reads and converts them to volts only when it is indexed.
+        '''
+        if self.voltsLayout == 'contiguous':
+            if trialNum not in self.trialRanges:
+                raise KeyError(f"Trial {trialNum} has no voltages in this session.")
+            start, stop = self.trialRanges[trialNum]
+            table = self.h5file.root.voltages.samples
+        elif self.voltsLayout == 'perTrial':
+            table = self.h5file.get_node('/voltages', f'trial_{trialNum:03d}')
+            start, stop = 0, table.nrows
+        else:
+            raise KeyError("This session has no voltages.")
+        return LazyVolts(table, start, stop, *self.getVoltsScales(table))
+
+    def getVoltsScales(self, table):
+        # Returns the names of the voltageCh columns and the gain and offset that convert each one to volts.
+        attrs = self.h5file.root.voltages._v_attrs
+        if getattr(attrs, 'format', 'volts') == 'counts':
+            return (list(attrs.columnNames), attrs.columnGains, attrs.columnOffsets)
+        # The columns already hold volts (files saved before the voltsFormat setting existed always saved volts).
+        columnNames = [name for name in table.colnames if name.startswith('voltageCh')]
+        return (columnNames, [1.0] * len(columnNames), [0.0] * len(columnNames))
+
+    def __readWhere(self, table, conditions, condvars, firstTrial, lastTrial):
+        # Reads the rows of the table that match all of the conditions and are of trials firstTrial to lastTrial. Uses the table's indexes when the columns have one.
+        conditions = list(conditions)
+        condvars = dict(condvars)
+        if firstTrial is not None:
+            conditions.append('(trialNum >= firstTrial)')
+            condvars['firstTrial'] = firstTrial
+        if lastTrial is not None:
+            conditions.append('(trialNum <= lastTrial)')
+            condvars['lastTrial'] = lastTrial
+        if len(conditions) == 0:
+            return table.read()
+        return table.read_where(' & '.join(conditions), condvars=condvars)
+
+    def __getEnumNames(self, table, columnName):
+        enum = table.get_enum(columnName)
+        return [name for (name, code) in sorted(enum, key=lambda item: item[1])]
+
+    def getEventNames(self):
+        # Names of the events that the event column of the /events table can hold, in the order of their codes.
+        return self.__getEnumNames(self.h5file.root.events, 'event')
+
+    def readEvents(self, eventName=None, firstTrial=None, lastTrial=None):
+        '''
+        Returns a structured array with the trialNum, event and timestamp columns of the events in the /events table, optionally only the ones named
+        eventName and of trials firstTrial to lastTrial (inclusive). Uses the table's indexes, so readEvents('Port1In', 200, 400) reads only those rows.
+        The event column holds the event codes, use getEventNames() or self.h5file.root.events.get_enum('event')(code) to get their names.
+        '''
+        table = self.h5file.root.events
+        if eventName is None:
+            return self.__readWhere(table, [], {}, firstTrial, lastTrial)
+        return self.__readWhere(table, ['(event == eventCode)'], {'eventCode': table.get_enum('event')[eventName]}, firstTrial, lastTrial)  # Raises KeyError if the session has no such event.
+
+    def readEventTimes(self, eventName, firstTrial=None, lastTrial=None):
+        # Just the timestamps of readEvents().
+        return self.readEvents(eventName, firstTrial, lastTrial)['timestamp']
+
+    def getStateNames(self):
+        return self.__getEnumNames(self.h5file.root.states, 'state')
+
+    def readStates(self, stateName=None, firstTrial=None, lastTrial=None):
+        # Same as readEvents() for the trialNum, state, start and end columns of the /states table. Each row is one visit of a state.
+        table = self.h5file.root.states
+        if stateName is None:
+            return self.__readWhere(table, [], {}, firstTrial, lastTrial)
+        return self.__readWhere(table, ['(state == stateCode)'], {'stateCode': table.get_enum('state')[stateName]}, firstTrial, lastTrial)
+
+    def readTrials(self, outcome=None, stimulusID=None, firstTrial=None, lastTrial=None):
+        '''
+        Returns the rows of the /trial_data table, optionally only the ones with the outcome ('Correct', 'Wrong', 'NoResponse' or 'Unknown'),
+        the stimulusID (see getStimuli()) and of trials firstTrial to lastTrial. i.e. readTrials('Correct', 3)['trialNum'] are the trials that
+        presented stimulus 3 and were correct.
+        '''
+        table = self.h5file.root.trial_data
+        conditions = []
+        condvars = {}
+        if outcome is not None:
+            conditions.append('(outcome == outcomeCode)')
+            condvars['outcomeCode'] = table.get_enum('outcome')[outcome]
+        if stimulusID is not None:
+            conditions.append('(stimulusID == stimulusIDValue)')
+            condvars['stimulusIDValue'] = stimulusID
+        return self.__readWhere(table, conditions, condvars, firstTrial, lastTrial)
+
+    def getStimuli(self):
+        # Maps each stimulusID to a list of the (odorIndex, olfa, vial, flow) of its odors.
+        stimuli = {}
+        for row in self.h5file.root.stimuli.read():
+            stimuli.setdefault(int(row['stimulusID']), []).append((int(row['odorIndex']), row['olfa'].decode(), int(row['vial']), int(row['flow'])))
+        return stimuli
+
+    def readAllVoltages(self):
+        # Every sample of the session in trial order, as a single structured array.
+        if self.voltsLayout == 'contiguous':
+            return self.h5file.root.voltages.samples.read()
+        trialNums = self.getTrialNums()
+        if len(trialNums) == 0:
+            raise KeyError("This session has no voltages.")
+        return np.concatenate([self.readTrialVoltages(trialNum) for trialNum in trialNums])
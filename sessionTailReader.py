@@ -0,0 +1,99 @@
+import h5py
+import logging
+import numpy as np
+
+
+logging.basicConfig(format="%(message)s", level=logging.INFO)
+
+
+class SessionTailReader(object):
+    '''
+    Reads a session file while the SaveDataWorker is still saving it, from another process. The session must be saved with the 'swmr' writer (the
+    "writer" setting of the dataStorage section of defaults.json), and the file can be opened once the writer has saved the first samples or the
+    first trial's data. Each readNew...() call returns a structured array of only the rows that were saved since the previous call of the same
+    method, so an online analysis script can poll it, i.e.:
+
+        with SessionTailReader('results/Mouse_1234_Rig_e_2021-06-01_120000.h5') as tail:
+            while True:
+                samples = tail.readNewSamples()  # sampleIndex and voltageCh columns, see SessionReader for the time base.
+                licks = tail.readNewEvents()
+                trials = tail.readNewTrials()
+                time.sleep(0.5)
+
+    The samples are saved in blocks at least every flushInterval seconds, and the trial data, states and events at the end of each trial. The samples
+    of a trial that is discarded to be repeated are deleted from the file, so some samples that were already returned might not belong to any trial.
+    Use readNewTrialIndex() to get the rows of the samples of each trial that was kept. Once the session ends, use SessionReader to read the file.
+    '''
+
+    def __init__(self, fileName):
+        self.h5file = h5py.File(fileName, mode='r', swmr=True)
+        self.cursors = {}  # Maps each table's name to the number of its rows already returned.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def close(self):
+        self.h5file.close()
+
+    def readNew(self, tableName):
+        # Rows of the table (i.e. 'events' or 'voltages/samples') saved since the last call with the same tableName. Empty if the table does not exist.
+        if tableName not in self.h5file:
+            return np.zeros(shape=0)
+        table = self.h5file[tableName]
+        table.refresh()  # Get the number of rows that the writer has flushed since the file was opened.
+        cursor = self.cursors.get(tableName, 0)
+        nRows = len(table)
+        if nRows < cursor:
+            logging.info(f"{cursor - nRows} rows of {tableName} were discarded since the last read.")
+            cursor = nRows
+        self.cursors[tableName] = nRows
+        return table[cursor:nRows]
+
+    def readNewSamples(self):
+        return self.readNew('voltages/samples')
+
+    def readNewTrialIndex(self):
+        return self.readNew('voltages/trial_index')
+
+    def readNewTrialAnchors(self):
+        return self.readNew('voltages/trial_anchors')
+
+    def readNewTrials(self):
+        return self.readNew('trial_data')
+
+    def readNewEvents(self):
+        return self.readNew('events')
+
+    def readNewStates(self):
+        return self.readNew('states')
+
+    def getEnumNames(self, tableName, columnName):
+        # Names of the codes of an Enum column (i.e. the event column of the events table) in the order of their codes. Empty if the table does not exist.
+        if tableName not in self.h5file:
+            return []
+        enum = h5py.check_enum_dtype(self.h5file[tableName].dtype[columnName])
+        return sorted(enum.keys(), key=lambda name: enum[name])
+
+    def getEventNames(self):
+        return self.getEnumNames('events', 'event')
+
+    def getStateNames(self):
+        return self.getEnumNames('states', 'state')
+
+    def getOutcomeNames(self):
+        return self.getEnumNames('trial_data', 'outcome')
+
+    def getSamplingRate(self):
+        return float(self.h5file['voltages'].attrs['samplingRate'])
+
+    def convertToVolts(self, samples):
+        # Converts the voltageCh columns of samples returned by readNewSamples() to a float32 array of shape (nSamples, nChannels), whether the file saves volts or counts.
+        attributes = self.h5file['voltages'].attrs
+        columnNames = [name.decode() if isinstance(name, bytes) else str(name) for name in attributes['columnNames']]
+        volts = np.zeros(shape=(len(samples), len(columnNames)), dtype='float32')
+        for i in range(len(columnNames)):
+            volts[:, i] = (samples[columnNames[i]] * attributes['columnGains'][i]) + attributes['columnOffsets'][i]
+        return volts
@@ -0,0 +1,213 @@
+import logging
+import multiprocessing
+import queue
+import time
+import numpy as np
+try:
+    from multiprocessing import shared_memory  # Python 3.8 or newer.
+except ImportError:
+    shared_memory = None
+
+from sessionWriters import SessionWriter, makeSessionWriter
+
+
+logging.basicConfig(format="%(message)s", level=logging.INFO)
+
+
+'''
+Runs a session writer in its own process so that HDF5 compression and flushes do not hold the GIL that the acquisition thread, the SaveDataWorker
+and the GUI need. Enabled by setting "writerProcess" to true in the dataStorage section of defaults.json, with any of the writers of sessionWriters.py.
+The SaveDataWorker calls ProcessSessionWriter like any other writer. The sample records are copied into a SharedRecordRing and everything else
+(trial data, events, attributes, ...) is sent as messages through a multiprocessing queue, in order, to runWriterProcess() which calls the real writer.
+'''
+
+
+def isWriterProcessAvailable():
+    return shared_memory is not None
+
+
+class SharedRecordRing(object):
+    '''
+    Ring buffer of records of a fixed dtype in shared memory, with one producer process that calls write() and one consumer process that calls read().
+    The first bytes of the shared memory hold the total number of records written and read, so both processes can tell how full the ring is.
+    The producer never overwrites records that were not read yet: write() only takes as many records as getNumFree() allows.
+    '''
+
+    headerSize = 64  # Bytes before the records. Keeps the records aligned.
+
+    def __init__(self, dtype, capacity, name=None):
+        self.dtype = np.dtype(dtype)
+        self.capacity = int(capacity)
+        if name is None:
+            self.sharedMemory = shared_memory.SharedMemory(create=True, size=(self.headerSize + (self.capacity * self.dtype.itemsize)))
+        else:
+            self.sharedMemory = shared_memory.SharedMemory(name=name)  # The process that created it unlinks it.
+        self.name = self.sharedMemory.name
+        self.counters = np.ndarray(shape=2, dtype='int64', buffer=self.sharedMemory.buf)  # [nWritten, nRead]
+        self.records = np.ndarray(shape=self.capacity, dtype=self.dtype, buffer=self.sharedMemory.buf, offset=self.headerSize)
+        if name is None:
+            self.counters[:] = 0
+
+    def getNumUsed(self):
+        return int(self.counters[0] - self.counters[1])
+
+    def getNumFree(self):
+        return self.capacity - self.getNumUsed()
+
+    def write(self, records):
+        # Returns the number of records written, which is less than len(records) when the ring is too full.
+        nItems = min(len(records), self.getNumFree())
+        start = int(self.counters[0] % self.capacity)
+        nFirst = min(nItems, self.capacity - start)
+        self.records[start:(start + nFirst)] = records[:nFirst]
+        self.records[:(nItems - nFirst)] = records[nFirst:nItems]
+        self.counters[0] += nItems  # Only count the records once they are copied, so the consumer never reads a partial record.
+        return nItems
+
+    def read(self, nItems):
+        start = int(self.counters[1] % self.capacity)
+        nFirst = min(nItems, self.capacity - start)
+        records = np.concatenate((self.records[start:(start + nFirst)], self.records[:(nItems - nFirst)]))
+        self.counters[1] += nItems
+        return records
+
+    def close(self, unlink=False):
+        del self.counters  # numpy arrays that use the shared memory's buffer must be deleted before it can be closed.
+        del self.records
+        self.sharedMemory.close()
+        if unlink:
+            self.sharedMemory.unlink()
+
+
+def runWriterProcess(storageSettings, messageQueue, nMessagesDone):
+    '''
+    Target of the writer process. Calls the writer's methods in the order the messages were sent until the 'close' message, and flushes the writer
+    at least every flushInterval seconds in between.
+    '''
+    writer = makeSessionWriter(storageSettings)
+    ring = None
+    flushInterval = storageSettings.get('flushInterval', 1.0)
+    try:
+        while True:
+            try:
+                methodName, args = messageQueue.get(timeout=flushInterval)
+            except queue.Empty:
+                writer.flushIfDue()
+                continue
+
+            if methodName == 'appendSamples':
+                trialNum, nRows = args
+                writer.appendSamples(trialNum, ring.read(nRows))
+            elif methodName == 'createVolts':
+                ringName, ringCapacity, sampleDtype, settingsRecords, attributes, expectedRows = args
+                ring = SharedRecordRing(sampleDtype, ringCapacity, name=ringName)
+                writer.createVolts(sampleDtype, settingsRecords, attributes, expectedRows)
+            else:
+                getattr(writer, methodName)(*args)
+            nMessagesDone.value += 1
+            if methodName == 'close':
+                break
+            writer.flushIfDue()
+    except Exception:
+        logging.exception("The session writer process stopped because of an error.")
+    finally:
+        if ring is not None:
+            ring.close()
+
+
+class ProcessSessionWriter(SessionWriter):
+    '''
+    Session writer that forwards every call to the writer chosen by the "writer" setting, running in its own process (see runWriterProcess()).
+    When the writer process falls behind, the shared ring fills up and appendSamples() waits for it, which keeps the SaveDataWorker's samples in
+    the acquisition's AnalogRingBuffer (where overruns are counted) instead of losing them. These waits are the backpressure metrics saved as
+    file attributes when the session is closed:
+        writerProcessRingHighWater: the most records that were ever waiting in the shared ring, out of writerProcessRingCapacity.
+        writerProcessWaits and writerProcessWaitTime: how many times and for how many seconds appendSamples() waited for free space.
+        writerProcessMaxLag: the most messages that were ever sent but not yet done by the writer process.
+    close() sends the metrics and the 'close' message and waits for the writer process to save and close the file.
+    '''
+
+    def __init__(self, storageSettings=None):
+        super(ProcessSessionWriter, self).__init__(storageSettings)
+        self.fileExtension = makeSessionWriter(self.storageSettings).fileExtension
+        self.ringDuration = self.storageSettings.get('writerProcessBufferDuration', 10)  # Seconds of samples that the shared ring holds.
+        context = multiprocessing.get_context('spawn')  # Do not fork the GUI's threads and serial ports.
+        self.messageQueue = context.Queue()
+        self.nMessagesDone = context.RawValue('q', 0)
+        self.nMessagesSent = 0
+        self.process = context.Process(target=runWriterProcess, args=(self.storageSettings, self.messageQueue, self.nMessagesDone), name='SessionWriterProcess')
+        self.process.start()
+        self.ring = None
+        self.failed = False
+        self.metrics = {'writerProcessRingHighWater': 0, 'writerProcessWaits': 0, 'writerProcessWaitTime': 0.0, 'writerProcessMaxLag': 0}
+
+    def send(self, methodName, *args):
+        if not self.failed:
+            self.messageQueue.put((methodName, args))
+            self.nMessagesSent += 1
+            self.metrics['writerProcessMaxLag'] = max(self.metrics['writerProcessMaxLag'], self.nMessagesSent - self.nMessagesDone.value)
+
+    def checkProcess(self):
+        # Stops sending to the writer process if it stopped, instead of waiting for it forever.
+        if (not self.failed) and (not self.process.is_alive()):
+            logging.error("The session writer process stopped. The rest of the session will not be saved.")
+            self.failed = True
+        return not self.failed
+
+    def open(self, fileName, attributes, eventNames=(), stateNames=()):
+        self.send('open', fileName, attributes, list(eventNames), list(stateNames))
+
+    def saveVials(self, vialRecords):
+        self.send('saveVials', vialRecords)
+
+    def createVolts(self, sampleDtype, settingsRecords, attributes, expectedRows):
+        self.ring = SharedRecordRing(sampleDtype, max(int(self.ringDuration * attributes['samplingRate']), 1))
+        self.metrics['writerProcessRingCapacity'] = self.ring.capacity
+        self.send('createVolts', self.ring.name, self.ring.capacity, np.dtype(sampleDtype), settingsRecords, attributes, expectedRows)
+
+    def appendSamples(self, trialNum, records):
+        start = 0
+        waitStart = None
+        while (start < len(records)) and self.checkProcess():
+            nWritten = self.ring.write(records[start:])
+            if nWritten > 0:
+                self.send('appendSamples', trialNum, nWritten)
+                start += nWritten
+                self.metrics['writerProcessRingHighWater'] = max(self.metrics['writerProcessRingHighWater'], self.ring.getNumUsed())
+            else:
+                if waitStart is None:
+                    waitStart = time.perf_counter()
+                    self.metrics['writerProcessWaits'] += 1
+                time.sleep(0.001)  # The ring is full, so wait for the writer process to read some records.
+        if waitStart is not None:
+            self.metrics['writerProcessWaitTime'] += time.perf_counter() - waitStart
+
+    def endTrialSamples(self, trialNum, anchorSampleIndex, anchorTime):
+        self.send('endTrialSamples', trialNum, anchorSampleIndex, anchorTime)
+
+    def discardTrialSamples(self):
+        self.send('discardTrialSamples')
+
+    def appendTrial(self, trialNum, infoDict):
+        self.send('appendTrial', trialNum, infoDict)
+
+    def appendEvents(self, trialNum, eventsDict):
+        self.send('appendEvents', trialNum, eventsDict)
+
+    def setAttributes(self, attributes):
+        self.send('setAttributes', dict(attributes))
+
+    def flushIfDue(self):
+        pass  # The writer process flushes the file at least every flushInterval seconds by itself.
+
+    def close(self):
+        self.send('setAttributes', dict(self.metrics))
+        self.send('close')
+        self.messageQueue.close()
+        self.process.join()  # Wait until everything sent is saved and the file is closed.
+        if self.ring is not None:
+            self.ring.close(unlink=True)
+        logging.info(
+            f"Session writer process: ring high water {self.metrics['writerProcessRingHighWater']} of {self.metrics.get('writerProcessRingCapacity', 0)} samples, "
+            f"{self.metrics['writerProcessWaits']} waits for {self.metrics['writerProcessWaitTime']:.3f} s, max lag {self.metrics['writerProcessMaxLag']} messages"
+        )
@@ -0,0 +1,741 @@
+import tables
+import logging
+import os
+import json
+import time
+import argparse
+import numpy as np
+try:
+    import h5py  # Only needed by the 'swmr' writer.
+except ImportError:
+    h5py = None
+
+
+logging.basicConfig(format="%(message)s", level=logging.INFO)
+
+
+'''
+Session writers save everything the SaveDataWorker collects during a session. The SaveDataWorker only calls the methods of SessionWriter, so the
+file format is chosen by the "writer" setting of the dataStorage section of defaults.json:
+    'hdf5' (default): HDF5SessionWriter, the PyTables file described in the README's Viewing Saved Data section.
+    'binary': BinarySessionWriter, which appends the analog samples to a preallocated memory-mapped flat binary file. It does the least work per
+        sample, so use it when the HDF5 file cannot keep up, and convert the session to HDF5 afterwards with:
+            python sessionWriters.py results/Mouse_1234_Rig_e_2021-06-01_120000.json
+    'swmr': SWMRSessionWriter, which saves the same HDF5 file with h5py in single-writer/multiple-reader mode, so that other processes can read the
+        session while it runs (see sessionTailReader.py).
+'''
+
+
+# Columns of the session's tables that are indexed when the session ends. Indexes make queries by trial, outcome, stimulus, event or state (i.e. every
+# Port1In of trials 200 to 400) read only the matching rows instead of scanning the whole table (see sessionReader.py). They are created once at the end
+# of the session because PyTables would otherwise update them at every flush, which made saving each trial's data about ten times slower. So only a
+# session that was closed cleanly has them, and SessionReader creates them when it opens a file that does not.
+indexedColumns = {
+    'trial_data': ('trialNum', 'outcome', 'stimulusID'),
+    'stimuli': ('stimulusID',),
+    'events': ('trialNum', 'event'),
+    'states': ('trialNum', 'state')
+}
+
+
+def makeSessionWriter(storageSettings):
+    writer = storageSettings.get('writer', 'hdf5')
+    if writer == 'binary':
+        return BinarySessionWriter(storageSettings)
+    if writer == 'swmr':
+        if h5py is not None:
+            return SWMRSessionWriter(storageSettings)
+        logging.warning("The 'swmr' writer needs the h5py package. Using 'hdf5' instead.")
+        return HDF5SessionWriter(storageSettings)
+    if writer != 'hdf5':
+        logging.warning(f"Unknown writer '{writer}' in the dataStorage settings. Using 'hdf5' instead.")
+    return HDF5SessionWriter(storageSettings)
+
+
+class SessionWriter(object):
+    '''
+    Interface of the session writers. Every call comes from the SaveDataWorker's thread.
+    The analog samples are record arrays of the dtype given to createVolts() and are appended to the current trial with appendSamples(). At the
+    end of each trial, endTrialSamples() marks where the trial's samples end, or discardTrialSamples() deletes them when the trial is repeated.
+    '''
+
+    fileExtension = ''
+
+    def __init__(self, storageSettings=None):
+        self.storageSettings = storageSettings if (storageSettings is not None) else {}
+
+    def open(self, fileName, attributes, eventNames=(), stateNames=()):
+        '''
+        attributes is a dict of session information (mouse number, protocol file, ...). eventNames are all of the bpod's event names in the order of
+        their event codes, and stateNames are the names of the protocol's states.
+        '''
+        raise NotImplementedError
+
+    def saveVials(self, vialRecords):
+        # Record array of the olfa, vial, odor and conc of every vial in the olfactometer config file.
+        raise NotImplementedError
+
+    def createVolts(self, sampleDtype, settingsRecords, attributes, expectedRows):
+        '''
+        Called once before the first appendSamples() when the session has analog input. settingsRecords is a record array of the analog input's
+        settings with a row per channel, and attributes has the samplingRate, the voltsFormat ('volts' or 'counts') and the columnNames,
+        columnGains and columnOffsets that convert the sample columns to volts. expectedRows is about the number of samples of a one hour session.
+        '''
+        raise NotImplementedError
+
+    def appendSamples(self, trialNum, records):
+        raise NotImplementedError
+
+    def endTrialSamples(self, trialNum, anchorSampleIndex, anchorTime):
+        # anchorSampleIndex and anchorTime are the trial's time base (see SaveDataWorker). anchorSampleIndex is None if the trial had no anchor.
+        raise NotImplementedError
+
+    def discardTrialSamples(self):
+        raise NotImplementedError
+
+    def appendTrial(self, trialNum, infoDict):
+        # Saves the trial data, stimulus and states timestamps of the end of trial infoDict.
+        raise NotImplementedError
+
+    def appendEvents(self, trialNum, eventsDict):
+        raise NotImplementedError
+
+    def setAttributes(self, attributes):
+        raise NotImplementedError
+
+    def flushIfDue(self):
+        # Called at least every flushInterval seconds so that little data is lost if the application crashes.
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class HDF5SessionWriter(SessionWriter):
+    '''
+    Saves the session in a single HDF5 file with PyTables. Uses the voltsLayout, compressionLibrary, compressionLevel, appendChunkRows and
+    flushInterval dataStorage settings.
+    '''
+
+    fileExtension = '.h5'
+    outcomeNames = ['Correct', 'Wrong', 'NoResponse', 'Unknown']  # Names of the trial_data table's outcome Enum.
+
+    def __init__(self, storageSettings=None):
+        super(HDF5SessionWriter, self).__init__(storageSettings)
+
+        # 'contiguous' saves the voltages of the whole session in a single table (/voltages/samples) and the first and last row of each trial in /voltages/trial_index.
+        # 'perTrial' is the older layout that creates one table per trial (/voltages/trial_001, /voltages/trial_002, ...).
+        self.voltsLayout = self.storageSettings.get('voltsLayout', 'contiguous')
+        if self.voltsLayout not in ('contiguous', 'perTrial'):
+            logging.warning(f"Unknown voltsLayout '{self.voltsLayout}' in the dataStorage settings. Using 'contiguous' instead.")
+            self.voltsLayout = 'contiguous'
+
+        # Compression filters used for every table in the file. A compressionLevel of 0 disables compression. Note that files compressed with 'blosc' can only be
+        # opened by programs that have the blosc filter (i.e. PyTables, or h5py with the hdf5plugin package), while 'zlib' is supported by every HDF5 program.
+        compressionLibrary = self.storageSettings.get('compressionLibrary', 'zlib')
+        compressionLevel = self.storageSettings.get('compressionLevel', 0)
+        if compressionLibrary not in tables.filters.all_complibs:
+            logging.warning(f"Unknown compressionLibrary '{compressionLibrary}' in the dataStorage settings. Using 'zlib' instead.")
+            compressionLibrary = 'zlib'
+        self.filters = tables.Filters(complevel=compressionLevel, complib=compressionLibrary, shuffle=(compressionLevel > 0))
+
+        # Voltages are collected in record arrays and appended to the volts table once appendChunkRows rows are waiting. The table is also written and flushed to
+        # disk at least every flushInterval seconds (and at the end of every trial) so that little data is lost if the application crashes.
+        self.appendChunkRows = self.storageSettings.get('appendChunkRows', 4096)
+        self.flushInterval = self.storageSettings.get('flushInterval', 1.0)
+        self.pendingVolts = []  # Record arrays waiting to be appended to the volts table.
+        self.nPendingVoltsRows = 0
+        self.lastVoltsFlushTime = time.perf_counter()
+
+        self.h5file = None
+        self.voltsGroup = None  # Stays None if the session has no analog input.
+        self.voltsTable = None
+        self.trialsTable = None  # Make it None for now because have to wait for completion of first trial to get the infoDict with data on the trial.
+        self.stimulusIDs = {}  # Maps each distinct stimulus (see getStimulusKey) to its stimulusID in the /stimuli table.
+        self.statesTable = None  # Make it None because have to wait for completion of first trial to get names of all the states for the state column's Enum.
+        self.eventsTable = None  # Same thing here, and also because I do not want to create the eventsTable if no input events even occurred.
+
+    def open(self, fileName, attributes, eventNames=(), stateNames=()):
+        self.eventNames = list(eventNames)  # The states table's Enum is made from the first trial's states instead of stateNames, which also has the states the protocol file did not list.
+        self.h5file = tables.open_file(filename=fileName, mode='w', title=f"Mouse {attributes.get('mouseNum', '')} Experiment Data", filters=self.filters)
+        self.setAttributes(attributes)
+
+    def saveVials(self, vialRecords):
+        self.vialsTable = self.h5file.create_table(where=self.h5file.root, name='vials', description=vialRecords.dtype, title='Vial Details')
+        self.vialsTable.append(vialRecords)
+        self.vialsTable.flush()
+
+    def createVolts(self, sampleDtype, settingsRecords, attributes, expectedRows):
+        self.sampleDtype = sampleDtype
+        self.expectedVoltsRows = expectedRows  # Used to pick the chunk size of the contiguous volts table.
+        self.voltsGroup = self.h5file.create_group(where='/', name='voltages', title='Voltages Per Trial')
+        self.voltsSettingsTable = self.h5file.create_table(where='/voltages', name='settings', description=settingsRecords.dtype, title='Analog Input Settings')
+        self.voltsSettingsTable.append(settingsRecords)
+        self.voltsSettingsTable.flush()
+
+        # Readers use these to convert the voltageCh columns to volts when the format is 'counts' (see sessionReader.py).
+        self.voltsGroup._v_attrs.format = attributes['voltsFormat']
+        self.voltsGroup._v_attrs.columnNames = list(attributes['columnNames'])
+        self.voltsGroup._v_attrs.columnGains = np.array(attributes['columnGains'], dtype='float64')
+        self.voltsGroup._v_attrs.columnOffsets = np.array(attributes['columnOffsets'], dtype='float64')
+        self.voltsGroup._v_attrs.layout = self.voltsLayout  # Tells readers how the voltages are organized. Files without this attribute use the 'perTrial' layout.
+        self.voltsGroup._v_attrs.samplingRate = float(attributes['samplingRate'])
+
+        # Each sample is saved with its integer sampleIndex instead of a timestamp, so that timestamps do not lose precision over long trials. A sample's time on the
+        # bpod's clock is anchorTime + ((sampleIndex - anchorSampleIndex) / samplingRate) using its trial's row of this table (see sessionReader.py).
+        trialAnchorsDescDict = {
+            'trialNum': tables.UInt16Col(pos=0),
+            'anchorSampleIndex': tables.Int64Col(pos=1),  # sampleIndex of the analog input module's ADC_start sync frame, or of the trial's first sample for the bpod's flex channels. -1 if there was none.
+            'anchorTime': tables.Float64Col(pos=2)  # Seconds on the bpod's clock at anchorSampleIndex. NaN if it is not known.
+        }
+        self.trialAnchorsTable = self.h5file.create_table(where='/voltages', name='trial_anchors', description=trialAnchorsDescDict, title='Time Base Of Each Trial')
+
+        if self.voltsLayout == 'contiguous':
+            self.voltsTable = self.h5file.create_table(where='/voltages', name='samples', description=self.sampleDtype, title='Voltage Data', expectedrows=self.expectedVoltsRows)
+            trialIndexDescDict = {
+                'trialNum': tables.UInt16Col(pos=0),
+                'start': tables.UInt64Col(pos=1),  # Row of the trial's first sample in /voltages/samples.
+                'stop': tables.UInt64Col(pos=2)  # One past the row of the trial's last sample, so that samples.read(start, stop) returns the whole trial.
+            }
+            self.trialIndexTable = self.h5file.create_table(where='/voltages', name='trial_index', description=trialIndexDescDict, title='Sample Rows Of Each Trial')
+            self.trialStartRow = 0  # Row of /voltages/samples where the current trial's samples begin.
+
+    def appendSamples(self, trialNum, records):
+        if self.voltsTable is None:
+            # The 'perTrial' layout creates the trial's table when its first samples come.
+            self.voltsTable = self.h5file.create_table(where='/voltages', name=f'trial_{trialNum:03d}', description=self.sampleDtype, title=f'Trial {trialNum} Voltage Data')
+
+        # Collect the records and only append them to the volts table once there are at least appendChunkRows of them, because each append has a fixed overhead.
+        self.pendingVolts.append(records)
+        self.nPendingVoltsRows += len(records)
+        if self.nPendingVoltsRows >= self.appendChunkRows:
+            self.writePendingVolts(flush=False)
+
+    def writePendingVolts(self, flush=True):
+        if self.nPendingVoltsRows > 0:
+            self.appendRows(self.voltsTable, np.concatenate(self.pendingVolts))
+            self.pendingVolts = []
+            self.nPendingVoltsRows = 0
+        if flush and (self.voltsTable is not None):
+            self.voltsTable.flush()
+            self.lastVoltsFlushTime = time.perf_counter()
+
+    def flushIfDue(self):
+        if (time.perf_counter() - self.lastVoltsFlushTime) >= self.flushInterval:
+            self.writePendingVolts()
+            self.lastVoltsFlushTime = time.perf_counter()
+
+    def endTrialSamples(self, trialNum, anchorSampleIndex, anchorTime):
+        self.writePendingVolts()
+        anchor = np.zeros(shape=1, dtype=self.trialAnchorsTable.dtype)
+        anchor['trialNum'] = trialNum
+        anchor['anchorSampleIndex'] = anchorSampleIndex if (anchorSampleIndex is not None) else -1
+        anchor['anchorTime'] = anchorTime if (anchorSampleIndex is not None) else np.nan
+        self.appendRows(self.trialAnchorsTable, anchor)
+        self.trialAnchorsTable.flush()
+
+        if self.voltsLayout == 'perTrial':
+            self.voltsTable = None
+        else:
+            self.appendRows(self.trialIndexTable, np.array([(trialNum, self.trialStartRow, len(self.voltsTable))], dtype=self.trialIndexTable.dtype))
+            self.trialIndexTable.flush()
+            self.trialStartRow = len(self.voltsTable)
+
+    def discardTrialSamples(self):
+        self.pendingVolts = []  # These all belong to the discarded trial.
+        self.nPendingVoltsRows = 0
+        if self.voltsLayout == 'perTrial':
+            if self.voltsTable is not None:
+                self.voltsTable.remove()
+                self.voltsTable = None
+        else:
+            self.voltsTable.flush()  # Rows still waiting in the row buffer must be written before truncating, or they would be appended after the truncation.
+            self.voltsTable.truncate(self.trialStartRow)
+
+    def getStimulusKey(self, infoDict):
+        # The olfactometers' vial and flow of every odor of the trial's stimList, so that trials that presented the same stimulus have the same key.
+        key = []
+        for stimIndex, stimDict in enumerate(infoDict['stimList']):
+            for olfaName, olfaValues in stimDict['olfas'].items():
+                key.append((stimIndex, olfaName, int(olfaValues['vialNum']), int(olfaValues['mfc_1_flow'])))
+        return tuple(key)
+
+    def getStimulusID(self, infoDict):
+        # Each distinct stimulus is saved once in the /stimuli table, with a row per odor per olfactometer, and the trials refer to it by its stimulusID.
+        key = self.getStimulusKey(infoDict)
+        if key not in self.stimulusIDs:
+            self.stimulusIDs[key] = len(self.stimulusIDs)
+            if len(key) > 0:
+                records = np.zeros(shape=len(key), dtype=self.stimuliTable.dtype)
+                records['stimulusID'] = self.stimulusIDs[key]
+                records['odorIndex'], records['olfa'], records['vial'], records['flow'] = zip(*key)
+                self.appendRows(self.stimuliTable, records)
+                self.stimuliTable.flush()
+        return self.stimulusIDs[key]
+
+    def appendTrial(self, trialNum, infoDict):
+        self.saveTrialData(trialNum, infoDict)
+        self.saveStatesTimestamps(trialNum, infoDict['States timestamps'])
+
+    def saveTrialData(self, trialNum, infoDict):
+        # If its None, that means the first trial's data just came, so create the tables. This only happens once.
+        if self.trialsTable is None:
+            stimuliTableDescDict = {
+                'stimulusID': tables.UInt16Col(pos=0),
+                'odorIndex': tables.UInt8Col(pos=1),  # Index of the odor in the trial's stimList, i.e. the first or second odor of the trial.
+                'olfa': tables.StringCol(16, pos=2),
+                'vial': tables.UInt8Col(pos=3),
+                'flow': tables.UInt16Col(pos=4)  # mfc_1_flow. The odors and concentrations of the vials are in the vials table.
+            }
+            self.stimuliTable = self.h5file.create_table(where='/', name='stimuli', description=stimuliTableDescDict, title='Stimuli')
+
+            # 'None' is what the protocolWorker reports for both NoResponse and NoSniff. Trials that ended without a response result (i.e. the protocol has no response states) are 'Unknown'.
+            self.outcomeEnum = tables.Enum(self.outcomeNames)
+            trialsTableDescDict = {
+                'trialNum': tables.UInt16Col(pos=0),
+                'outcome': tables.EnumCol(self.outcomeEnum, 'Unknown', base='uint8', pos=1),
+                'stimulusID': tables.UInt16Col(pos=2),
+                'trialStartTime': tables.Float64Col(pos=3),
+                'trialEndTime': tables.Float64Col(pos=4)
+            }
+            self.trialsTable = self.h5file.create_table(where='/', name='trial_data', description=trialsTableDescDict, title='Trial Data')
+            self.h5file.root._v_attrs.bpodStartTime = infoDict['Bpod start timestamp']  # Save the bpod start time as an attribute instead of in the table because it remains the same for every trial. So save it when the first trial's data comes.
+
+        outcome = {'Correct': 'Correct', 'Wrong': 'Wrong', 'None': 'NoResponse'}.get(infoDict['responseResult'], 'Unknown')
+        trial = np.zeros(shape=1, dtype=self.trialsTable.dtype)
+        trial['trialNum'] = trialNum
+        trial['outcome'] = self.outcomeEnum[outcome]
+        trial['stimulusID'] = self.getStimulusID(infoDict)
+        trial['trialStartTime'] = infoDict['Trial start timestamp']
+        trial['trialEndTime'] = infoDict['Trial end timestamp']
+        self.appendRows(self.trialsTable, trial)
+        self.trialsTable.flush()
+
+    def saveStatesTimestamps(self, trialNum, statesDict):
+        # One table for the whole session with a row per visit of a state: its trial, its name (as an Enum), and its start and end times.
+        # Create it only once, when the first trial's data comes, because that is when the names of all the states are known.
+        if self.statesTable is None:
+            self.statesEnum = tables.Enum(list(statesDict.keys()))
+            statesTableDescDict = {
+                'trialNum': tables.UInt16Col(pos=0),
+                'state': tables.EnumCol(self.statesEnum, list(statesDict.keys())[0], base='uint16', pos=1),
+                'start': tables.Float64Col(pos=2),
+                'end': tables.Float64Col(pos=3)
+            }
+            self.statesTable = self.h5file.create_table(where='/', name='states', description=statesTableDescDict, title='States Timestamps')
+
+        # States that were not visited have a single (NaN, NaN) visit, so they get no rows.
+        visits = [(self.statesEnum[state], start, end) for (state, stateVisits) in statesDict.items() if state in self.statesEnum for (start, end) in stateVisits if not np.isnan(start)]
+        unknownStates = [state for state in statesDict.keys() if state not in self.statesEnum]
+        if len(unknownStates) > 0:
+            logging.warning(f"States {unknownStates} of trial {trialNum} are not in the states table's Enum, so they were not saved.")
+        if len(visits) > 0:
+            visits.sort(key=lambda visit: visit[1])  # Keep each trial's visits in the order they happened.
+            records = np.zeros(shape=len(visits), dtype=self.statesTable.dtype)
+            records['trialNum'] = trialNum
+            records['state'], records['start'], records['end'] = zip(*visits)
+            self.appendRows(self.statesTable, records)
+            self.statesTable.flush()
+
+    def appendEvents(self, trialNum, eventsDict):
+        if len(eventsDict) == 0:
+            return
+
+        # One table for the whole session with a row per event: its trial, its name (as an Enum so each row stores a small integer code), and its timestamp.
+        # Create it only once, when the first trial with events comes.
+        if self.eventsTable is None:
+            # The Enum's values are the bpod's event codes. Event names that the bpod did not list (i.e. when no bpod was given) get the codes after the bpod's events.
+            eventNames = self.eventNames + [event for event in eventsDict.keys() if event not in self.eventNames]
+            self.eventsEnum = tables.Enum(eventNames)
+            eventsTableDescDict = {
+                'trialNum': tables.UInt16Col(pos=0),
+                'event': tables.EnumCol(self.eventsEnum, eventNames[0], base='uint16', pos=1),
+                'timestamp': tables.Float64Col(pos=2)
+            }
+            self.eventsTable = self.h5file.create_table(where='/', name='events', description=eventsTableDescDict, title='Event Timestamps')
+
+        unknownEvents = [event for event in eventsDict.keys() if event not in self.eventsEnum]
+        if len(unknownEvents) > 0:
+            logging.warning(f"Events {unknownEvents} of trial {trialNum} are not in the events table's Enum, so they were not saved.")
+        events = [event for event in eventsDict.keys() if event in self.eventsEnum]
+        nEvents = [len(eventsDict[event]) for event in events]
+        if sum(nEvents) == 0:
+            return
+
+        records = np.zeros(shape=sum(nEvents), dtype=self.eventsTable.dtype)
+        records['trialNum'] = trialNum
+        records['event'] = np.repeat([self.eventsEnum[event] for event in events], nEvents)
+        records['timestamp'] = np.concatenate([eventsDict[event] for event in events])
+        self.appendRows(self.eventsTable, records[np.argsort(records['timestamp'], kind='stable')])  # Keep each trial's events in the order they happened.
+        self.eventsTable.flush()
+
+    def appendRows(self, table, records):
+        # Callers flush the table when the rows should reach the disk.
+        table.append(records)
+
+    def setAttributes(self, attributes):
+        for name, value in attributes.items():
+            setattr(self.h5file.root._v_attrs, name, value)
+
+    def indexAndCloseTables(self):
+        for table in (self.trialsTable, self.stimuliTable if (self.trialsTable is not None) else None, self.eventsTable, self.statesTable):
+            if table is not None:
+                for columnName in indexedColumns[table.name]:
+                    table.colinstances[columnName].create_csindex()
+                table.close()  # Close it explicitly, otherwise PyTables can leave the indexed tables open after closing the file, which raises errors when they are garbage collected.
+
+    def close(self):
+        if self.voltsTable is not None:
+            self.writePendingVolts()
+        self.indexAndCloseTables()
+        self.h5file.close()
+
+
+class SWMRSessionWriter(HDF5SessionWriter):
+    '''
+    Saves the same tables as HDF5SessionWriter, but with h5py in HDF5's single-writer/multiple-reader (SWMR) mode so that other processes can read
+    the file while the session runs (see sessionTailReader.py). PyTables and sessionReader.py read the file like any other session file once it
+    is closed. SWMR mode does not allow creating tables or attributes, so every table is created before the first samples or trial data are saved:
+        The states table's Enum is made from the protocol's state names and the events table's Enum from the bpod's event names given to open().
+        When either is empty, SWMR mode only starts when the first trial's data comes, and that Enum is made from the names in the first trial's data.
+        The voltages are always saved with the 'contiguous' layout.
+        Attributes set during the session (i.e. the acquisition stats) are saved when the session is closed, which also creates the indexes.
+    Only zlib compression can be used, because h5py does not have the blosc filter.
+    '''
+
+    def __init__(self, storageSettings=None):
+        super(SWMRSessionWriter, self).__init__(storageSettings)
+        if self.voltsLayout != 'contiguous':
+            logging.warning("The 'swmr' writer can only save the voltages with the 'contiguous' layout.")
+            self.voltsLayout = 'contiguous'
+
+        compressionLevel = self.storageSettings.get('compressionLevel', 0)
+        if (compressionLevel > 0) and (self.storageSettings.get('compressionLibrary', 'zlib') != 'zlib'):
+            logging.warning("The 'swmr' writer can only use zlib compression. Using 'zlib' instead.")
+        self.datasetOptions = {'compression': 'gzip', 'compression_opts': compressionLevel, 'shuffle': True} if (compressionLevel > 0) else {}
+        self.swmrStarted = False
+        self.pendingAttributes = {}  # Attributes set after SWMR mode started, which are saved when the file is closed.
+
+    def open(self, fileName, attributes, eventNames=(), stateNames=()):
+        self.fileName = fileName
+        self.eventNames = list(eventNames)
+        self.stateNames = list(stateNames)
+        self.h5file = h5py.File(fileName, mode='w', libver=('v110', 'v110'))  # SWMR needs the v110 file format, and PyTables cannot read the newer formats.
+        self.setAttributes(attributes)
+
+    def createDataset(self, name, dtype, chunkRows=256):
+        # An empty dataset that appendRows() resizes. Chunked datasets are the only ones that can grow.
+        return self.h5file.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(chunkRows,), **self.datasetOptions)
+
+    def makeEnumDtype(self, names, basetype):
+        # Values are 0 to n - 1 in the order of the names, like tables.Enum() makes them.
+        return h5py.enum_dtype({name: i for i, name in enumerate(names)}, basetype=basetype)
+
+    def saveVials(self, vialRecords):
+        self.h5file.create_dataset('vials', data=vialRecords)
+
+    def createVolts(self, sampleDtype, settingsRecords, attributes, expectedRows):
+        self.sampleDtype = np.dtype(sampleDtype)
+        self.voltsGroup = self.h5file.create_group('voltages')
+        self.h5file.create_dataset('voltages/settings', data=settingsRecords)
+        self.voltsGroup.attrs['format'] = attributes['voltsFormat']
+        self.voltsGroup.attrs['columnNames'] = list(attributes['columnNames'])
+        self.voltsGroup.attrs['columnGains'] = np.array(attributes['columnGains'], dtype='float64')
+        self.voltsGroup.attrs['columnOffsets'] = np.array(attributes['columnOffsets'], dtype='float64')
+        self.voltsGroup.attrs['layout'] = self.voltsLayout
+        self.voltsGroup.attrs['samplingRate'] = float(attributes['samplingRate'])
+        self.voltsTable = self.createDataset('voltages/samples', self.sampleDtype, chunkRows=self.appendChunkRows)
+        self.trialAnchorsTable = self.createDataset('voltages/trial_anchors', [('trialNum', 'uint16'), ('anchorSampleIndex', 'int64'), ('anchorTime', 'float64')])
+        self.trialIndexTable = self.createDataset('voltages/trial_index', [('trialNum', 'uint16'), ('start', 'uint64'), ('stop', 'uint64')])
+        self.trialStartRow = 0
+
+    def startSWMR(self, infoDict=None):
+        # Create the rest of the tables and switch to SWMR mode when the first samples or trial data come. Readers can open the file from then on.
+        # Without the state or event names for an Enum, the samples are saved without SWMR mode until the first trial's data (infoDict) has them.
+        if self.swmrStarted:
+            return
+        if self.trialsTable is None:
+            self.outcomeEnum = tables.Enum(self.outcomeNames)
+            self.stimuliTable = self.createDataset('stimuli', [('stimulusID', 'uint16'), ('odorIndex', 'uint8'), ('olfa', 'S16'), ('vial', 'uint8'), ('flow', 'uint16')])
+            self.trialsTable = self.createDataset('trial_data', [
+                ('trialNum', 'uint16'),
+                ('outcome', self.makeEnumDtype(self.outcomeNames, 'uint8')),
+                ('stimulusID', 'uint16'),
+                ('trialStartTime', 'float64'),
+                ('trialEndTime', 'float64')
+            ])
+        if infoDict is not None:
+            # Like HDF5SessionWriter, add the names of the first trial's data that open() was not given.
+            self.stateNames += [state for state in infoDict['States timestamps'].keys() if state not in self.stateNames]
+            self.eventNames += [event for event in infoDict['Events timestamps'].keys() if event not in self.eventNames]
+        if (self.statesTable is None) and (len(self.stateNames) > 0):
+            self.statesEnum = tables.Enum(self.stateNames)
+            self.statesTable = self.createDataset('states', [('trialNum', 'uint16'), ('state', self.makeEnumDtype(self.stateNames, 'uint16')), ('start', 'float64'), ('end', 'float64')])
+        if (self.eventsTable is None) and (len(self.eventNames) > 0):
+            self.eventsEnum = tables.Enum(self.eventNames)
+            self.eventsTable = self.createDataset('events', [('trialNum', 'uint16'), ('event', self.makeEnumDtype(self.eventNames, 'uint16')), ('timestamp', 'float64')])
+
+        if (self.statesTable is None) or (self.eventsTable is None):
+            if infoDict is None:
+                return
+            if self.statesTable is None:
+                logging.warning("Neither the protocol nor the first trial has state names, so the 'swmr' writer will not save the states timestamps.")
+            if self.eventsTable is None:
+                logging.warning("Neither the bpod nor the first trial has event names, so the 'swmr' writer will not save the events timestamps.")
+        self.h5file.swmr_mode = True
+        self.swmrStarted = True
+
+    def appendRows(self, table, records):
+        nRows = len(table)
+        table.resize((nRows + len(records),))
+        table[nRows:] = records
+
+    def appendSamples(self, trialNum, records):
+        self.startSWMR()
+        super(SWMRSessionWriter, self).appendSamples(trialNum, records)
+
+    def discardTrialSamples(self):
+        self.pendingVolts = []  # These all belong to the discarded trial.
+        self.nPendingVoltsRows = 0
+        self.voltsTable.resize((self.trialStartRow,))
+        self.voltsTable.flush()
+
+    def appendTrial(self, trialNum, infoDict):
+        self.startSWMR(infoDict)
+        super(SWMRSessionWriter, self).appendTrial(trialNum, infoDict)
+
+    def saveTrialData(self, trialNum, infoDict):
+        if len(self.trialsTable) == 0:
+            self.setAttributes({'bpodStartTime': infoDict['Bpod start timestamp']})
+        super(SWMRSessionWriter, self).saveTrialData(trialNum, infoDict)
+
+    def saveStatesTimestamps(self, trialNum, statesDict):
+        if self.statesTable is not None:
+            super(SWMRSessionWriter, self).saveStatesTimestamps(trialNum, statesDict)
+
+    def appendEvents(self, trialNum, eventsDict):
+        self.startSWMR()
+        if self.eventsTable is not None:
+            super(SWMRSessionWriter, self).appendEvents(trialNum, eventsDict)
+
+    def setAttributes(self, attributes):
+        if self.swmrStarted:
+            self.pendingAttributes.update(attributes)
+        else:
+            for name, value in attributes.items():
+                self.h5file.attrs[name] = value
+
+    def close(self):
+        if self.voltsTable is not None:
+            self.writePendingVolts()
+        self.h5file.close()
+
+        # Reopen the file with PyTables to save what SWMR mode did not allow.
+        with tables.open_file(self.fileName, mode='a') as h5file:
+            for name, value in self.pendingAttributes.items():
+                setattr(h5file.root._v_attrs, name, value)
+            for tableName, columnNames in indexedColumns.items():
+                if f'/{tableName}' in h5file:
+                    table = h5file.get_node('/', tableName)
+                    for columnName in columnNames:
+                        table.colinstances[columnName].create_csindex()
+                    table.close()  # See HDF5SessionWriter.indexAndCloseTables().
+
+
+class BinarySessionWriter(SessionWriter):
+    '''
+    Appends the analog samples to a flat binary file (fileName.samples.bin) that is preallocated for about an hour of samples and memory-mapped,
+    so saving a block of samples is a single copy into the map. The file grows by doubling when it is full and is truncated to the samples saved
+    when the session is closed. Everything else goes in two text files:
+        fileName.json: the sidecar with the session attributes, the dtype of the samples and the analog input settings. It is written when
+            the file is opened, when createVolts() is called and when the session is closed.
+        fileName.trials.jsonl: one JSON line per call of appendTrial(), appendEvents() and endTrialSamples(), which is written immediately.
+    Use loadBinarySamples() to read the samples, and convertToHDF5() to make the same HDF5 file that HDF5SessionWriter would have saved.
+    '''
+
+    fileExtension = '.json'
+
+    def __init__(self, storageSettings=None):
+        super(BinarySessionWriter, self).__init__(storageSettings)
+        self.flushInterval = self.storageSettings.get('flushInterval', 1.0)
+        self.lastFlushTime = time.perf_counter()
+        self.samples = None  # Stays None if the session has no analog input.
+        self.nRows = 0
+        self.trialStartRow = 0
+
+    def open(self, fileName, attributes, eventNames=(), stateNames=()):
+        self.sidecarFileName = fileName
+        self.baseFileName = os.path.splitext(fileName)[0]
+        self.sidecar = {
+            'attributes': dict(attributes),
+            'eventNames': list(eventNames),
+            'stateNames': list(stateNames),
+            'storageSettings': self.storageSettings
+        }
+        self.trialsFile = open(f"{self.baseFileName}.trials.jsonl", 'w')
+        self.writeSidecar()
+
+    def writeSidecar(self):
+        # Write to a temporary file and then replace the sidecar so that it is never left half written.
+        with open(f"{self.sidecarFileName}.tmp", 'w') as f:
+            json.dump(self.sidecar, f, indent=4, default=toJsonValue)
+        os.replace(f"{self.sidecarFileName}.tmp", self.sidecarFileName)
+
+    def writeLine(self, line):
+        self.trialsFile.write(json.dumps(line, default=toJsonValue) + '\n')
+
+    def saveVials(self, vialRecords):
+        self.sidecar['vials'] = recordsToJson(vialRecords)
+        self.writeSidecar()
+
+    def createVolts(self, sampleDtype, settingsRecords, attributes, expectedRows):
+        self.samplesFileName = f"{self.baseFileName}.samples.bin"
+        self.sidecar['samplesFile'] = os.path.basename(self.samplesFileName)
+        self.sidecar['sampleDtype'] = np.lib.format.dtype_to_descr(np.dtype(sampleDtype))
+        self.sidecar['voltsSettings'] = recordsToJson(settingsRecords)
+        self.sidecar['voltsAttributes'] = dict(attributes)
+        self.sidecar['expectedRows'] = int(expectedRows)
+        self.writeSidecar()
+        self.samples = np.memmap(self.samplesFileName, dtype=sampleDtype, mode='w+', shape=(max(int(expectedRows), 1),))
+
+    def appendSamples(self, trialNum, records):
+        if (self.nRows + len(records)) > len(self.samples):
+            self.growSamplesFile(self.nRows + len(records))
+        self.samples[self.nRows:(self.nRows + len(records))] = records
+        self.nRows += len(records)
+
+    def growSamplesFile(self, nRowsNeeded):
+        capacity = max(2 * len(self.samples), nRowsNeeded)
+        dtype = self.samples.dtype
+        self.samples.flush()
+        del self.samples  # Unmap the file before resizing it.
+        with open(self.samplesFileName, 'r+b') as f:
+            f.truncate(capacity * dtype.itemsize)
+        self.samples = np.memmap(self.samplesFileName, dtype=dtype, mode='r+', shape=(capacity,))
+
+    def endTrialSamples(self, trialNum, anchorSampleIndex, anchorTime):
+        self.writeLine({
+            'type': 'samples',
+            'trialNum': trialNum,
+            'start': self.trialStartRow,
+            'stop': self.nRows,
+            'anchorSampleIndex': anchorSampleIndex,
+            'anchorTime': anchorTime
+        })
+        self.trialStartRow = self.nRows
+        self.flush()
+
+    def discardTrialSamples(self):
+        self.nRows = self.trialStartRow  # The next trial's samples overwrite the discarded ones.
+
+    def appendTrial(self, trialNum, infoDict):
+        info = {k: v for k, v in infoDict.items() if k != 'Events timestamps'}  # The events are saved by appendEvents().
+        self.writeLine({'type': 'trial', 'trialNum': trialNum, 'infoDict': info})
+        self.trialsFile.flush()
+
+    def appendEvents(self, trialNum, eventsDict):
+        self.writeLine({'type': 'events', 'trialNum': trialNum, 'events': eventsDict})
+        self.trialsFile.flush()
+
+    def setAttributes(self, attributes):
+        self.sidecar['attributes'].update(attributes)
+
+    def flush(self):
+        if self.samples is not None:
+            self.samples.flush()
+        self.trialsFile.flush()
+        self.lastFlushTime = time.perf_counter()
+
+    def flushIfDue(self):
+        if (time.perf_counter() - self.lastFlushTime) >= self.flushInterval:
+            self.flush()
+
+    def close(self):
+        if self.samples is not None:
+            self.samples.flush()
+            del self.samples
+            self.samples = None
+            with open(self.samplesFileName, 'r+b') as f:
+                f.truncate(self.nRows * np.lib.format.descr_to_dtype(self.sidecar['sampleDtype']).itemsize)
+            self.sidecar['nRows'] = self.nRows
+        self.trialsFile.close()
+        self.writeSidecar()
+
+
+def toJsonValue(value):
+    # Converts the numpy values in the infoDicts and records to values that json can save.
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.decode()
+    raise TypeError(f"{type(value).__name__} cannot be saved in the session's JSON files.")
+
+
+def recordsToJson(records):
+    # tolist() already converts the numbers to python types, which leaves only the strings (bytes) to convert.
+    return {'dtype': np.lib.format.dtype_to_descr(records.dtype), 'rows': [[(value.decode() if isinstance(value, bytes) else value) for value in row] for row in records.tolist()]}
+
+
+def recordsFromJson(recordsDict):
+    return np.array([tuple(row) for row in recordsDict['rows']], dtype=np.lib.format.descr_to_dtype(recordsDict['dtype']))
+
+
+def loadBinarySamples(sidecarFileName):
+    '''
+    Returns the sidecar dict and a read only memory map of the samples saved by a BinarySessionWriter (None if the session had no analog input).
+    Works on sessions that were not closed too, in which case the map also has the unused rows at the end of the preallocated file.
+    '''
+    with open(sidecarFileName, 'r') as f:
+        sidecar = json.load(f)
+    if 'samplesFile' not in sidecar:
+        return sidecar, None
+    samplesFileName = os.path.join(os.path.dirname(sidecarFileName), sidecar['samplesFile'])
+    dtype = np.lib.format.descr_to_dtype(sidecar['sampleDtype'])
+    nRows = sidecar.get('nRows', os.path.getsize(samplesFileName) // dtype.itemsize)
+    if nRows == 0:
+        return sidecar, np.zeros(shape=0, dtype=dtype)
+    return sidecar, np.memmap(samplesFileName, dtype=dtype, mode='r', shape=(nRows,))
+
+
+def convertToHDF5(sidecarFileName, hdf5FileName=None, storageSettings=None):
+    '''
+    Converts a session saved by the BinarySessionWriter to the HDF5 file that the HDF5SessionWriter would have saved, using the session's own
+    dataStorage settings unless others are given. Returns the name of the HDF5 file.
+    '''
+    sidecar, samples = loadBinarySamples(sidecarFileName)
+    if hdf5FileName is None:
+        hdf5FileName = f"{os.path.splitext(sidecarFileName)[0]}{HDF5SessionWriter.fileExtension}"
+    writer = HDF5SessionWriter(storageSettings if (storageSettings is not None) else sidecar['storageSettings'])
+    writer.open(hdf5FileName, sidecar['attributes'], sidecar['eventNames'], sidecar.get('stateNames', []))
+    if 'vials' in sidecar:
+        writer.saveVials(recordsFromJson(sidecar['vials']))
+    if samples is not None:
+        writer.createVolts(samples.dtype, recordsFromJson(sidecar['voltsSettings']), sidecar['voltsAttributes'], sidecar['expectedRows'])
+
+    with open(f"{os.path.splitext(sidecarFileName)[0]}.trials.jsonl", 'r') as f:
+        for line in f:
+            line = json.loads(line)
+            if line['type'] == 'trial':
+                writer.appendTrial(line['trialNum'], line['infoDict'])
+            elif line['type'] == 'events':
+                writer.appendEvents(line['trialNum'], line['events'])
+            elif line['type'] == 'samples':
+                for start in range(line['start'], line['stop'], writer.appendChunkRows):
+                    writer.appendSamples(line['trialNum'], np.array(samples[start:min(start + writer.appendChunkRows, line['stop'])]))
+                writer.endTrialSamples(line['trialNum'], line['anchorSampleIndex'], line['anchorTime'] if (line['anchorTime'] is not None) else np.nan)
+    writer.close()
+    return hdf5FileName
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a session saved with the 'binary' writer to an HDF5 file.")
+    parser.add_argument('sidecarFileNames', nargs='+', help="the .json files of the sessions")
+    args = parser.parse_args()
+    for sidecarFileName in args.sidecarFileNames:
+        logging.info(f"{sidecarFileName} -> {convertToHDF5(sidecarFileName)}")
+
+
+if __name__ == '__main__':
+    main()
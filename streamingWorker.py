@@ -6,12 +6,322 @@ from PyQt5.QtCore import QObject, QTimer, pyqtSignal
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 from matplotlib.lines import Line2D
+from matplotlib.patches import Rectangle
+from matplotlib.ticker import AutoLocator, ScalarFormatter
 import matplotlib.animation as animation
 
 
 logging.basicConfig(format="%(message)s", level=logging.INFO)
 
 
+def makeStreamingWorker(backend, maxt=2, dt=0.02, ymin=-1.0, ymax=1.0, plotInterval=5):
+    '''
+    Creates the streaming plot chosen by the "backend" setting of the streamingPlot section of defaults.json: 'matplotlib' (the default) for
+    StreamingWorker, or 'pyqtgraph' for PyqtgraphStreamingWorker. Both have the same methods, so the rest of the GUI does not need to know which one it got.
+    '''
+    if backend == 'pyqtgraph':
+        from pyqtgraphStreamingWorker import PyqtgraphStreamingWorker  # Imported here because it imports StreamingPlotBuffer from this module.
+        return PyqtgraphStreamingWorker(maxt, dt, ymin, ymax, plotInterval)
+    if backend != 'matplotlib':
+        logging.warning(f"Unknown streaming plot backend '{backend}'. Using matplotlib.")
+    return StreamingWorker(maxt, dt, ymin, ymax, plotInterval)
+
+
+class StreamingPlotBuffer(object):
+    '''
+    Preallocated NumPy arrays holding the points of the streaming plot's current window: the time of each point, the value of each analog channel,
+    and the value of each input port's line (NaN while the port is not triggered). The window holds maxt/dt points after its first point. append()
+    copies each block into the arrays with slice assignments, and when a block does not fit, a new window starts from the last point, like a sweep
+    display. getTimes(), getValues() and getPortValues() return views of the filled part of the arrays, so nothing is allocated or converted from
+    lists while animating. All the channels share the same arrays, so plotting more channels mostly costs the extra lines.
+
+    A window can hold far more points than the plot has pixel columns (100000 at 10 kHz with a 10 s maxt), so the lines are given a min/max
+    envelope instead: the window is split into buckets of consecutive points, about one per pixel column (see setDecimationColumns()), and each
+    bucket is drawn as its lowest and highest point, in the order they happened, so spikes and the signal's extent are kept. A port is shown as
+    triggered during a whole bucket if it was triggered at any of its points. Only the buckets touched by a block are recomputed when it is
+    appended, for all channels at once, so the cost of drawing depends on the plot's width rather than the sampling rate. getDisplayTimes(),
+    getDisplayValues(), getDisplayPortTimes() and getDisplayPortValues() return the envelope, or the points themselves when there are fewer
+    points than columns.
+    '''
+
+    def __init__(self, maxt, dt, nPorts=4, nColumns=1000, nChannels=1):
+        self.nPorts = nPorts
+        self.nColumns = nColumns
+        self.nChannels = nChannels
+        self.allocate(maxt, dt)
+        self.reset()
+
+    def allocate(self, maxt, dt):
+        self.maxt = maxt
+        self.dt = dt
+        self.capacity = max(int(round(maxt / dt)), 1) + 1  # The first point of the window plus one point every dt until maxt.
+        self.tdata = np.zeros(self.capacity)
+        self.ydata = np.zeros((self.nChannels, self.capacity))
+        self.portData = np.full((self.nPorts, self.capacity), np.nan)
+        self.steps = np.arange(1, self.capacity, dtype='float64')  # Multiplied by dt in place to get the times of a block's points without allocating.
+        self.nPoints = 0
+        self.allocateEnvelope()
+
+    def allocateEnvelope(self):
+        # Points per bucket. 1 means no decimation, when the envelope (two points per column) would not have fewer points than the window.
+        self.bucketSize = int(np.ceil(self.capacity / self.nColumns)) if (self.capacity > (2 * self.nColumns)) else 1
+        nBuckets = int(np.ceil(self.capacity / self.bucketSize))
+        self.envelopeTimes = np.zeros((self.nChannels, 2 * nBuckets))  # Two points per bucket: its min and max, in the order they happened.
+        self.envelopeValues = np.zeros((self.nChannels, 2 * nBuckets))
+        self.portEnvelopeTimes = np.zeros(2 * nBuckets)  # The first and last point of each bucket.
+        self.portEnvelopeValues = np.full((self.nPorts, 2 * nBuckets), np.nan)
+        self.nEnvelopePoints = 0
+        self.scaledValues = np.zeros((self.nChannels, (self.capacity if (self.bucketSize == 1) else (2 * nBuckets))))  # Used by getDisplayValues() to scale without allocating.
+
+    def setNumChannels(self, nChannels):
+        # Re-allocates the arrays for a new number of channels and starts a new window from the last point's time.
+        lastTime = self.getLastTime() if (self.nPoints > 0) else 0.0
+        self.nChannels = nChannels
+        self.allocate(self.maxt, self.dt)
+        self.reset(lastTime)
+
+    def setDecimationColumns(self, nColumns):
+        # Sets about how many buckets the window is split into, i.e. the width in pixels of the plot, and recomputes the envelope of the current window.
+        nColumns = int(nColumns)
+        if (nColumns > 0) and (nColumns != self.nColumns):
+            self.nColumns = nColumns
+            self.allocateEnvelope()
+            self.updateEnvelope(0)
+
+    def decimateBuckets(self, firstBucket, nBuckets, bucketLength):
+        # Writes the min and max points of nBuckets consecutive buckets of bucketLength points (shorter than bucketSize only for the last, partial bucket).
+        start = firstBucket * self.bucketSize
+        end = start + (nBuckets * bucketLength)
+        ydata = self.ydata[:, start:end].reshape(self.nChannels, nBuckets, bucketLength)
+        iMin = ydata.argmin(axis=2)
+        iMax = ydata.argmax(axis=2)
+        bucketStarts = start + (np.arange(nBuckets) * bucketLength)
+        iFirst = bucketStarts + np.minimum(iMin, iMax)  # Shape (nChannels, nBuckets).
+        iSecond = bucketStarts + np.maximum(iMin, iMax)
+        channels = np.arange(self.nChannels)[:, np.newaxis]
+        envelopeStart = 2 * firstBucket
+        envelopeEnd = envelopeStart + (2 * nBuckets)
+        self.envelopeTimes[:, envelopeStart:envelopeEnd:2] = self.tdata[iFirst]
+        self.envelopeTimes[:, (envelopeStart + 1):envelopeEnd:2] = self.tdata[iSecond]
+        self.envelopeValues[:, envelopeStart:envelopeEnd:2] = self.ydata[channels, iFirst]
+        self.envelopeValues[:, (envelopeStart + 1):envelopeEnd:2] = self.ydata[channels, iSecond]
+        self.portEnvelopeTimes[envelopeStart:envelopeEnd:2] = self.tdata[bucketStarts]
+        self.portEnvelopeTimes[(envelopeStart + 1):envelopeEnd:2] = self.tdata[bucketStarts + (bucketLength - 1)]
+        portLevels = np.fmax.reduce(self.portData[:, start:end].reshape(self.nPorts, nBuckets, bucketLength), axis=2)  # fmax ignores NaN, so the level if the port was triggered at any point.
+        self.portEnvelopeValues[:, envelopeStart:envelopeEnd:2] = portLevels
+        self.portEnvelopeValues[:, (envelopeStart + 1):envelopeEnd:2] = portLevels
+
+    def updateEnvelope(self, start):
+        # Recomputes the buckets from the one holding the point at index start to the last point.
+        if self.bucketSize == 1:
+            return
+        firstBucket = start // self.bucketSize
+        nFullBuckets = self.nPoints // self.bucketSize
+        if nFullBuckets > firstBucket:
+            self.decimateBuckets(firstBucket, (nFullBuckets - firstBucket), self.bucketSize)
+        remainder = self.nPoints - (nFullBuckets * self.bucketSize)
+        if remainder > 0:
+            self.decimateBuckets(nFullBuckets, 1, remainder)
+        self.nEnvelopePoints = 2 * (nFullBuckets + (1 if (remainder > 0) else 0))
+
+    def reset(self, t=0.0, y=0.0, portValues=None):
+        # Starts a new window with a single point. y is the value of every channel, or one value per channel.
+        self.tdata[0] = t
+        self.ydata[:, 0] = y
+        self.portData[:, 0] = np.nan if (portValues is None) else portValues
+        self.nPoints = 1
+        self.updateEnvelope(0)
+
+    def resize(self, maxt, dt):
+        # Re-allocates the arrays for a new maxt or dt. Keeps the points of the current window if they fit, otherwise starts a new window from the last point.
+        # Returns True if a new window was started.
+        tdata, ydata, portData = self.getTimes().copy(), self.getValues().copy(), self.getPortValues().copy()
+        self.allocate(maxt, dt)
+        if len(tdata) <= self.capacity:
+            self.tdata[:len(tdata)] = tdata
+            self.ydata[:, :len(tdata)] = ydata
+            self.portData[:, :len(tdata)] = portData
+            self.nPoints = len(tdata)
+            self.updateEnvelope(0)
+            return False
+        self.reset(tdata[-1], ydata[:, -1], portData[:, -1])
+        return True
+
+    def append(self, y, portValues):
+        # Adds a block of samples, one dt apart, after the last point. y has shape (nChannels, nSamples), or (nSamples,) for a single channel. portValues
+        # holds the current value of each port's line, used for every new point. If the number of channels changed, a new window is started for them.
+        # Returns True if a new window was started, so that the caller can move the x axis.
+        y = y.reshape(1, -1) if (np.ndim(y) == 1) else y
+        newWindow = False
+        if y.shape[0] != self.nChannels:
+            self.setNumChannels(y.shape[0])
+            newWindow = True
+        nSamples = y.shape[1]
+        if (self.nPoints + nSamples) > self.capacity:
+            last = self.nPoints - 1
+            self.reset(self.tdata[last], self.ydata[:, last], self.portData[:, last])
+            newWindow = True
+            nSkipped = nSamples - (self.capacity - 1)
+            if nSkipped > 0:
+                # The block is longer than a whole window, so only its last points are shown.
+                self.tdata[0] += nSkipped * self.dt
+                self.ydata[:, 0] = y[:, nSkipped - 1]
+                y = y[:, nSkipped:]
+                nSamples = y.shape[1]
+
+        start = self.nPoints
+        end = start + nSamples
+        np.multiply(self.steps[:nSamples], self.dt, out=self.tdata[start:end])
+        self.tdata[start:end] += self.tdata[start - 1]
+        self.ydata[:, start:end] = y
+        for i in range(self.nPorts):
+            self.portData[i, start:end] = portValues[i]
+        self.nPoints = end
+        self.updateEnvelope(0 if newWindow else start)
+        return newWindow
+
+    def getWindowStart(self):
+        return self.tdata[0]
+
+    def getLastTime(self):
+        return self.tdata[self.nPoints - 1]
+
+    def getLastValues(self):
+        return self.ydata[:, self.nPoints - 1]
+
+    def getTimes(self):
+        return self.tdata[:self.nPoints]
+
+    def getValues(self):
+        return self.ydata[:, :self.nPoints]
+
+    def getPortValues(self):
+        return self.portData[:, :self.nPoints]
+
+    def getDisplayTimes(self, channel=0):
+        return self.getTimes() if (self.bucketSize == 1) else self.envelopeTimes[channel, :self.nEnvelopePoints]
+
+    def getDisplayValues(self, channel=0, scale=1.0, offset=0.0):
+        # The channel's points or envelope, multiplied by scale and then added to offset (see StreamingChannelLayout.getTransform()).
+        values = self.ydata[channel, :self.nPoints] if (self.bucketSize == 1) else self.envelopeValues[channel, :self.nEnvelopePoints]
+        if (scale == 1) and (offset == 0):
+            return values
+        scaledValues = self.scaledValues[channel, :len(values)]
+        np.multiply(values, scale, out=scaledValues)
+        scaledValues += offset
+        return scaledValues
+
+    def getDisplayPortTimes(self):
+        return self.getTimes() if (self.bucketSize == 1) else self.portEnvelopeTimes[:self.nEnvelopePoints]
+
+    def getDisplayPortValues(self):
+        return self.getPortValues() if (self.bucketSize == 1) else self.portEnvelopeValues[:, :self.nEnvelopePoints]
+
+
+class StreamingChannelLayout(object):
+    '''
+    Where each analog channel of the streaming plot is drawn. In 'overlaid' mode every visible channel uses the whole y axis, and in 'stacked' mode
+    the y axis is split into one lane per visible channel, the first channel at the top. Each channel can have its own y range (setYRange()), which
+    is scaled to fit its lane. Otherwise the plot's ymin and ymax are used, so in 'overlaid' mode the channel is drawn as is.
+    '''
+
+    modes = ['overlaid', 'stacked']
+
+    def __init__(self, nChannels=1, mode='overlaid'):
+        self.mode = mode if (mode in self.modes) else 'overlaid'
+        self.names = []
+        self.visible = []
+        self.yRanges = []
+        self.setNumChannels(nChannels)
+
+    def setNumChannels(self, nChannels):
+        # The settings of channels beyond nChannels are kept, because the names can be set before the data arrives and the frames plotted before that have one channel.
+        nSettings = max(nChannels, len(self.names))
+        self.names += [f"Channel {i + 1}" for i in range(len(self.names), nSettings)]
+        self.visible += [True] * (nSettings - len(self.visible))
+        self.yRanges += [None] * (nSettings - len(self.yRanges))
+        self.nChannels = nChannels
+
+    def setNames(self, names):
+        self.names = list(names) + self.names[len(names):]
+        self.setNumChannels(self.nChannels)
+
+    def setMode(self, mode):
+        if mode not in self.modes:
+            logging.warning(f"Unknown channel layout '{mode}'. Use one of {self.modes}.")
+            return
+        self.mode = mode
+
+    def setVisible(self, channel, visible):
+        if channel < len(self.visible):
+            self.visible[channel] = bool(visible)
+
+    def setYRange(self, channel, yRange):
+        # yRange is (ymin, ymax), or None to use the plot's.
+        if channel < len(self.yRanges):
+            self.yRanges[channel] = None if (yRange is None) else (float(yRange[0]), float(yRange[1]))
+
+    def getLanes(self, ymin, ymax):
+        # List of (channel, laneBottom, laneTop) for each visible channel.
+        channels = [i for i in range(self.nChannels) if self.visible[i]]
+        if self.mode == 'overlaid':
+            return [(i, ymin, ymax) for i in channels]
+        laneHeight = (ymax - ymin) / max(len(channels), 1)
+        return [(channels[n], ymax - ((n + 1) * laneHeight), ymax - (n * laneHeight)) for n in range(len(channels))]
+
+    def getTransform(self, channel, laneBottom, laneTop, ymin, ymax):
+        # Returns (scale, offset) that map the channel's y range onto its lane: displayed = (value * scale) + offset.
+        channelMin, channelMax = self.yRanges[channel] if (self.yRanges[channel] is not None) else (ymin, ymax)
+        if channelMax == channelMin:
+            return 1.0, laneBottom - channelMin
+        scale = (laneTop - laneBottom) / (channelMax - channelMin)
+        return scale, laneBottom - (channelMin * scale)
+
+
+class StreamingPlotReader(object):
+    '''
+    Reads the analog samples of the streaming plot from the SaveDataWorker's plotBuffer, an AnalogRingBuffer with one item of volts (one value per
+    channel) per sample. The SaveDataWorker writes every converted block into it without any signal, and each frame of the plot calls read() to
+    get every sample written since the previous frame, so the GUI thread wakes up once per frame however high the sampling rate is, and each sample
+    is plotted once. If the plot falls more than the buffer's capacity behind (e.g. while paused), the oldest samples are skipped and counted as
+    the buffer's overruns.
+    '''
+
+    def __init__(self):
+        self.buffer = None
+        self.readerId = None
+        self.firstIndex = 0  # Absolute index in the buffer of the first sample since the last skip().
+        self.nSamples = 0  # Samples written to the buffer since the last skip(), plotted or not.
+
+    def setBuffer(self, buffer):
+        # buffer is the AnalogRingBuffer to read from, or None when there is no analog input to plot.
+        if self.buffer is not None:
+            self.buffer.removeReader(self.readerId)
+        self.buffer = buffer
+        self.readerId = None if (buffer is None) else buffer.addReader()
+        self.skip()
+
+    def skip(self):
+        # Drops the samples that were not read yet, so the next read() starts with the samples written from now on.
+        self.nSamples = 0
+        if self.buffer is not None:
+            startIndex, data = self.buffer.read(self.readerId)
+            self.firstIndex = startIndex + len(data)
+
+    def read(self):
+        # Returns every sample written since the last read, of shape (nChannels, nSamples), or None if there are none.
+        if self.buffer is None:
+            return None
+        startIndex, data = self.buffer.read(self.readerId)
+        if len(data) == 0:
+            return None
+        self.nSamples = startIndex + len(data) - self.firstIndex
+        return data.T
+
+    def getNumSamples(self):
+        return self.nSamples
+
+
 class StreamingWorker(QObject):  
     def __init__(self, maxt=2, dt=0.02, ymin=-1.0, ymax=1.0, plotInterval=5):
         super().__init__()
@@ -25,20 +335,18 @@ class StreamingWorker(QObject):
         self.ymax = ymax
         self.ymin = ymin
         self.plotInterval = plotInterval  # milliseconds
-        self.tdata = [0]
-        self.ydata = [0]
-        self.port_1_Data = [np.nan]
-        self.port_2_Data = [np.nan]
-        self.port_3_Data = [np.nan]
-        self.port_4_Data = [np.nan]
-
-        self.line = Line2D(self.tdata, self.ydata, animated=True)
-        self.port_1_Line = Line2D(self.tdata, self.port_1_Data, color='b', marker='.', animated=True)
-        self.port_2_Line = Line2D(self.tdata, self.port_2_Data, color='b', marker='.', animated=True)
-        self.port_3_Line = Line2D(self.tdata, self.port_3_Data, color='b', marker='.', animated=True)
-        self.port_4_Line = Line2D(self.tdata, self.port_4_Data, color='b', marker='.', animated=True)
+        self.plotData = StreamingPlotBuffer(self.maxt, self.dt, nColumns=int(self.ax.bbox.width))
+        self.dynamic_canvas.mpl_connect('resize_event', lambda event: self.plotData.setDecimationColumns(self.ax.bbox.width))  # One envelope bucket per pixel column of the axes.
+        self.channelLayout = StreamingChannelLayout()
+        self.channelLines = []  # One line per analog channel, created by updateChannelLines() once the number of channels is known.
+        tdata = self.plotData.getTimes()
+        portData = self.plotData.getPortValues()
+
+        self.port_1_Line = Line2D(tdata, portData[0], color='b', marker='.', animated=True)
+        self.port_2_Line = Line2D(tdata, portData[1], color='b', marker='.', animated=True)
+        self.port_3_Line = Line2D(tdata, portData[2], color='b', marker='.', animated=True)
+        self.port_4_Line = Line2D(tdata, portData[3], color='b', marker='.', animated=True)
         
-        self.ax.add_line(self.line)
         self.ax.add_line(self.port_1_Line)
         self.ax.add_line(self.port_2_Line)
         self.ax.add_line(self.port_3_Line)
@@ -50,9 +358,9 @@ class StreamingWorker(QObject):
         self.spanStart = 0
         self.spanEnd = 0
         self.spanColor = 'b'
+        self.updateChannelLines()
 
-        self.analogData = np.zeros(self.maxt)
-        self.nTotalDataPoints = 0
+        self.dataReader = StreamingPlotReader()  # Gets the samples of each frame from the SaveDataWorker's plotBuffer, given by setDataBuffer().
         self.nDataPointsPlotted = 0
 
         self.timeText = self.ax.text(0.70, 0.99, '', transform=self.ax.transAxes)
@@ -82,15 +390,21 @@ class StreamingWorker(QObject):
         self.ymin = ymin
         self.ax.set_ylim(self.ymin - 0.1, self.ymax + 0.1)
         self.triggeredValues = [self.ymax, (self.ymax - ((self.ymax - self.ymin) / 3)), (((self.ymax - self.ymin) / 3) + self.ymin), self.ymin]
-        self.ax.figure.canvas.draw()
+        self.updateChannelAxis()  # The stacked lanes divide the y axis, so they move with it.
 
     def setXaxis(self, maxt):
         self.maxt = maxt
-        self.ax.set_xlim(self.tdata[-1], self.tdata[-1] + self.maxt)
+        self.plotData.resize(self.maxt, self.dt)
+        lastt = self.plotData.getLastTime()
+        self.plotData.reset(lastt, self.plotData.getLastValues(), self.plotData.getPortValues()[:, -1])  # Start a new window from the last point.
+        self.ax.set_xlim(lastt, lastt + self.maxt)
         self.ax.figure.canvas.draw()
 
     def set_dt(self, dt):
         self.dt = dt
+        if self.plotData.resize(self.maxt, self.dt):  # The window holds maxt/dt points, so it needs a new size.
+            self.ax.set_xlim(self.plotData.getWindowStart(), self.plotData.getWindowStart() + self.maxt)
+            self.ax.figure.canvas.draw()
 
     def setPlotInterval(self, value):
         self.plotInterval = value
@@ -108,45 +422,29 @@ class StreamingWorker(QObject):
         self.counter += 1
         elap = 'Elapsed Time: {dt:.3f} sec'.format(dt= (time.perf_counter() - self.t_start))
         self.elapsed.set_text(elap)
-        self.nTotalDataPointsText.set_text('Total data points: {0}'.format(self.nTotalDataPoints))
+        self.nTotalDataPointsText.set_text('Total data points: {0}'.format(self.dataReader.getNumSamples()))
         self.nDataPointsPlottedText.set_text('Plotted data points: {0}'.format(self.nDataPointsPlotted))
 
-        lastt = self.tdata[-1]
-        if lastt > self.tdata[0] + self.maxt:  # reset the arrays
-            self.tdata = [self.tdata[-1]]
-            self.ydata = [self.ydata[-1]]
-            self.port_1_Data = [self.port_1_Data[-1]]
-            self.port_2_Data = [self.port_2_Data[-1]]
-            self.port_3_Data = [self.port_3_Data[-1]]
-            self.port_4_Data = [self.port_4_Data[-1]]
-            
-            self.ax.set_xlim(self.tdata[0], self.tdata[0] + self.maxt)
+        if y is None:
+            pass  # No new samples since the last frame, so only the texts and the span change.
+        elif self.plotData.append(y, self.inputPorts):  # The window is full (or the number of channels changed) so a new one was started.
+            if len(self.channelLines) != self.plotData.nChannels:
+                self.updateChannelLines()
+            self.ax.set_xlim(self.plotData.getWindowStart(), self.plotData.getWindowStart() + self.maxt)
             self.ax.figure.canvas.draw()
-
-        # t = self.tdata[-1] + self.dt
-        # self.tdata.append(t)
-        # self.ydata.append(y)
-        # self.lickRightCorrectData.append(self.lickRightCorrect)
-        # self.lickRightWrongData.append(self.lickRightWrong)
-        # self.lickLeftCorrectData.append(self.lickLeftCorrect)
-        # self.lickLeftWrongData.append(self.lickLeftWrong)
-        # self.nDataPointsPlotted += 1
-
-        for i in range(len(y)):
-            t = self.tdata[-1] + self.dt
-            self.tdata.append(t)
-            self.ydata.append(y[i])
-            self.port_1_Data.append(self.inputPorts[0])
-            self.port_2_Data.append(self.inputPorts[1])
-            self.port_3_Data.append(self.inputPorts[2])
-            self.port_4_Data.append(self.inputPorts[3])
-            self.nDataPointsPlotted += 1
-
-        self.line.set_data(self.tdata, self.ydata)
-        self.port_1_Line.set_data(self.tdata, self.port_1_Data)
-        self.port_2_Line.set_data(self.tdata, self.port_2_Data)
-        self.port_3_Line.set_data(self.tdata, self.port_3_Data)
-        self.port_4_Line.set_data(self.tdata, self.port_4_Data)
+        self.nDataPointsPlotted += 0 if (y is None) else np.shape(y)[-1]
+
+        # The lines get views of the plot buffer's min/max envelope, so there are no lists to convert and about two points per pixel column to draw.
+        # Each visible channel is scaled into its lane (see StreamingChannelLayout).
+        for channel, laneBottom, laneTop in self.channelLayout.getLanes(self.ymin, self.ymax):
+            scale, offset = self.channelLayout.getTransform(channel, laneBottom, laneTop, self.ymin, self.ymax)
+            self.channelLines[channel].set_data(self.plotData.getDisplayTimes(channel), self.plotData.getDisplayValues(channel, scale, offset))
+        tdata = self.plotData.getDisplayPortTimes()
+        portData = self.plotData.getDisplayPortValues()
+        self.port_1_Line.set_data(tdata, portData[0])
+        self.port_2_Line.set_data(tdata, portData[1])
+        self.port_3_Line.set_data(tdata, portData[2])
+        self.port_4_Line.set_data(tdata, portData[3])
         
         #if self.presentOdor: # Bea 16/12/2022
         #    self.spanEnd = self.tdata[-1]  # Make the responseWindow grow with sniff signal.
@@ -156,28 +454,81 @@ class StreamingWorker(QObject):
         #    self.span.set_xy([[self.spanStart, self.ymin], [self.spanStart, self.ymax], [self.spanEnd, self.ymax], [self.spanEnd, self.ymin], [self.spanStart, self.ymin]])
 
         if self.activateResponseWindow or self.presentOdor:
-            self.spanEnd = self.tdata[-1]  # Make the responseWindow grow with sniff signal.
-            # set_xy() takes an (N, 2) list of the verticies of the polygon. Since axvspan is a rectangle, there are 5 verticies in order to create a complete closed circuit.
-            self.span.set_xy([[self.spanStart, self.ymin], [self.spanStart, self.ymax], [self.spanEnd, self.ymax], [self.spanEnd, self.ymin], [self.spanStart, self.ymin]])
+            self.spanEnd = self.plotData.getLastTime()  # Make the responseWindow grow with sniff signal.
+            self.setSpanBounds()
         else:
             # This else statement keeps the responseWindow showing until the canvas gets redrawn because I need to do something with self.span in order to be able to return it.
-            self.span.set_xy([[self.spanStart, self.ymin], [self.spanStart, self.ymax], [self.spanEnd, self.ymax], [self.spanEnd, self.ymin], [self.spanStart, self.ymin]])
+            self.setSpanBounds()
+
+        return tuple(self.channelLines) + (self.port_1_Line, self.port_2_Line, self.port_3_Line, self.port_4_Line, self.span)
+
+    def updateChannelLines(self):
+        # Creates one line per channel of the plot buffer, replacing the previous ones.
+        for line in self.channelLines:
+            line.remove()
+        self.channelLayout.setNumChannels(self.plotData.nChannels)
+        self.channelLines = []
+        for i in range(self.plotData.nChannels):
+            line = Line2D([], [], color=f'C{i}', animated=True)
+            self.ax.add_line(line)
+            self.channelLines.append(line)
+        self.updateChannelAxis()
+
+    def updateChannelAxis(self):
+        # Shows the visible channels' lines, and labels them with a legend when overlaid or with the y axis ticks of their lanes when stacked.
+        for i in range(len(self.channelLines)):
+            self.channelLines[i].set_visible(self.channelLayout.visible[i])
+            self.channelLines[i].set_label(self.channelLayout.names[i])
+        lanes = self.channelLayout.getLanes(self.ymin, self.ymax)
+        if self.channelLayout.mode == 'stacked':
+            self.ax.set_yticks([(laneBottom + laneTop) / 2 for channel, laneBottom, laneTop in lanes])
+            self.ax.set_yticklabels([self.channelLayout.names[channel] for channel, laneBottom, laneTop in lanes])
+        else:
+            self.ax.yaxis.set_major_locator(AutoLocator())
+            self.ax.yaxis.set_major_formatter(ScalarFormatter())
+        if self.ax.get_legend() is not None:
+            self.ax.get_legend().remove()
+        if (self.channelLayout.mode == 'overlaid') and (len(lanes) > 1):
+            self.ax.legend(handles=[self.channelLines[channel] for channel, laneBottom, laneTop in lanes], loc='upper left')
+        self.ax.figure.canvas.draw()
 
-        return self.line, self.port_1_Line, self.port_2_Line, self.port_3_Line, self.port_4_Line, self.span,
+    def setChannelNames(self, names):
+        self.channelLayout.setNames(names)
+        self.updateChannelAxis()
+
+    def setChannelLayout(self, mode):
+        # mode is 'overlaid' or 'stacked'.
+        self.channelLayout.setMode(mode)
+        self.updateChannelAxis()
+
+    def setChannelVisible(self, channel, visible):
+        self.channelLayout.setVisible(channel, visible)
+        self.updateChannelAxis()
+
+    def setChannelYRange(self, channel, yRange):
+        # yRange is the (ymin, ymax) of the channel's values that fills its lane, or None to use the plot's y axis.
+        self.channelLayout.setYRange(channel, yRange)
+        self.updateChannelAxis()
+
+    def setSpanBounds(self):
+        if isinstance(self.span, Rectangle):
+            # axvspan returns a Rectangle since matplotlib 3.9, whose height already spans the whole y axis.
+            self.span.set_x(self.spanStart)
+            self.span.set_width(self.spanEnd - self.spanStart)
+        else:
+            # set_xy() takes an (N, 2) list of the verticies of the polygon. Since axvspan is a rectangle, there are 5 verticies in order to create a complete closed circuit.
+            self.span.set_xy([[self.spanStart, self.ymin], [self.spanStart, self.ymax], [self.spanEnd, self.ymax], [self.spanEnd, self.ymin], [self.spanStart, self.ymin]])
 
-    def getData(self, data):
-        self.analogData = data
-        self.nTotalDataPoints += len(data)
+    def setDataBuffer(self, buffer):
+        # buffer is the SaveDataWorker's plotBuffer (see StreamingPlotReader), or None when there is no analog input to plot.
+        self.dataReader.setBuffer(buffer)
 
     def emitter(self):
-        yield self.analogData
-        
-        # for y in self.analogData:
-        #     yield y
+        yield self.dataReader.read()  # Every sample written since the previous frame, or None.
 
     def animate(self):
         # pass a generator in "emitter" to produce data for the update func
-        self.anim = animation.FuncAnimation(self.fig, self.update, self.emitter, interval=self.plotInterval, blit=True)
+        self.anim = animation.FuncAnimation(self.fig, self.update, self.emitter, interval=self.plotInterval, blit=True, cache_frame_data=False)  # Each frame is new data, so there is nothing to cache.
 
     def getFigure(self):
         return self.dynamic_canvas
@@ -185,7 +536,7 @@ class StreamingWorker(QObject):
     def checkOdorPresentation(self, stateName): 
         if stateName == 'PresentOdor':
             self.presentOdor = True
-            self.spanStart = self.tdata[-1]
+            self.spanStart = self.plotData.getLastTime()
             self.span.set_color('y')
             self.spanColor = 'y'
            
@@ -194,7 +545,7 @@ class StreamingWorker(QObject):
         # This function gets the newStateSignal from protocolWorker.
         if stateName == 'WaitForResponse':
             self.presentOdor = False
-            self.spanStart = self.tdata[-1]
+            self.spanStart = self.plotData.getLastTime()
             self.span.set_color('b')  # reset color to blue until lick occurs.
             self.activateResponseWindow = True
             self.spanColor = 'b'  # also reset the color variable to blue.
@@ -247,19 +598,14 @@ class StreamingWorker(QObject):
 
     def startAnimation(self):
         if self.isSetup and not self.isRun:
+            self.t_start = time.perf_counter()  # Set before animate() because FuncAnimation draws the first frame when it is created.
             self.animate()
-            self.t_start = time.perf_counter()
             self.isRun = True
             return True
         return False
 
     def resetPlot(self):
-        self.tdata = [0]
-        self.ydata = [0]
-        self.port_1_Data = [np.nan]
-        self.port_2_Data = [np.nan]
-        self.port_3_Data = [np.nan]
-        self.port_4_Data = [np.nan]
+        self.plotData.reset()
         
         self.ax.set_xlim(0, self.maxt)
 
@@ -269,7 +615,7 @@ class StreamingWorker(QObject):
         self.nTotalDataPointsText.set_text('')
         self.nDataPointsPlottedText.set_text('')
 
-        self.nTotalDataPoints = 0
+        self.dataReader.skip()  # Start from the samples written from now on instead of the ones written while the plot was paused.
         self.nDataPointsPlotted = 0
         self.plotTimer = 0
         self.previousTimer = 0
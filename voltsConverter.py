@@ -0,0 +1,42 @@
+import numpy as np
+
+
+def makeLookupTable(nCodes, fullScale, multiplier, offset):
+    '''
+    Returns the voltage of every possible ADC count from 0 to nCodes - 1, i.e. ((count / fullScale) * multiplier) - offset.
+    '''
+    codes = np.arange(nCodes, dtype='float64')
+    return ((codes / fullScale) * multiplier) - offset
+
+
+class VoltsConverter(object):
+    '''
+    Converts blocks of ADC counts to volts using one lookup table per channel, so that a whole block is converted with a single fancy-index
+    operation instead of a Python if/elif per sample and per channel. lookupTables is a 2D array-like of shape (nChannels, nCodes) where row i
+    holds the voltage of every count of channel i.
+    '''
+
+    def __init__(self, lookupTables):
+        self.lookupTables = np.asarray(lookupTables, dtype='float32')
+        self.nChannels = self.lookupTables.shape[0]
+        self.channelIndices = np.arange(self.nChannels)
+
+    @classmethod
+    def fromAnalogInModule(cls, analogInModule, inputRanges):
+        # inputRanges is the list of range strings (i.e. '-10V:10V') of each channel that is streaming to USB, in streaming order.
+        return cls(analogInModule.getVoltsLookupTables(inputRanges))
+
+    @classmethod
+    def fromFlexChannels(cls, maxVoltages):
+        # The bpod's flex channels are 12-bit ADCs that measure from 0V to maxVoltage.
+        return cls([makeLookupTable(4096, 4095, maxVoltage, 0) for maxVoltage in maxVoltages])
+
+    def convert(self, counts):
+        '''
+        counts is an integer array of shape (nSamples, nChannels). Returns a float32 array of voltages with the same shape.
+        '''
+        return self.lookupTables[self.channelIndices, counts]
+
+    def convertChannel(self, counts, channelIndex):
+        # Same as convert() for the counts of a single channel, given as a 1D array.
+        return self.lookupTables[channelIndex, counts]